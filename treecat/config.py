@@ -9,7 +9,28 @@ DEFAULT_CONFIG = {
     'learning_sample_tree_steps': 10,
     'learning_annealing_init_rows': 2,
     'learning_annealing_epochs': 100.0,
+    'learning_annealing_schedule': 'linear',
+    'learning_annealing_target_change': 0.3,
+    'learning_annealing_min_change': 0.1,
+    'learning_annealing_min_churn': 0.01,
+    'learning_annealing_max_tree_interval': 16,
+    'learning_fused_segments': True,
+    'learning_pair_cache': False,
+    'learning_num_threads': 0,
+    'learning_num_processes': 0,
+    'learning_checkpoint_period': 1,
+    'learning_update_tree_samples': 1,
+    'learning_sample_tree_rows': 0,
+    'learning_sample_tree_candidates': 0,
+    'learning_sample_tree_refresh': 10,
+    'learning_sample_tree_candidate_rows': 1000,
+    'learning_early_stopping_patience': 0,
+    'learning_early_stopping_tol': 0.01,
+    'learning_early_stopping_churn': 0.05,
+    'learning_parallel_sweeps': 0,
+    'learning_warm_start_epochs': 5,
     'serving_samples': 1024,
+    'serving_dedup_rows': False,
 }
 
 
@@ -13,6 +13,7 @@ from parsable import parsable
 from six.moves import cPickle as pickle
 from six.moves import intern
 from six.moves import zip
+from treecat.util import dedup_rows
 from treecat.version import __version__
 
 logger = logging.getLogger(__name__)
@@ -49,8 +50,12 @@ def csv_writer(filename):
 
 
 @parsable
-def import_data(schema_csv_in, data_csv_in, dataset_out):
-    """Import a csv file into internal treecat format."""
+def import_data(schema_csv_in, data_csv_in, dataset_out, dedup=False):
+    """Import a csv file into internal treecat format.
+
+    If dedup is true, repeated rows are stored once, with their multiplicities
+    stored as dataset['weights'].
+    """
     # Load schema.
     features = []
     types = {}
@@ -119,6 +124,10 @@ def import_data(schema_csv_in, data_csv_in, dataset_out):
                 min_value, max_value = ordinal_ranges[name]
                 data[row_id, pos] = value - min_value
                 data[row_id, pos + 1] = max_value - value
+    weights = None
+    if dedup:
+        data, weights, _ = dedup_rows(data)
+        logger.info('Found %d unique rows', data.shape[0])
     dataset = {
         'schema': {
             'features': features,
@@ -129,6 +138,8 @@ def import_data(schema_csv_in, data_csv_in, dataset_out):
         'ragged_index': ragged_index,
         'data': data,
     }
+    if weights is not None:
+        dataset['weights'] = weights
     pickle_dump(dataset, dataset_out)
 
 
@@ -143,6 +154,8 @@ def export_data(dataset_in, schema_csv_out, data_csv_out):
     ordinal_ranges = schema['ordinal_ranges']
     ragged_index = dataset['ragged_index']
     data = dataset['data']
+    if 'weights' in dataset:
+        data = np.repeat(data, dataset['weights'], axis=0)
 
     # Write schema csv.
     with csv_writer(schema_csv_out) as writer:
@@ -61,10 +61,10 @@ def generate_dataset_file(num_rows, num_cols, num_cats=4, rate=1.0):
 
 def generate_tree(num_cols):
     tree = TreeStructure(num_cols)
-    K = tree.complete_grid.shape[1]
+    K = num_cols * (num_cols - 1) // 2
     edge_logits = np.random.random([K])
     edges = [tuple(edge) for edge in tree.tree_grid[1:3, :].T]
-    edges = sample_tree(tree.complete_grid, edge_logits, edges, steps=10)
+    edges = sample_tree(None, edge_logits, edges, steps=10)
     tree.set_edges(edges)
     return tree
 
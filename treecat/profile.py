@@ -54,7 +54,11 @@ def train_files(dataset_path, config_path):
     from treecat.training import train_model
     dataset = pickle_load(dataset_path)
     config = pickle_load(config_path)
-    train_model(dataset['ragged_index'], dataset['data'], config['config'])
+    train_model(
+        dataset['ragged_index'],
+        dataset['data'],
+        config['config'],
+        weights=dataset.get('weights'))
 
 
 @parsable
@@ -69,6 +73,7 @@ def serve_files(model_path, config_path):
     counts = np.ones(model['tree'].num_vertices, np.int8)
     samples = server.sample(num_samples, counts)
     server.logprob(samples)
+    server.marginals(samples)
     server.correlation()
 
 
@@ -3,13 +3,21 @@ from __future__ import division
 from __future__ import print_function
 
 import logging
+import math
 
 import numpy as np
+import scipy.sparse
 from scipy.misc import logsumexp
 from scipy.stats import entropy
 
+from six.moves import xrange
 from treecat.structure import TreeStructure
-from treecat.structure import make_propagation_schedule
+from treecat.structure import jit_make_propagation_schedule
+from treecat.util import dedup_rows
+from treecat.util import find_sparse_cells
+from treecat.util import jit
+from treecat.util import make_sparse_data
+from treecat.util import no_jit
 from treecat.util import profile
 from treecat.util import sample_from_probs2
 
@@ -24,6 +32,307 @@ def correlation(probs):
     return np.sqrt(1.0 - np.exp(-2.0 * mutual_information))
 
 
+@jit(nopython=True, cache=True)
+def jit_observe(beg, end, data_cells, data_counts, col_verts, log_feat_cond,
+                log_messages):
+    """Add evidence of one sparse row to log messages, in place.
+
+    Args:
+      beg, end: The range of cells of the row in data_cells and data_counts.
+      log_messages: A [V, M]-shaped array of log messages.
+    """
+    for j in xrange(beg, end):
+        cell = data_cells[j]
+        factor = data_counts[j]
+        log_messages[col_verts[cell], :] += factor * log_feat_cond[cell, :]
+
+
+@jit(nopython=True, cache=True)
+def jit_exp_messages(log_messages, messages):
+    """Convert log messages to messages rescaled to have maximum 1.
+
+    Returns:
+      The log scale removed from messages.
+    """
+    V, M = messages.shape
+    logprob = 0.0
+    for v in xrange(V):
+        shift = log_messages[v, :].max()
+        for m in xrange(M):
+            messages[v, m] = math.exp(log_messages[v, m] - shift)
+        logprob += shift
+    return logprob
+
+
+@jit(nopython=True, cache=True)
+def jit_propagate_in(schedule, edge_trans, messages):
+    """Propagate latent state inward from leaves to root, in place.
+
+    Returns:
+      The log normalizer, including the total at the root.
+    """
+    M = messages.shape[1]
+    logprob = 0.0
+    for i in xrange(len(schedule)):
+        op, v, v2, e = schedule[i]
+        if op == 1:  # OP_IN
+            # Propagate latent state inward from children to v.
+            message_sum = 0.0
+            for m in xrange(M):
+                total = 0.0
+                if v < v2:
+                    for m2 in xrange(M):
+                        total += edge_trans[e, m, m2] * messages[v2, m2]
+                else:
+                    for m2 in xrange(M):
+                        total += edge_trans[e, m2, m] * messages[v2, m2]
+                messages[v, m] *= total
+                message_sum += messages[v, m]
+            messages[v, :] /= message_sum
+            logprob += math.log(message_sum)
+        elif op == 2:  # OP_ROOT
+            # Aggregate the total logprob.
+            logprob += math.log(messages[v, :].sum())
+            break
+    return logprob
+
+
+@jit(nopython=True, cache=True)
+def jit_logprob(data_indptr, data_cells, data_counts, col_verts, schedule,
+                log_vert_probs, log_feat_cond, edge_trans, log_messages,
+                messages, logprob):
+    """Compute log probabilities of rows of sparse data.
+
+    Args:
+      data_indptr, data_cells, data_counts: An [N, R]-shaped sparse matrix
+        in CSR format.
+      log_messages, messages: [V, M]-shaped scratch buffers.
+      logprob: An [N]-shaped output buffer.
+    """
+    for n in xrange(len(logprob)):
+        log_messages[:, :] = log_vert_probs
+        jit_observe(data_indptr[n], data_indptr[n + 1], data_cells,
+                    data_counts, col_verts, log_feat_cond, log_messages)
+        logprob[n] = jit_exp_messages(log_messages, messages)
+        logprob[n] += jit_propagate_in(schedule, edge_trans, messages)
+
+
+@jit(nopython=True, cache=True)
+def jit_propagate_dirty(schedule, edge_trans, dirty, log_messages,
+                        base_messages, messages, log_scales):
+    """Propagate inward from leaves to root, recomputing only dirty vertices.
+
+    Each dirty vertex's message is recomputed from its log evidence and its
+    children, reading messages of clean children from base_messages.
+
+    Args:
+      dirty: A [V]-shaped boolean array, closed under taking parents.
+      log_messages: A [V, M]-shaped array of log prior and evidence.
+      base_messages: A [V, M]-shaped array of messages of clean vertices.
+      messages: A [V, M]-shaped buffer for messages of dirty vertices.
+      log_scales: A [V]-shaped buffer for the log normalizers of dirty
+        vertices, whose sum over all vertices is the log probability.
+    """
+    M = messages.shape[1]
+    for i in xrange(len(schedule)):
+        op, v, v2, e = schedule[i]
+        if not dirty[v]:
+            continue
+        if op == 0:  # OP_UP
+            shift = log_messages[v, :].max()
+            for m in xrange(M):
+                messages[v, m] = math.exp(log_messages[v, m] - shift)
+            log_scales[v] = shift
+        elif op == 1:  # OP_IN
+            child = messages[v2, :] if dirty[v2] else base_messages[v2, :]
+            message_sum = 0.0
+            for m in xrange(M):
+                total = 0.0
+                if v < v2:
+                    for m2 in xrange(M):
+                        total += edge_trans[e, m, m2] * child[m2]
+                else:
+                    for m2 in xrange(M):
+                        total += edge_trans[e, m2, m] * child[m2]
+                messages[v, m] *= total
+                message_sum += messages[v, m]
+            messages[v, :] /= message_sum
+            log_scales[v] += math.log(message_sum)
+        elif op == 2:  # OP_ROOT
+            log_scales[v] += math.log(messages[v, :].sum())
+            break
+
+
+@jit(nopython=True, cache=True)
+def jit_conditional_logprob(data_indptr, data_cells, data_counts,
+                            cond_indptr, cond_cells, cond_counts, col_verts,
+                            schedule, parents, log_vert_probs, log_feat_cond,
+                            edge_trans, log_messages, cond_messages, messages,
+                            cond_log_scales, log_scales, dirty, logprob,
+                            cond_logprob):
+    """Compute joint and marginal log probabilities of pairs of sparse rows.
+
+    The joint pass reuses the evidence and messages of the marginal pass,
+    recomputing only vertices with data and their ancestors, so that sparse
+    data costs O(depth) per observed vertex rather than O(V).
+
+    Args:
+      data_indptr, data_cells, data_counts: An [N, R]-shaped sparse matrix
+        in CSR format.
+      cond_indptr, cond_cells, cond_counts: An [N, R]-shaped sparse matrix
+        of conditioning data in CSR format.
+      parents: A [V]-shaped array of parent vertices, with -1 at the root.
+      log_messages, cond_messages, messages: [V, M]-shaped scratch buffers.
+      cond_log_scales, log_scales, dirty: [V]-shaped scratch buffers.
+      logprob: An [N]-shaped output buffer for log P(data, cond_data).
+      cond_logprob: An [N]-shaped output buffer for log P(cond_data).
+    """
+    for n in xrange(len(logprob)):
+        # Compute the marginal, where every vertex is dirty.
+        log_messages[:, :] = log_vert_probs
+        jit_observe(cond_indptr[n], cond_indptr[n + 1], cond_cells,
+                    cond_counts, col_verts, log_feat_cond, log_messages)
+        dirty[:] = True
+        jit_propagate_dirty(schedule, edge_trans, dirty, log_messages,
+                            cond_messages, cond_messages, cond_log_scales)
+        cond_logprob[n] = cond_log_scales.sum()
+
+        # Compute the joint, where only ancestors of data are dirty.
+        beg = data_indptr[n]
+        end = data_indptr[n + 1]
+        jit_observe(beg, end, data_cells, data_counts, col_verts,
+                    log_feat_cond, log_messages)
+        dirty[:] = False
+        for j in xrange(beg, end):
+            v = col_verts[data_cells[j]]
+            while v != -1 and not dirty[v]:
+                dirty[v] = True
+                v = parents[v]
+        jit_propagate_dirty(schedule, edge_trans, dirty, log_messages,
+                            cond_messages, messages, log_scales)
+        logprob[n] = cond_logprob[n]
+        for v in xrange(len(dirty)):
+            if dirty[v]:
+                logprob[n] += log_scales[v] - cond_log_scales[v]
+
+
+@jit(nopython=True, cache=True)
+def jit_sample_categorical(probs):
+    """Sample from a non-normalized categorical distribution."""
+    u = np.random.random() * probs.sum()
+    for i in xrange(len(probs) - 1):
+        u -= probs[i]
+        if u < 0:
+            return i
+    return len(probs) - 1
+
+
+@jit(nopython=True, cache=True)
+def jit_sample(counts, sample_indptr, data_indptr, data_cells, data_counts,
+               col_verts, ragged_index, schedule, log_vert_probs,
+               log_feat_cond, feat_cond, edge_trans, log_messages, messages,
+               message, vert_samples, feat_samples):
+    """Draw samples conditioned on each of many sparse rows of data.
+
+    Args:
+      counts: A [V]-shaped array of counts of multinomials to sample.
+      sample_indptr: A [B+1]-shaped array of offsets, such that samples
+        conditioned on row b are written to
+        feat_samples[sample_indptr[b]:sample_indptr[b+1], :].
+      data_indptr, data_cells, data_counts: A [B, R]-shaped sparse matrix
+        of conditioning data in CSR format.
+      log_messages, messages: [V, M]-shaped scratch buffers.
+      message: An [M]-shaped scratch buffer.
+      vert_samples: A [V]-shaped scratch buffer.
+      feat_samples: An [S, R]-shaped output buffer of zeros.
+    """
+    B = len(sample_indptr) - 1
+    for b in xrange(B):
+        log_messages[:, :] = log_vert_probs
+        jit_observe(data_indptr[b], data_indptr[b + 1], data_cells,
+                    data_counts, col_verts, log_feat_cond, log_messages)
+        jit_exp_messages(log_messages, messages)
+        jit_propagate_in(schedule, edge_trans, messages)
+        for n in xrange(sample_indptr[b], sample_indptr[b + 1]):
+            for i in xrange(len(schedule)):
+                op, v, v2, e = schedule[i]
+                if op == 2 or op == 3:  # OP_ROOT or OP_OUT
+                    message[:] = messages[v, :]
+                    if op == 3:  # OP_OUT
+                        # Propagate latent state outward from parent to v.
+                        m2 = vert_samples[v2]
+                        if v2 < v:
+                            message *= edge_trans[e, m2, :]
+                        else:
+                            message *= edge_trans[e, :, m2]
+                    m = jit_sample_categorical(message)
+                    vert_samples[v] = m
+                    # Propagate downward from latent to observed.
+                    beg = ragged_index[v]
+                    end = ragged_index[v + 1]
+                    for _ in xrange(counts[v]):
+                        c = jit_sample_categorical(feat_cond[beg:end, m])
+                        feat_samples[n, beg + c] += 1
+
+
+@jit(nopython=True, cache=True)
+def jit_marginals(data_indptr, data_cells, data_counts, col_verts, schedule,
+                  log_vert_probs, log_feat_cond, feat_cond, edge_trans,
+                  log_messages, messages, beliefs, up, outside, marginals,
+                  logprob):
+    """Compute posterior marginals of each feature given rows of sparse data.
+
+    This runs sum-product message passing, inward and then outward.
+
+    Args:
+      data_indptr, data_cells, data_counts: An [N, R]-shaped sparse matrix
+        in CSR format.
+      log_messages, messages, beliefs: [V, M]-shaped scratch buffers.
+      up, outside: [M]-shaped scratch buffers.
+      marginals: An [N, R]-shaped output buffer.
+      logprob: An [N]-shaped output buffer.
+    """
+    V, M = messages.shape
+    R = marginals.shape[1]
+    for n in xrange(len(logprob)):
+        log_messages[:, :] = log_vert_probs
+        jit_observe(data_indptr[n], data_indptr[n + 1], data_cells,
+                    data_counts, col_verts, log_feat_cond, log_messages)
+        logprob[n] = jit_exp_messages(log_messages, messages)
+        logprob[n] += jit_propagate_in(schedule, edge_trans, messages)
+        for i in xrange(len(schedule)):
+            op, v, v2, e = schedule[i]
+            if op == 2:  # OP_ROOT
+                beliefs[v, :] = messages[v, :] / messages[v, :].sum()
+            elif op == 3:  # OP_OUT
+                # Divide the inward message of v out of its parent's belief.
+                for m2 in xrange(M):
+                    total = 0.0
+                    for m in xrange(M):
+                        if v2 < v:
+                            total += edge_trans[e, m2, m] * messages[v, m]
+                        else:
+                            total += edge_trans[e, m, m2] * messages[v, m]
+                    up[m2] = beliefs[v2, m2] / total
+                # Propagate latent state outward from parent to v.
+                for m in xrange(M):
+                    total = 0.0
+                    for m2 in xrange(M):
+                        if v2 < v:
+                            total += edge_trans[e, m2, m] * up[m2]
+                        else:
+                            total += edge_trans[e, m, m2] * up[m2]
+                    outside[m] = messages[v, m] * total
+                beliefs[v, :] = outside / outside.sum()
+        # Propagate downward from latent to observed.
+        for r in xrange(R):
+            v = col_verts[r]
+            total = 0.0
+            for m in xrange(M):
+                total += beliefs[v, m] * feat_cond[r, m]
+            marginals[n, r] = total
+
+
 class TreeCatServer(object):
     """Class for serving queries against a trained TreeCat model."""
 
@@ -34,7 +343,14 @@ class TreeCatServer(object):
         self._tree = tree
         self._config = config
         self._ragged_index = ragged_index
-        self._schedule = make_propagation_schedule(tree.tree_grid)
+        self._schedule = tree.propagation_schedule()
+        # Jitted kernels are used for serving whenever numba is enabled;
+        # otherwise level-batched numpy code is used.
+        self._jit = (jit is not no_jit)
+        self._parents = np.full(tree.num_vertices, -1, np.int32)
+        for op, v, v2, e in self._schedule:
+            if op == 1:  # OP_IN
+                self._parents[v2] = v
         self._zero_row = np.zeros(self._ragged_index[-1], np.int8)
 
         # These are useful dimensions to import into locals().
@@ -72,10 +388,125 @@ class TreeCatServer(object):
             beg, end = ragged_index[v:v + 2]
             self._feat_cond[beg:end, :] /= meas_probs[v, np.newaxis, :]
 
+        # These are used to compute evidence in log space, see _observe().
+        self._log_vert_probs = np.log(self._vert_probs)
+        self._log_feat_cond = np.log(self._feat_cond)
+        R = ragged_index[-1]
+        cols = np.arange(R)
+        self._col_verts = np.searchsorted(ragged_index, cols, 'right') - 1
+
+        # This pads feat_cond to a [V, M, C]-shaped array, where C is the
+        # largest feature size, so that features of many vertices can be
+        # sampled at once. Padding cells have zero probability.
+        C = np.diff(ragged_index).max() if V else 0
+        verts = self._col_verts
+        self._feat_cond_padded = np.zeros([V, M, C], np.float32)
+        self._feat_cond_padded[verts, :, cols - ragged_index[verts]] = \
+            self._feat_cond
+
+        # These group the schedule by depth, so that message passing costs
+        # O(depth) batched operations rather than O(V) small operations.
+        self._levels = self._make_levels()
+
+    def _make_levels(self, root=None):
+        """Makes a level-grouped schedule for batched message passing.
+
+        Args:
+          root: Optional root vertex, defaults to a center of the tree.
+
+        Returns:
+          A list of tuples (vertices, parents, trans, groups, starts), one
+          per level of the tree, where trans is an [n, M, M]-shaped array of
+          transitions oriented as trans[k, parent_state, vertex_state], and
+          starts are the positions in each level where the children of each
+          of the parents in groups begin. The root level has parents = -1 and
+          trans = None.
+        """
+        schedule, level_offsets = self._tree.propagation_schedule(
+            root, levels=True)
+        levels = []
+        for beg, end in zip(level_offsets[:-1], level_offsets[1:]):
+            vertices, parents, edges = schedule[beg:end].T
+            trans = None
+            if beg:
+                trans = self._edge_trans[edges]
+                flip = (parents > vertices)
+                trans[flip] = trans[flip].transpose((0, 2, 1))
+            starts = np.flatnonzero(
+                np.concatenate([[True], parents[1:] != parents[:-1]]))
+            groups = parents[starts]
+            levels.append((vertices, parents, trans, groups, starts))
+        return levels
+
+    def _propagate_in(self, messages):
+        """Propagate latent state inward from leaves to root.
+
+        This processes each level of the tree in a single batched operation,
+        accumulating children in log space to avoid underflow at vertices
+        with many children.
+
+        Args:
+          messages: A [V, M, N]-shaped array of messages, updated in place.
+
+        Returns:
+          An [N]-shaped numpy array of log normalizers.
+        """
+        logprob = np.zeros(messages.shape[-1], np.float32)
+        for vertices, _, trans, groups, starts in reversed(self._levels[1:]):
+            # Each transition is oriented as (parent, child).
+            logs = np.log(np.matmul(trans, messages[vertices]))
+            logs = np.add.reduceat(logs, starts, axis=0)
+            shift = logs.max(axis=1, keepdims=True)
+            message = messages[groups] * np.exp(logs - shift)
+            message_sum = message.sum(axis=1, keepdims=True)
+            messages[groups] = message / message_sum
+            logprob += (shift + np.log(message_sum)).sum(axis=(0, 1))
+        return logprob
+
     def zero_row(self):
         """Make an empty data row."""
         return self._zero_row.copy()
 
+    def _observe(self, N, rows, cols, counts):
+        """Propagate observations upward from observed to latent.
+
+        Evidence is computed in log space as a single sparse-dense product
+        [V * N, R] x [R, M] over observed cells, so that missing blocks of
+        sparse data cost nothing and rows with many observations do not
+        underflow. Each message is then rescaled to have maximum 1.
+
+        Args:
+          N: The number of rows.
+          rows, cols, counts: Observed cells as returned by
+            find_sparse_cells(). Repeated cells are summed.
+
+        Returns:
+          A pair (messages, logprob), where messages is a [V, M, N]-shaped
+          array of messages combining prior and evidence, and logprob is an
+          [N]-shaped array of the log scale removed from messages.
+        """
+        V, E, M = self._VEM
+        verts = self._col_verts[cols].astype(np.int64)
+        # This uses a with-replacement approximation which is exact for
+        # categorical data but approximate for multinomial.
+        counts = scipy.sparse.csr_matrix(
+            (counts.astype(np.float32), (verts * N + rows, cols)),
+            shape=(V * N, self._ragged_index[-1]))
+        messages = counts.dot(self._log_feat_cond).reshape((V, N, M))
+        messages = messages.transpose((0, 2, 1))
+        messages += self._log_vert_probs[:, :, np.newaxis]
+        shift = messages.max(axis=1, keepdims=True)
+        messages = np.exp(messages - shift)
+        return messages, shift.sum(axis=(0, 1))
+
+    def _propagate_logprob(self, messages, logprob):
+        """Propagate observed messages to the root, updating logprob."""
+        logprob += self._propagate_in(messages)
+        # Aggregate the total logprob at the root.
+        root = self._levels[0][0][0]
+        logprob += np.log(messages[root].sum(axis=0))
+        return logprob
+
     @profile
     def sample(self, N, counts, data=None):
         """Draw N samples from the posterior distribution.
@@ -85,63 +516,102 @@ class TreeCatServer(object):
           counts: A [V]-shaped numpy array of requested counts of multinomials
             to sample.
           data: An optional single row of conditioning data, as a ragged nummpy
-            array of multinomial counts.
+            array or [1, _]-shaped scipy.sparse matrix of multinomial counts.
 
         Returns:
           An [N, _]-shaped numpy array of sampled multinomial data.
         """
         logger.debug('sampling data')
-        V, E, M = self._VEM
         if data is None:
             data = self._zero_row
+        elif scipy.sparse.issparse(data):
+            data = data.toarray().reshape(self._zero_row.shape)
         assert data.shape == self._zero_row.shape
         assert data.dtype == self._zero_row.dtype
-        assert counts.shape == (V, )
-        assert counts.dtype == np.int8
-        edge_trans = self._edge_trans
-        feat_cond = self._feat_cond
+        row_Ns = np.array([N], np.int32)
+        return self._sample_rows(row_Ns, counts, data[np.newaxis, :])
 
-        messages_in = self._vert_probs.copy()
-        messages_out = np.tile(self._vert_probs[:, np.newaxis, :], (1, N, 1))
-        vert_samples = np.zeros([V, N], np.int8)
-        feat_samples = np.zeros([N, self._zero_row.shape[0]], np.int8)
-        range_N = np.arange(N, dtype=np.int32)
+    @profile
+    def sample_batch(self, N, counts, data):
+        """Draw N samples from the posterior distribution of each of B rows.
 
-        for op, v, v2, e in self._schedule:
-            if op == 0:  # OP_UP
-                # Propagate upward from observed to latent.
-                message = messages_in[v, :]
-                beg, end = self._ragged_index[v:v + 2]
-                for r in range(beg, end):
-                    # This uses a with-replacement approximation which is exact
-                    # for categorical data but approximate for multinomial.
-                    message *= feat_cond[r, :]**data[r]
-            elif op == 1:  # OP_IN
-                # Propagate latent state inward from children to v.
-                message = messages_in[v, :]
-                trans = edge_trans[e, :, :]
-                if v > v2:
-                    trans = trans.T
-                message *= np.dot(trans, messages_in[v2, :])
-                message /= message.sum()
-            else:  # OP_ROOT or OP_OUT
-                message = messages_out[v, :, :]
-                message[...] = messages_in[v, np.newaxis, :]
-                # Propagate latent state outward from parent to v.
-                if op == 3:  # OP_OUT
-                    trans = edge_trans[e, :, :]
-                    if v2 > v:
-                        trans = trans.T
-                    message *= trans[vert_samples[v2, :], :]
-                message /= message.sum(axis=1, keepdims=True)
-                vert_samples[v, :] = sample_from_probs2(message)
-                # Propagate downward from latent to observed.
-                beg, end = self._ragged_index[v:v + 2]
-                feat_block = feat_cond[beg:end, :].T
-                probs = feat_block[vert_samples[v, :], :]
-                samples_block = feat_samples[:, beg:end]
-                for _ in range(counts[v]):
-                    samples_block[range_N, sample_from_probs2(probs)] += 1
+        Args:
+          N: The number of samples to draw per row.
+          counts: A [V]-shaped numpy array of requested counts of multinomials
+            to sample.
+          data: A [B, _]-shaped ragged numpy array or scipy.sparse matrix of
+            conditioning data.
+
+        Returns:
+          A [B, N, _]-shaped numpy array of sampled multinomial data, where
+          samples [b, :, :] are conditioned on data[b, :].
+        """
+        logger.debug('sampling data in batch')
+        assert len(data.shape) == 2
+        assert data.shape[1] == self._ragged_index[-1]
+        assert data.dtype == np.int8
+        B, R = data.shape
+        row_Ns = np.full(B, N, np.int32)
+        return self._sample_rows(row_Ns, counts, data).reshape((B, N, R))
+
+    def _sample_rows(self, row_Ns, counts, data):
+        """Draw row_Ns[b] samples conditioned on each row data[b, :].
+
+        Returns:
+          An [S, R]-shaped numpy array of samples ordered by conditioning
+          row, where S = row_Ns.sum().
+        """
+        V, E, M = self._VEM
+        B, R = data.shape
+        assert row_Ns.shape == (B, )
+        assert counts.shape == (V, )
+        assert counts.dtype == np.int8
+        BN = int(row_Ns.sum())
+        if self._jit:
+            data = make_sparse_data(data)
+            sample_indptr = np.zeros(B + 1, np.int64)
+            np.cumsum(row_Ns, out=sample_indptr[1:])
+            feat_samples = np.zeros([BN, R], np.int8)
+            jit_sample(counts, sample_indptr, data.indptr, data.indices,
+                       data.data, self._col_verts, self._ragged_index,
+                       self._schedule, self._log_vert_probs,
+                       self._log_feat_cond, self._feat_cond, self._edge_trans,
+                       np.empty([V, M], np.float32),
+                       np.empty([V, M], np.float32), np.empty(M, np.float32),
+                       np.zeros(V, np.int32), feat_samples)
+            return feat_samples
+        ragged_index = self._ragged_index
+        feat_cond_padded = self._feat_cond_padded
+
+        # Samples are flattened into BN columns, ordered by row then sample.
+        messages_in, _ = self._observe(B, *find_sparse_cells(data))
+        self._propagate_in(messages_in)
+        messages_in = messages_in.transpose((0, 2, 1))
+        vert_samples = np.zeros([V, BN], np.int8)
+        feat_samples = np.zeros([BN, R], np.int8)
+        range_BN = np.arange(BN, dtype=np.int32)
+
+        for vertices, parents, trans, _, _ in self._levels:
+            n = len(vertices)
+            # Propagate latent state outward from parents to this level.
+            message = np.repeat(messages_in[vertices], row_Ns, axis=1)
+            if trans is not None:
+                message *= trans[np.arange(n)[:, np.newaxis],
+                                 vert_samples[parents, :], :]
+            message /= message.sum(axis=2, keepdims=True)
+            vert_samples[vertices, :] = sample_from_probs2(
+                message.reshape((n * BN, M))).reshape((n, BN))
+            # Propagate downward from latent to observed.
+            probs = feat_cond_padded[vertices[:, np.newaxis],
+                                     vert_samples[vertices, :], :]
+            probs = probs.reshape((n * BN, feat_cond_padded.shape[-1]))
+            rows = np.tile(range_BN, n)
+            begs = np.repeat(ragged_index[vertices], BN)
+            level_counts = np.repeat(counts[vertices], BN)
+            for i in range(counts[vertices].max()):
+                active = (level_counts > i)
+                cols = begs[active] + sample_from_probs2(probs[active])
+                feat_samples[rows[active], cols] += 1
 
         return feat_samples
 
@@ -149,14 +619,18 @@ class TreeCatServer(object):
     def logprob(self, data):
         """Compute non-normalized log probabilies of many rows of data.
 
-        To compute conditional probabilty, use the identity:
+        To compute conditional probabilty, use conditional_logprob(), which
+        is equivalent to but cheaper than:
 
           log P(data|cond_data) = server.logprob(data + cond_data)
                                 - server.logprob(cond_data)
 
+        If config['serving_dedup_rows'] is set, repeated rows of dense data
+        are evaluated only once.
+
         Args:
-          data: A [N, _]-shaped ragged nummpy array of multinomial count data,
-            where N is the number of rows.
+          data: A [N, _]-shaped ragged nummpy array or scipy.sparse matrix of
+            multinomial count data, where N is the number of rows.
 
         Returns:
           An [N]-shaped numpy array of log probabilities.
@@ -165,38 +639,143 @@ class TreeCatServer(object):
         assert len(data.shape) == 2
         assert data.shape[1] == self._ragged_index[-1]
         assert data.dtype == np.int8
+        if self._config.get('serving_dedup_rows', False) and \
+                not scipy.sparse.issparse(data):
+            data, _, inverse = dedup_rows(data)
+            return self._logprob(data)[inverse]
+        return self._logprob(data)
+
+    def _logprob(self, data):
         N = data.shape[0]
         V, E, M = self._VEM
-        edge_trans = self._edge_trans
-        feat_cond = self._feat_cond
-
-        messages = np.tile(self._vert_probs[:, :, np.newaxis], (1, 1, N))
+        if self._jit:
+            data = make_sparse_data(data)
+            logprob = np.zeros(N, np.float32)
+            jit_logprob(data.indptr, data.indices, data.data, self._col_verts,
+                        self._schedule, self._log_vert_probs,
+                        self._log_feat_cond, self._edge_trans,
+                        np.empty([V, M], np.float32),
+                        np.empty([V, M], np.float32), logprob)
+            return logprob
+
+        messages, logprob = self._observe(N, *find_sparse_cells(data))
         assert messages.shape == (V, M, N)
-        logprob = np.zeros(N, np.float32)
+        return self._propagate_logprob(messages, logprob)
 
-        for op, v, v2, e in self._schedule:
-            message = messages[v, :, :]
-            if op == 0:  # OP_UP
-                # Propagate upward from observed to latent.
-                beg, end = self._ragged_index[v:v + 2]
-                for r in range(beg, end):
-                    # This uses a with-replacement approximation which is exact
-                    # for categorical data but approximate for multinomial.
-                    power = data[np.newaxis, :, r]
-                    message *= feat_cond[r, :, np.newaxis]**power
-            elif op == 1:  # OP_IN
-                # Propagate latent state inward from children to v.
-                trans = edge_trans[e, :, :]
-                if v > v2:
-                    trans = trans.T
-                message *= np.dot(trans, messages[v2, :, :])
-                message_sum = message.sum(axis=0, keepdims=True)
-                message /= message_sum
-                logprob += np.log(message_sum[0, :])
-            elif op == 2:  # OP_ROOT
-                # Aggregate the total logprob.
-                logprob += np.log(message.sum(axis=0))
-                return logprob
+    @profile
+    def conditional_logprob(self, data, cond_data):
+        """Compute conditional log probabilities of many pairs of rows.
+
+        This computes log P(data|cond_data) without summing int8 data, and
+        shares evidence of cond_data between the joint and marginal terms.
+
+        Args:
+          data: An [N, _]-shaped ragged numpy array or scipy.sparse matrix of
+            multinomial count data.
+          cond_data: An [N, _]-shaped ragged numpy array or scipy.sparse
+            matrix of conditioning data.
+
+        Returns:
+          An [N]-shaped numpy array of conditional log probabilities.
+        """
+        logger.debug('computing conditional logprob')
+        logprob, cond_logprob = self._conditional_logprob(data, cond_data)
+        return logprob - cond_logprob
+
+    def _conditional_logprob(self, data, cond_data):
+        """Compute log P(data, cond_data) and log P(cond_data)."""
+        assert len(data.shape) == 2
+        assert data.shape == cond_data.shape
+        assert data.shape[1] == self._ragged_index[-1]
+        assert data.dtype == np.int8
+        assert cond_data.dtype == np.int8
+        N = data.shape[0]
+        V, E, M = self._VEM
+        if self._jit:
+            data = make_sparse_data(data)
+            cond_data = make_sparse_data(cond_data)
+            logprob = np.zeros(N, np.float32)
+            cond_logprob = np.zeros(N, np.float32)
+            jit_conditional_logprob(
+                data.indptr, data.indices, data.data, cond_data.indptr,
+                cond_data.indices, cond_data.data, self._col_verts,
+                self._schedule, self._parents, self._log_vert_probs,
+                self._log_feat_cond, self._edge_trans,
+                np.empty([V, M], np.float32), np.empty([V, M], np.float32),
+                np.empty([V, M], np.float32), np.empty(V, np.float64),
+                np.empty(V, np.float64), np.empty(V, np.bool_), logprob,
+                cond_logprob)
+            return logprob, cond_logprob
+
+        # Batch both terms as 2N rows: cond_data then data + cond_data.
+        cond_rows, cond_cols, cond_counts = find_sparse_cells(cond_data)
+        rows, cols, counts = find_sparse_cells(data)
+        rows = np.concatenate([cond_rows, cond_rows + N, rows + N])
+        cols = np.concatenate([cond_cols, cond_cols, cols])
+        counts = np.concatenate([cond_counts, cond_counts, counts])
+        messages, logprob = self._observe(2 * N, rows, cols, counts)
+        logprob = self._propagate_logprob(messages, logprob)
+        return logprob[N:], logprob[:N]
+
+    @profile
+    def marginals(self, data):
+        """Compute posterior marginals of each feature given rows of data.
+
+        This is exact and deterministic, and costs one O(V M^2) pass per row.
+
+        Args:
+          data: An [N, _]-shaped ragged numpy array or scipy.sparse matrix of
+            multinomial count data.
+
+        Returns:
+          An [N, _]-shaped numpy array of probabilities, where each ragged
+          block marginals[n, beg:end] is the posterior predictive
+          distribution of the categories of one feature given data[n, :].
+        """
+        logger.debug('computing marginals')
+        return self._marginals(data)[0]
+
+    def _marginals(self, data):
+        """Compute marginals and logprob of rows of data in a single pass."""
+        assert len(data.shape) == 2
+        assert data.shape[1] == self._ragged_index[-1]
+        assert data.dtype == np.int8
+        N, R = data.shape
+        V, E, M = self._VEM
+        if self._jit:
+            data = make_sparse_data(data)
+            marginals = np.zeros([N, R], np.float32)
+            logprob = np.zeros(N, np.float32)
+            jit_marginals(data.indptr, data.indices, data.data,
+                          self._col_verts, self._schedule,
+                          self._log_vert_probs, self._log_feat_cond,
+                          self._feat_cond, self._edge_trans,
+                          np.empty([V, M], np.float32),
+                          np.empty([V, M], np.float32),
+                          np.empty([V, M], np.float32),
+                          np.empty(M, np.float32), np.empty(M, np.float32),
+                          marginals, logprob)
+            return marginals, logprob
+
+        messages, logprob = self._observe(N, *find_sparse_cells(data))
+        logprob = self._propagate_logprob(messages, logprob)
+        root = self._levels[0][0][0]
+        beliefs = np.empty_like(messages)
+        beliefs[root] = messages[root] / messages[root].sum(axis=0)
+        for vertices, parents, trans, _, _ in self._levels[1:]:
+            # Divide the inward message of each vertex out of its parent's
+            # belief, then propagate latent state outward to the vertex.
+            up = beliefs[parents] / np.matmul(trans, messages[vertices])
+            outside = np.matmul(trans.transpose((0, 2, 1)), up)
+            belief = messages[vertices] * outside
+            beliefs[vertices] = belief / belief.sum(axis=1, keepdims=True)
+
+        # Propagate downward from latent to observed.
+        marginals = np.zeros([R, N], np.float32)
+        for m in range(M):
+            marginals += (self._feat_cond[:, m, np.newaxis] *
+                          beliefs[self._col_verts, m, :])
+        return marginals.T, logprob
 
     @profile
     def correlation(self):
@@ -215,9 +794,13 @@ class TreeCatServer(object):
         edge_probs = self._edge_probs
         vert_probs = self._vert_probs
         result = np.zeros([V, V], np.float32)
+        # Schedules for each root are built from the cached adjacency of the
+        # tree, but not cached, since that would cost O(V^2) memory.
+        offsets, neighbors, edges = self._tree.adjacency
         for root in range(V):
             messages = np.empty([V, M, M])
-            schedule = make_propagation_schedule(self._tree.tree_grid, root)
+            schedule = jit_make_propagation_schedule(offsets, neighbors,
+                                                     edges, root)
             for op, v, v2, e in schedule:
                 if op == 2:  # OP_ROOT
                     messages[v, :, :] = np.diagflat(vert_probs[v, :])
@@ -243,8 +826,12 @@ class EnsembleServer(object):
     def __init__(self, ensemble):
         logger.info('EnsembleServer of size %d', len(ensemble))
         assert ensemble
+        # Rows are deduplicated once for the whole ensemble, not per member.
+        config = ensemble[0]['config']
+        self._dedup_rows = config.get('serving_dedup_rows', False)
         self._ensemble = [
-            TreeCatServer(model['tree'], model['suffstats'], model['config'])
+            TreeCatServer(model['tree'], model['suffstats'],
+                          dict(model['config'], serving_dedup_rows=False))
             for model in ensemble
         ]
         self._zero_row = self._ensemble[0]._zero_row.copy()
@@ -265,11 +852,62 @@ class EnsembleServer(object):
         assert samples.shape[0] == N
         return samples
 
+    def sample_batch(self, N, counts, data):
+        # Each sample picks a member uniformly, as in sample(), and each
+        # member draws only the samples of each row that picked it.
+        assert len(data.shape) == 2
+        assert data.dtype == np.int8
+        B, R = data.shape
+        size = len(self._ensemble)
+        pvals = np.ones(size, dtype=np.float32) / size
+        sub_Ns = np.random.multinomial(N, pvals, size=B).astype(np.int32)
+        samples = np.concatenate([
+            server._sample_rows(sub_N, counts, data)
+            for server, sub_N in zip(self._ensemble, sub_Ns.T)
+        ])
+        rows = np.concatenate(
+            [np.repeat(np.arange(B), sub_N) for sub_N in sub_Ns.T])
+        # Group samples by row, in random order within each row.
+        order = np.lexsort((np.random.random(B * N), rows))
+        return samples[order].reshape((B, N, R))
+
+    def marginals(self, data):
+        # Members are weighted by their posterior given each row.
+        pairs = [server._marginals(data) for server in self._ensemble]
+        logprobs = np.stack([pair[1] for pair in pairs])
+        weights = np.exp(logprobs - logprobs.max(axis=0))
+        weights /= weights.sum(axis=0)
+        marginals = sum(weight[:, np.newaxis] * pair[0]
+                        for weight, pair in zip(weights, pairs))
+        assert marginals.shape == data.shape
+        return marginals
+
     def logprob(self, data):
+        N = data.shape[0]
+        inverse = None
+        if self._dedup_rows and not scipy.sparse.issparse(data):
+            data, _, inverse = dedup_rows(data)
         logprobs = np.stack(
             [server.logprob(data) for server in self._ensemble])
         logprobs = logsumexp(logprobs, axis=0)
         logprobs -= np.log(len(self._ensemble))
+        if inverse is not None:
+            logprobs = logprobs[inverse]
+        assert logprobs.shape == (N, )
+        return logprobs
+
+    def conditional_logprob(self, data, cond_data):
+        """Compute conditional log probabilities of many pairs of rows.
+
+        Each member contributes to both the joint and the marginal, so that
+        the result is the conditional probability under the mixture.
+        """
+        pairs = [
+            server._conditional_logprob(data, cond_data)
+            for server in self._ensemble
+        ]
+        logprobs = logsumexp(np.stack([pair[0] for pair in pairs]), axis=0)
+        logprobs -= logsumexp(np.stack([pair[1] for pair in pairs]), axis=0)
         assert logprobs.shape == (data.shape[0], )
         return logprobs
 
@@ -6,8 +6,11 @@ import itertools
 
 import numpy as np
 import pytest
+import scipy.sparse
 from goftests import multinomial_goodness_of_fit
+from scipy.misc import logsumexp
 
+from treecat.generate import generate_dataset
 from treecat.generate import generate_fake_ensemble
 from treecat.generate import generate_fake_model
 from treecat.serving import serve_ensemble
@@ -64,6 +67,54 @@ def test_ensemble_sample_shape(ensemble):
     validate_sample_shape(ragged_index, data, server)
 
 
+def validate_sample_batch_shape(ragged_index, data, server):
+    V = len(ragged_index) - 1
+    B, R = data.shape
+    for N in [0, 1, 5]:
+        counts = np.arange(V, dtype=np.int8) % 3
+        samples = server.sample_batch(N, counts, data)
+        assert samples.shape == (B, N, R)
+        assert samples.dtype == data.dtype
+        for v in range(V):
+            beg, end = ragged_index[v:v + 2]
+            assert np.all(samples[:, :, beg:end].sum(axis=2) == counts[v])
+
+
+@pytest.mark.parametrize('use_jit', [False, True])
+def test_server_sample_batch_shape(model, use_jit):
+    server = serve_model(model['tree'], model['suffstats'], TINY_CONFIG)
+    server._jit = use_jit
+    validate_sample_batch_shape(TINY_RAGGED_INDEX, TINY_DATA, server)
+    validate_sample_batch_shape(TINY_RAGGED_INDEX,
+                                scipy.sparse.csr_matrix(TINY_DATA), server)
+
+
+def test_ensemble_sample_batch_shape(ensemble):
+    server = serve_ensemble(ensemble)
+    validate_sample_batch_shape(TINY_RAGGED_INDEX, TINY_DATA, server)
+
+
+def test_ensemble_sample_batch_draws_only_shares(ensemble):
+    server = serve_ensemble(ensemble)
+    num_drawn = []
+    for member in server._ensemble:
+        sample_rows = member._sample_rows
+
+        def spy(row_Ns, counts, data, sample_rows=sample_rows):
+            samples = sample_rows(row_Ns, counts, data)
+            num_drawn.append(samples.shape[0])
+            return samples
+
+        member._sample_rows = spy
+    V = len(TINY_RAGGED_INDEX) - 1
+    B = TINY_DATA.shape[0]
+    N = 7
+    counts = np.ones(V, np.int8)
+    samples = server.sample_batch(N, counts, TINY_DATA)
+    assert samples.shape == (B, N, TINY_DATA.shape[1])
+    assert sum(num_drawn) == B * N
+
+
 def test_server_logprob_shape(model):
     data = TINY_DATA
     server = serve_model(model['tree'], model['suffstats'], TINY_CONFIG)
@@ -84,6 +135,203 @@ def test_ensemble_logprob_shape(ensemble):
     assert np.isfinite(logprobs).all()
 
 
+def test_server_logprob_sparse(model):
+    data = TINY_DATA
+    server = serve_model(model['tree'], model['suffstats'], TINY_CONFIG)
+    expected = server.logprob(data)
+    for sparse_data in [
+            scipy.sparse.csr_matrix(data),
+            scipy.sparse.coo_matrix(data),
+    ]:
+        actual = server.logprob(sparse_data)
+        assert actual.dtype == np.float32
+        np.testing.assert_allclose(actual, expected, rtol=1e-5)
+
+
+@pytest.mark.parametrize('C,M', [(2, 2), (5, 3)])
+def test_server_logprob_many_observations(C, M):
+    set_random_seed(0)
+    model = generate_fake_model(10, 1, C, M)
+    config = TINY_CONFIG.copy()
+    config['model_num_clusters'] = M
+    server = serve_model(model['tree'], model['suffstats'], config)
+    data = np.full([1, C], 120, np.int8)
+    logprob = server.logprob(data)
+    assert np.isfinite(logprob).all()
+
+    # Compare to a float64 computation in log space.
+    log_feat_cond = np.log(server._feat_cond.astype(np.float64))
+    expected = logsumexp(
+        np.log(server._vert_probs[0].astype(np.float64)) +
+        np.dot(data[0].astype(np.float64), log_feat_cond))
+    assert expected < -100
+    assert logprob[0] == pytest.approx(expected, rel=1e-5)
+
+
+def test_ensemble_logprob_old_config(ensemble):
+    # Models pickled before serving_dedup_rows existed lack that key.
+    ensemble = [model.copy() for model in ensemble]
+    for model in ensemble:
+        model['config'] = model['config'].copy()
+        model['config'].pop('serving_dedup_rows', None)
+    data = TINY_DATA
+    server = serve_model(ensemble[0]['tree'], ensemble[0]['suffstats'],
+                         ensemble[0]['config'])
+    assert server.logprob(data).shape == (data.shape[0], )
+    assert serve_ensemble(ensemble).logprob(data).shape == (data.shape[0], )
+
+
+@pytest.mark.parametrize('N,V,C,M', [
+    (10, 1, 2, 2),
+    (10, 5, 3, 4),
+    (20, 30, 2, 3),
+])
+def test_server_logprob_jit(N, V, C, M):
+    set_random_seed(0)
+    dataset = generate_dataset(N, V, C)
+    model = generate_fake_model(N, V, C, M, dataset)
+    config = TINY_CONFIG.copy()
+    config['model_num_clusters'] = M
+    server = serve_model(model['tree'], model['suffstats'], config)
+    data = dataset['data']
+    server._jit = False
+    expected = server.logprob(data)
+    server._jit = True
+    actual = server.logprob(data)
+    assert actual.dtype == np.float32
+    np.testing.assert_allclose(actual, expected, rtol=1e-4)
+    np.testing.assert_allclose(server.logprob(data[:1]), expected[:1],
+                               rtol=1e-4)
+
+
+def split_data(data, sparse):
+    set_random_seed(0)
+    if sparse:
+        # Condition on all but the first feature.
+        mask = np.ones(data.shape, np.bool_)
+        mask[:, :TINY_RAGGED_INDEX[1]] = False
+    else:
+        mask = (np.random.random(data.shape) < 0.5)
+    cond_data = (data * mask).astype(np.int8)
+    return (data - cond_data).astype(np.int8), cond_data
+
+
+@pytest.mark.parametrize('sparse', [False, True])
+@pytest.mark.parametrize('use_jit', [False, True])
+def test_server_conditional_logprob(model, use_jit, sparse):
+    server = serve_model(model['tree'], model['suffstats'], TINY_CONFIG)
+    server._jit = use_jit
+    data, cond_data = split_data(TINY_DATA, sparse)
+    expected = server.logprob(data + cond_data) - server.logprob(cond_data)
+    actual = server.conditional_logprob(data, cond_data)
+    assert actual.dtype == np.float32
+    assert actual.shape == expected.shape
+    np.testing.assert_allclose(actual, expected, rtol=1e-4, atol=1e-4)
+
+    # Sparse data should give the same result.
+    actual = server.conditional_logprob(
+        scipy.sparse.csr_matrix(data), scipy.sparse.csr_matrix(cond_data))
+    np.testing.assert_allclose(actual, expected, rtol=1e-4, atol=1e-4)
+
+
+def test_ensemble_conditional_logprob(ensemble):
+    server = serve_ensemble(ensemble)
+    data, cond_data = split_data(TINY_DATA, False)
+    expected = server.logprob(data + cond_data) - server.logprob(cond_data)
+    actual = server.conditional_logprob(data, cond_data)
+    assert actual.shape == expected.shape
+    np.testing.assert_allclose(actual, expected, rtol=1e-4, atol=1e-4)
+
+
+def test_server_sample_sparse(model):
+    server = serve_model(model['tree'], model['suffstats'], TINY_CONFIG)
+    V = len(TINY_RAGGED_INDEX) - 1
+    counts = np.ones(V, np.int8)
+    for row in TINY_DATA:
+        set_random_seed(0)
+        expected = server.sample(10, counts, row)
+        set_random_seed(0)
+        actual = server.sample(10, counts, scipy.sparse.csr_matrix(row))
+        assert np.all(actual == expected)
+
+
+def test_server_logprob_dedup_rows(model):
+    data = np.concatenate([TINY_DATA, TINY_DATA[::-1], TINY_DATA[:3]])
+    config = TINY_CONFIG.copy()
+    server = serve_model(model['tree'], model['suffstats'], config)
+    expected = server.logprob(data)
+    config['serving_dedup_rows'] = True
+    server = serve_model(model['tree'], model['suffstats'], config)
+    actual = server.logprob(data)
+    assert actual.shape == expected.shape
+    np.testing.assert_allclose(actual, expected, rtol=1e-5)
+
+
+def test_ensemble_logprob_dedup_rows(ensemble):
+    data = np.concatenate([TINY_DATA, TINY_DATA[::-1], TINY_DATA[:3]])
+    expected = serve_ensemble(ensemble).logprob(data)
+    ensemble = [model.copy() for model in ensemble]
+    for model in ensemble:
+        model['config'] = model['config'].copy()
+        model['config']['serving_dedup_rows'] = True
+    actual = serve_ensemble(ensemble).logprob(data)
+    assert actual.shape == expected.shape
+    np.testing.assert_allclose(actual, expected, rtol=1e-5)
+
+
+@pytest.mark.parametrize('N,V,C,M', [
+    (10, 1, 2, 2),
+    (10, 5, 3, 4),
+    (20, 30, 2, 3),
+])
+def test_server_logprob_root_invariant(N, V, C, M):
+    set_random_seed(0)
+    dataset = generate_dataset(N, V, C)
+    model = generate_fake_model(N, V, C, M, dataset)
+    config = TINY_CONFIG.copy()
+    config['model_num_clusters'] = M
+    server = serve_model(model['tree'], model['suffstats'], config)
+    data = dataset['data']
+    expected = server.logprob(data)
+    for root in range(V):
+        server._levels = server._make_levels(root)
+        actual = server.logprob(data)
+        np.testing.assert_allclose(actual, expected, rtol=1e-4)
+
+
+def validate_marginals(server, data):
+    marginals = server.marginals(data)
+    N, R = data.shape
+    assert marginals.shape == (N, R)
+    for v in range(len(TINY_RAGGED_INDEX) - 1):
+        beg, end = TINY_RAGGED_INDEX[v:v + 2]
+        np.testing.assert_allclose(
+            marginals[:, beg:end].sum(axis=1), 1, rtol=1e-5)
+
+    # Each marginal is the probability of one more observation.
+    for n in range(N):
+        observations = np.eye(R, dtype=np.int8)
+        cond_data = np.tile(data[n], (R, 1))
+        expected = np.exp(server.conditional_logprob(observations, cond_data))
+        np.testing.assert_allclose(marginals[n], expected, rtol=1e-4)
+
+
+@pytest.mark.parametrize('use_jit', [False, True])
+def test_server_marginals(model, use_jit):
+    server = serve_model(model['tree'], model['suffstats'], TINY_CONFIG)
+    server._jit = use_jit
+    validate_marginals(server, TINY_DATA)
+    marginals = server.marginals(TINY_DATA)
+    assert marginals.dtype == np.float32
+    sparse_marginals = server.marginals(scipy.sparse.csr_matrix(TINY_DATA))
+    np.testing.assert_allclose(sparse_marginals, marginals, rtol=1e-5)
+
+
+def test_ensemble_marginals(ensemble):
+    server = serve_ensemble(ensemble)
+    validate_marginals(server, TINY_DATA)
+
+
 def one_hot(c, C):
     value = np.zeros(C, dtype=np.int8)
     value[c] = 1
@@ -157,6 +405,18 @@ def test_server_conditional_gof(N, V, C, M):
     validate_gof(N, V, C, M, server, conditional=True)
 
 
+@pytest.mark.parametrize('use_jit', [False, True])
+@pytest.mark.parametrize('N,V,C,M', NVCM_EXAMPLES_FOR_GOF[:5])
+def test_server_sample_jit_gof(N, V, C, M, use_jit):
+    set_random_seed(0)
+    model = generate_fake_model(N, V, C, M)
+    config = TINY_CONFIG.copy()
+    config['model_num_clusters'] = M
+    server = serve_model(model['tree'], model['suffstats'], config)
+    server._jit = use_jit
+    validate_gof(N, V, C, M, server, conditional=True)
+
+
 @pytest.mark.xfail
 @pytest.mark.parametrize('N,V,C,M', NVCM_EXAMPLES_FOR_GOF)
 def test_ensemble_unconditional_gof(N, V, C, M):
@@ -173,6 +433,42 @@ def test_ensemble_conditional_gof(N, V, C, M):
     validate_gof(N, V, C, M, server, conditional=True)
 
 
+@pytest.mark.parametrize('use_jit', [False, True])
+@pytest.mark.parametrize('N,V,C,M', [
+    (10, 2, 2, 2),
+    (10, 3, 2, 3),
+])
+def test_server_sample_batch_gof(N, V, C, M, use_jit):
+    set_random_seed(0)
+    model = generate_fake_model(N, V, C, M)
+    config = TINY_CONFIG.copy()
+    config['model_num_clusters'] = M
+    server = serve_model(model['tree'], model['suffstats'], config)
+    server._jit = use_jit
+
+    # Condition each row on a different partial observation.
+    B = 3
+    ones = np.ones(V, dtype=np.int8)
+    cond_data = np.zeros([B, C * V], np.int8)
+    for b in range(B):
+        cond_data[b, :C] = server.sample(1, ones)[0, :C]
+    num_samples = 1000 * C**V
+    samples = server.sample_batch(num_samples, ones, cond_data)
+    for b in range(B):
+        counts = {}
+        for sample in samples[b]:
+            key = tuple(sample)
+            counts[key] = counts.get(key, 0) + 1
+        keys = sorted(counts.keys())
+        data = np.array(keys, dtype=np.int8)
+        probs = np.exp(server.conditional_logprob(
+            data, np.tile(cond_data[b], (len(keys), 1))))
+        counts = np.array([counts[k] for k in keys], dtype=np.int32)
+        gof = multinomial_goodness_of_fit(probs / probs.sum(), counts,
+                                          num_samples, plot=True)
+        assert 1e-2 < gof
+
+
 def validate_gof(N, V, C, M, server, conditional):
     # Generate samples.
     expected = C**V
@@ -3,14 +3,15 @@ from __future__ import division
 from __future__ import print_function
 
 import logging
-from collections import deque
+import math
 
 import numpy as np
 
+from six.moves import xrange
 from treecat.util import COUNTERS
 from treecat.util import HISTOGRAMS
+from treecat.util import jit
 from treecat.util import profile
-from treecat.util import sample_from_probs
 
 logger = logging.getLogger(__name__)
 
@@ -22,10 +23,25 @@ class TreeStructure(object):
         logger.debug('TreeStructure with %d vertices', num_vertices)
         self._num_vertices = num_vertices
         self._num_edges = num_vertices - 1
+        self._tree_grid = None
         self.set_edges([(v, v + 1) for v in range(num_vertices - 1)])
         self._complete_grid = None  # Lazily constructed.
         self._vertices = np.arange(num_vertices, dtype=np.int32)
 
+    def __getstate__(self):
+        # Cached data is omitted from pickles.
+        state = self.__dict__.copy()
+        state['_complete_grid'] = None
+        state['_adjacency'] = None
+        state['_schedules'] = {}
+        return state
+
+    def __setstate__(self, state):
+        # This also supports pickles made before caches were added.
+        self.__dict__.update(state)
+        self.__dict__.setdefault('_adjacency', None)
+        self.__dict__.setdefault('_schedules', {})
+
     def __eq__(self, other):
         return (self._num_vertices == other._num_vertices and
                 (self._tree_grid == other._tree_grid).all())
@@ -33,11 +49,17 @@ class TreeStructure(object):
     def set_edges(self, edges):
         """Sets the edges of this tree.
 
+        Cached data derived from the edges is kept if the edges are unchanged.
+
         Args:
           edges: A list of (vertex, vertex) pairs.
         """
         assert len(edges) == self._num_edges
-        self._tree_grid = make_tree(edges)
+        tree_grid = make_tree(edges)
+        if not np.array_equal(tree_grid, self._tree_grid):
+            self._tree_grid = tree_grid
+            self._adjacency = None  # Lazily constructed.
+            self._schedules = {}  # Lazily constructed for each root.
 
     @property
     def num_vertices(self):
@@ -54,20 +76,55 @@ class TreeStructure(object):
 
     @property
     def complete_grid(self):
-        """Array of (edge,vertex,vertex) triples defining a complete graph."""
+        """Array of (edge,vertex,vertex) triples defining a complete graph.
+
+        This costs O(K) memory. Most callers can instead pass grid=None to
+        sample_tree() to use an implicit complete graph.
+        """
         if self._complete_grid is None:
             self._complete_grid = make_complete_graph(self._num_vertices)
         return self._complete_grid
 
+    @property
+    def adjacency(self):
+        """Sorted adjacency lists of the tree, see make_tree_adjacency()."""
+        if self._adjacency is None:
+            self._adjacency = make_tree_adjacency(self._tree_grid)
+        return self._adjacency
+
     @property
     def vertices(self):
         return self._vertices
 
+    def propagation_schedule(self, root=None, levels=False):
+        """Gets a cached schedule as returned by make_propagation_schedule().
+
+        Args:
+          root: Optional root vertex, defaults to a center of the tree.
+          levels: Whether to group the schedule by depth.
+        """
+        key = (root, levels)
+        if key not in self._schedules:
+            offsets, neighbors, edges = self.adjacency
+            if root is None:
+                center = jit_find_center_of_tree(offsets, neighbors)
+                self._schedules[key] = self.propagation_schedule(
+                    center, levels)
+            elif levels:
+                self._schedules[key] = jit_make_level_schedule(
+                    offsets, neighbors, edges, root)
+            else:
+                self._schedules[key] = jit_make_propagation_schedule(
+                    offsets, neighbors, edges, root)
+        return self._schedules[key]
+
     def gc(self):
         """Garbage collect temporary cached data structures."""
         self._complete_grid = None
+        self._schedules = {}
 
 
+@jit(nopython=True, cache=True)
 def find_complete_edge(v1, v2):
     """Find the edge index k of an unsorted pair of vertices (v1, v2)."""
     if v2 < v1:
@@ -75,6 +132,21 @@ def find_complete_edge(v1, v2):
     return v1 + v2 * (v2 - 1) // 2
 
 
+@jit(nopython=True, cache=True)
+def find_complete_vertices(k):
+    """Find the sorted pair of vertices (v1, v2) of a complete edge k.
+
+    This is the inverse of find_complete_edge().
+    """
+    v2 = int((1.0 + math.sqrt(1.0 + 8.0 * k)) / 2.0)
+    # Correct for rounding error.
+    while v2 * (v2 - 1) // 2 > k:
+        v2 -= 1
+    while (v2 + 1) * v2 // 2 <= k:
+        v2 += 1
+    return k - v2 * (v2 - 1) // 2, v2
+
+
 def make_complete_graph(num_vertices):
     """Constructs a complete graph.
 
@@ -91,11 +163,43 @@ def make_complete_graph(num_vertices):
     V = num_vertices
     K = V * (V - 1) // 2
     grid = np.zeros([3, K], np.int32)
-    k = 0
-    for v2 in range(V):
-        for v1 in range(v2):
-            grid[:, k] = [k, v1, v2]
-            k += 1
+    grid[0, :] = np.arange(K)
+    grid[2, :], grid[1, :] = np.tril_indices(V, -1)
+    return grid
+
+
+def make_candidate_graph(num_vertices, neighbors, edges=()):
+    """Constructs a sparse graph of candidate edges.
+
+    Edges are ordered by the pairing function of make_complete_graph(), so
+    that a candidate graph including all pairs equals the complete graph.
+
+    Args:
+      num_vertices: Number of vertices.
+      neighbors: A [V, _]-shaped array of candidate neighbors of each vertex.
+      edges: An optional list of additional (vertex, vertex) pairs to
+        include, e.g. the edges of the current tree.
+
+    Returns:
+      grid: a 3 x K grid of (edge, vertex, vertex) triples.
+    """
+    V = num_vertices
+    neighbors = np.asarray(neighbors, np.int64).reshape((V, -1))
+    v1 = np.concatenate([
+        np.repeat(np.arange(V), neighbors.shape[1]),
+        np.array([e[0] for e in edges], np.int64),
+    ])
+    v2 = np.concatenate([
+        neighbors.reshape(-1),
+        np.array([e[1] for e in edges], np.int64),
+    ])
+    v1, v2 = np.minimum(v1, v2), np.maximum(v1, v2)
+    v1, v2 = v1[v1 != v2], v2[v1 != v2]
+    keys, pos = np.unique(v1 + v2 * (v2 - 1) // 2, return_index=True)
+    grid = np.zeros([3, len(pos)], np.int32)
+    grid[0, :] = np.arange(len(pos))
+    grid[1, :] = v1[pos]
+    grid[2, :] = v2[pos]
     return grid
 
 
@@ -120,6 +224,58 @@ def make_tree(edges):
     return grid
 
 
+def make_tree_adjacency(grid):
+    """Constructs sorted adjacency lists of a tree graph in CSR format.
+
+    Args:
+      grid: A tree graph as returned by make_tree().
+
+    Returns: A tuple with elements:
+      offsets: A [V+1]-shaped array, where the neighbors of vertex v are at
+        positions offsets[v]:offsets[v+1] of the following arrays.
+      neighbors: A [2E]-shaped array of neighbor vertices, sorted for each
+        vertex.
+      edges: A [2E]-shaped array of edge ids of each (vertex, neighbor) pair.
+    """
+    E = grid.shape[1]
+    V = 1 + E
+    v1 = np.concatenate([grid[1, :], grid[2, :]])
+    v2 = np.concatenate([grid[2, :], grid[1, :]])
+    edges = np.concatenate([grid[0, :], grid[0, :]])
+    order = np.lexsort((v2, v1))
+    offsets = np.zeros(V + 1, np.int32)
+    offsets[1:] = np.cumsum(np.bincount(v1, minlength=V))
+    return (offsets, v2[order].astype(np.int32),
+            edges[order].astype(np.int32))
+
+
+@jit(nopython=True, cache=True)
+def jit_find_center_of_tree(offsets, neighbors):
+    """Jit-compiled implementation of find_center_of_tree()."""
+    # Repeatedly remove leaves, in the order of a queue.
+    V = len(offsets) - 1
+    degrees = offsets[1:] - offsets[:-1]
+    removed = np.zeros(V, np.bool_)
+    queue = np.zeros(V, np.int32)
+    end = 0
+    for v in xrange(V - 1, -1, -1):
+        if degrees[v] <= 1:
+            queue[end] = v
+            end += 1
+    v = 0
+    for pos in xrange(V):
+        v = queue[pos]
+        removed[v] = True
+        for i in xrange(offsets[v + 1] - 1, offsets[v] - 1, -1):
+            v2 = neighbors[i]
+            if not removed[v2]:
+                degrees[v2] -= 1
+                if degrees[v2] == 1:
+                    queue[end] = v2
+                    end += 1
+    return v
+
+
 def find_center_of_tree(grid):
     """Finds a maximally central vertex in a tree graph.
 
@@ -129,23 +285,8 @@ def find_center_of_tree(grid):
     Returns:
         Vertex id of a maximally central vertex.
     """
-    E = grid.shape[1]
-    V = 1 + E
-    neighbors = [set() for _ in range(V)]
-    for e, v1, v2 in grid.T:
-        neighbors[v1].add(v2)
-        neighbors[v2].add(v1)
-    queue = deque()
-    for v in reversed(range(V)):
-        if len(neighbors[v]) <= 1:
-            queue.append(v)
-    while queue:
-        v = queue.popleft()
-        for v2 in sorted(neighbors[v], reverse=True):
-            neighbors[v2].remove(v)
-            if len(neighbors[v2]) == 1:
-                queue.append(v2)
-    return v
+    offsets, neighbors, edges = make_tree_adjacency(grid)
+    return jit_find_center_of_tree(offsets, neighbors)
 
 
 # Op codes.
@@ -155,133 +296,272 @@ OP_ROOT = 2
 OP_OUT = 3
 
 
-def make_propagation_schedule(grid, root=None):
-    """Makes an efficient schedule for message passing on a tree.
+@jit(nopython=True, cache=True)
+def jit_traverse_tree(offsets, neighbors, edges, root):
+    """Traverses a tree breadth first from a root vertex.
 
     Args:
-      grid: A tree graph as returned by make_tree().
-      root: Optional root vertex, defaults to find_center_of_tree(grid).
+      offsets, neighbors, edges: Adjacency as returned by
+        make_tree_adjacency().
+      root: The root vertex.
 
     Returns:
-      A numpy array with rows (opcode, vertex, relative, edge), where
-      opcode: One of 0 = up, 1 = in, 2 = root, 3 = out.
-      vertex: The vertex id of the vertex being operated on.
-      relative: The vertex ide of a relative, either a parent or child.
-      edge: The edge id of the (vertex, relative) pair.
+      A tuple (order, parents, parent_edges, depths) of [V]-shaped int32
+      arrays, where order lists vertices breadth first, and the parent,
+      parent edge and depth arrays are indexed by vertex. The root has
+      parent -1, parent edge -1 and depth 0.
     """
-    if root is None:
-        root = find_center_of_tree(grid)
-    E = grid.shape[1]
-    V = 1 + E
-    neighbors = [set() for _ in range(V)]
-    edge_dict = {}
-    for e, v1, v2 in grid.T:
-        neighbors[v1].add(v2)
-        neighbors[v2].add(v1)
-        edge_dict[v1, v2] = e
-        edge_dict[v2, v1] = e
-
-    # Construct a nested schedule.
-    nested_schedule = []
-    queue = deque()
-    queue.append((root, None))
-    while queue:
-        v, parent = queue.popleft()
-        nested_schedule.append((v, parent, []))
-        for v2 in sorted(neighbors[v]):
-            if v2 != parent:
-                queue.append((v2, v))
-    for v, parent, children in nested_schedule:
-        for v2 in sorted(neighbors[v]):
-            if v2 != parent:
-                children.append(v2)
+    V = len(offsets) - 1
+    order = np.zeros(V, np.int32)
+    parents = np.zeros(V, np.int32)
+    parent_edges = np.zeros(V, np.int32)
+    depths = np.zeros(V, np.int32)
+    visited = np.zeros(V, np.bool_)
+    order[0] = root
+    parents[root] = -1
+    parent_edges[root] = -1
+    visited[root] = True
+    end = 1
+    for pos in xrange(V):
+        v = order[pos]
+        for i in xrange(offsets[v], offsets[v + 1]):
+            v2 = neighbors[i]
+            if not visited[v2]:
+                visited[v2] = True
+                parents[v2] = v
+                parent_edges[v2] = edges[i]
+                depths[v2] = depths[v] + 1
+                order[end] = v2
+                end += 1
+    return order, parents, parent_edges, depths
+
+
+@jit(nopython=True, cache=True)
+def jit_make_propagation_schedule(offsets, neighbors, edges, root):
+    """Jit-compiled implementation of make_propagation_schedule()."""
+    V = len(offsets) - 1
+    E = V - 1
+    order, parents, parent_edges, _ = jit_traverse_tree(
+        offsets, neighbors, edges, root)
 
     # Construct a flattened schedule.
-    schedule = np.zeros([V + E + V, 4], np.int16)
+    schedule = np.zeros((V + E + V, 4), np.int32)
     pos = 0
-    for v, parent, children in reversed(nested_schedule):
-        schedule[pos, :] = [OP_UP, v, 0, 0]
+    for j in xrange(V - 1, -1, -1):
+        v = order[j]
+        schedule[pos, 0] = OP_UP
+        schedule[pos, 1] = v
         pos += 1
-        for child in children:
-            schedule[pos, :] = [OP_IN, v, child, edge_dict[v, child]]
-            pos += 1
-    schedule[pos, :] = [OP_ROOT, v, 0, 0]
+        for i in xrange(offsets[v], offsets[v + 1]):
+            v2 = neighbors[i]
+            if v2 != parents[v]:
+                schedule[pos, 0] = OP_IN
+                schedule[pos, 1] = v
+                schedule[pos, 2] = v2
+                schedule[pos, 3] = edges[i]
+                pos += 1
+    schedule[pos, 0] = OP_ROOT
+    schedule[pos, 1] = root
     pos += 1
-    for v, parent, children in nested_schedule[1:]:
-        schedule[pos, :] = [OP_OUT, v, parent, edge_dict[v, parent]]
+    for j in xrange(1, V):
+        v = order[j]
+        schedule[pos, 0] = OP_OUT
+        schedule[pos, 1] = v
+        schedule[pos, 2] = parents[v]
+        schedule[pos, 3] = parent_edges[v]
         pos += 1
     assert pos == V + E + 1 + E
-
     return schedule
 
 
-class MutableTree(object):
-    """MCMC tree for random spanning trees."""
+@jit(nopython=True, cache=True)
+def jit_make_level_schedule(offsets, neighbors, edges, root):
+    """Jit-compiled implementation of level-grouped schedules."""
+    V = len(offsets) - 1
+    order, parents, parent_edges, depths = jit_traverse_tree(
+        offsets, neighbors, edges, root)
+    schedule = np.zeros((V, 3), np.int32)
+    schedule[:, 0] = order
+    schedule[:, 1] = parents[order]
+    schedule[:, 2] = parent_edges[order]
 
-    __slots__ = ['VEK', 'grid', 'e2k', 'k2e', 'neighbors', 'components']
+    # Breadth first order is already sorted by depth.
+    num_levels = depths[order[V - 1]] + 1
+    level_offsets = np.zeros(num_levels + 1, np.int32)
+    for pos in xrange(V):
+        level_offsets[depths[order[pos]] + 1] = pos + 1
+    return schedule, level_offsets
 
-    def __init__(self, grid, edges):
-        """Build a mutable spanning tree.
 
-        Args:
-          grid: A 3 x K array as returned by make_complete_graph().
-          edges: A list of E edges in the form of (vertex,vertex) pairs.
-        """
-        E = len(edges)
-        V = 1 + E
-        K = V * (V - 1) // 2
-        assert grid.shape == (3, K)
-        self.VEK = (V, E, K)
-        self.grid = grid
-        self.k2e = {}
-        self.e2k = {}
-        self.neighbors = [set() for _ in range(V)]
-        for e, (v1, v2) in enumerate(edges):
-            k = find_complete_edge(v1, v2)
-            self.k2e[k] = e
-            self.e2k[e] = k
-            self.neighbors[v1].add(v2)
-            self.neighbors[v2].add(v1)
-        self.components = np.zeros([V], dtype=np.bool_)
-        assert len(self.e2k) == self.VEK[1]
-        assert len(self.k2e) == self.VEK[1]
-
-    @profile
-    def remove_edge(self, e):
-        """Remove edge at position e from tree and update data structures."""
-        assert len(self.e2k) == self.VEK[1]
-        assert len(self.k2e) == self.VEK[1]
-        neighbors = self.neighbors
-        components = self.components
-        k = self.e2k.pop(e)
-        self.k2e.pop(k)
-        v1, v2 = self.grid[1:, k]
-        neighbors[v1].remove(v2)
-        neighbors[v2].remove(v1)
-        stack = [v1]
-        while stack:
-            v1 = stack.pop()
-            components[v1] = True
-            for v2 in neighbors[v1]:
-                if not components[v2]:
-                    stack.append(v2)
-        assert len(self.e2k) == self.VEK[1] - 1
-        assert len(self.k2e) == self.VEK[1] - 1
-        return k
-
-    def add_edge(self, e, k):
-        """Add edge k at location e and update data structures."""
-        assert len(self.e2k) == self.VEK[1] - 1
-        assert len(self.k2e) == self.VEK[1] - 1
-        v1, v2 = self.grid[1:, k]
-        assert self.components[v1] != self.components[v2]
-        self.k2e[k] = e
-        self.e2k[e] = k
-        self.neighbors[v1].add(v2)
-        self.neighbors[v2].add(v1)
-        self.components[:] = False
-        assert len(self.e2k) == self.VEK[1]
-        assert len(self.k2e) == self.VEK[1]
+def make_propagation_schedule(grid, root=None, levels=False):
+    """Makes an efficient schedule for message passing on a tree.
+
+    Args:
+      grid: A tree graph as returned by make_tree().
+      root: Optional root vertex, defaults to find_center_of_tree(grid).
+      levels: Whether to group the schedule by depth, so that each level of
+        the tree can be processed as a single batched operation.
+
+    Returns:
+      If levels is False, a numpy array with rows
+      (opcode, vertex, relative, edge), where
+      opcode: One of 0 = up, 1 = in, 2 = root, 3 = out.
+      vertex: The vertex id of the vertex being operated on.
+      relative: The vertex ide of a relative, either a parent or child.
+      edge: The edge id of the (vertex, relative) pair.
+
+      If levels is True, a pair (schedule, level_offsets), where schedule
+      is a [V, 3]-shaped numpy array with rows (vertex, parent, edge) in
+      breadth first order, and level_offsets is a [D + 1]-shaped numpy
+      array such that level d of a depth-D tree is
+      schedule[level_offsets[d]:level_offsets[d + 1]]. Level 0 holds only
+      the root, whose parent and edge are -1. Within each level, the
+      children of each parent are contiguous.
+    """
+    offsets, neighbors, edges = make_tree_adjacency(grid)
+    if root is None:
+        root = jit_find_center_of_tree(offsets, neighbors)
+    if levels:
+        return jit_make_level_schedule(offsets, neighbors, edges, root)
+    return jit_make_propagation_schedule(offsets, neighbors, edges, root)
+
+
+@jit(nopython=True, cache=True)
+def jit_sample_tree(grid, edge_logits, edges, steps, stats, log2_choices):
+    """Jit-compiled implementation of sample_tree().
+
+    Args:
+      grid: A 3 x K array as returned by make_complete_graph() or
+        make_candidate_graph(), or an empty 3 x 0 array to denote an
+        implicit complete graph.
+      edge_logits: A length-K array of nonnormalized log probabilities.
+      edges: An [E, 2]-shaped array of (vertex, vertex) pairs, which is
+        updated in place.
+      steps: Number of MCMC steps to take.
+      stats: A length-3 array of (propose, accept, infeasible) counts, which
+        is updated in place.
+      log2_choices: A histogram of the bit lengths of the number of feasible
+        choices, which is updated in place.
+    """
+    E = edges.shape[0]
+    V = E + 1
+    K = edge_logits.shape[0]
+    complete = (K == V * (V - 1) // 2)
+    keys = np.zeros(0, np.int64)
+    if not complete:
+        # Sparse candidate edges are looked up by their complete edge index.
+        keys = np.zeros(K, np.int64)
+        for k in xrange(K):
+            keys[k] = find_complete_edge(np.int64(grid[1, k]),
+                                         np.int64(grid[2, k]))
+    degrees = np.zeros(V, np.int32)
+    offsets = np.zeros(V + 1, np.int32)
+    neighbors = np.zeros(2 * E, np.int32)
+    components = np.zeros(V, np.bool_)
+    stack = np.zeros(V, np.int32)
+    valid_edges = np.zeros(K, np.int32)
+    valid_probs = np.zeros(K, np.float64)
+
+    for step in xrange(steps):
+        for _ in xrange(E):
+            e = np.random.randint(0, E)  # Sequential scanning doesn't work.
+            k1 = find_complete_edge(
+                np.int64(edges[e, 0]), np.int64(edges[e, 1]))
+            if not complete:
+                k1 = np.searchsorted(keys, k1)
+
+            # Build CSR adjacency lists of all edges except e.
+            degrees[:] = 0
+            for e2 in xrange(E):
+                if e2 != e:
+                    degrees[edges[e2, 0]] += 1
+                    degrees[edges[e2, 1]] += 1
+            offsets[0] = 0
+            for v in xrange(V):
+                offsets[v + 1] = offsets[v] + degrees[v]
+            degrees[:] = 0
+            for e2 in xrange(E):
+                if e2 != e:
+                    v1, v2 = edges[e2, 0], edges[e2, 1]
+                    neighbors[offsets[v1] + degrees[v1]] = v2
+                    neighbors[offsets[v2] + degrees[v2]] = v1
+                    degrees[v1] += 1
+                    degrees[v2] += 1
+
+            # Label the component containing one endpoint of edge e.
+            components[:] = False
+            components[edges[e, 0]] = True
+            stack[0] = edges[e, 0]
+            size = 1
+            while size:
+                size -= 1
+                v1 = stack[size]
+                for i in xrange(offsets[v1], offsets[v1 + 1]):
+                    v2 = neighbors[i]
+                    if not components[v2]:
+                        components[v2] = True
+                        stack[size] = v2
+                        size += 1
+
+            # Collect all edges bridging the two components A and B. In a
+            # complete graph this costs O(|A| |B|) rather than O(K), since
+            # most removals split off a small component.
+            num_valid = 0
+            max_logit = -np.inf
+            if complete:
+                num_a = 0
+                num_b = V
+                for v in xrange(V):
+                    if components[v]:
+                        stack[num_a] = v
+                        num_a += 1
+                    else:
+                        num_b -= 1
+                        stack[num_b] = v
+                for i in xrange(num_a):
+                    for j in xrange(num_a, V):
+                        k = find_complete_edge(stack[i], stack[j])
+                        valid_edges[num_valid] = k
+                        valid_probs[num_valid] = edge_logits[k]
+                        if edge_logits[k] > max_logit:
+                            max_logit = edge_logits[k]
+                        num_valid += 1
+            else:
+                for k in xrange(K):
+                    if components[grid[1, k]] != components[grid[2, k]]:
+                        valid_edges[num_valid] = k
+                        valid_probs[num_valid] = edge_logits[k]
+                        if edge_logits[k] > max_logit:
+                            max_logit = edge_logits[k]
+                        num_valid += 1
+            total_prob = 0.0
+            for i in xrange(num_valid):
+                valid_probs[i] = np.exp(valid_probs[i] - max_logit)
+                total_prob += valid_probs[i]
+
+            # Sample a replacement edge.
+            k2 = k1
+            if total_prob > 0:
+                u = np.random.random() * total_prob
+                for i in xrange(num_valid):
+                    u -= valid_probs[i]
+                    if u < 0:
+                        break
+                k2 = valid_edges[i]
+            else:
+                stats[2] += 1
+            if complete:
+                edges[e, 0], edges[e, 1] = find_complete_vertices(k2)
+            else:
+                edges[e, 0] = grid[1, k2]
+                edges[e, 1] = grid[2, k2]
+
+            stats[0] += 1
+            stats[1] += (k1 != k2)
+            bit_length = 0
+            while num_valid >> bit_length:
+                bit_length += 1
+            log2_choices[bit_length] += 1
 
 
 @profile
@@ -299,7 +579,10 @@ def sample_tree(grid, edge_logits, edges, steps=1):
     and sample from them in proportion to exp(edge_logits).
 
     Args:
-      grid: A 3 x K array as returned by make_complete_graph().
+      grid: A 3 x K array as returned by make_complete_graph(), or a sparse
+        graph of candidate edges as returned by make_candidate_graph(), in
+        which case the initial edges must be candidates, or None to denote
+        an implicit complete graph.
       edge_logits: A length-K array of nonnormalized log probabilities.
       edges: A list of E initial edges in the form of (vertex,vertex) pairs.
       steps: Number of MCMC steps to take.
@@ -311,32 +594,28 @@ def sample_tree(grid, edge_logits, edges, steps=1):
     COUNTERS.sample_tree_calls += 1
     if len(edges) <= 1:
         return edges
-    tree = MutableTree(grid, edges)
-    V, E, K = tree.VEK
-
-    for step in range(steps):
-        for e in range(E):
-            e = np.random.randint(E)  # Sequential scanning doesn't work.
-            k1 = tree.remove_edge(e)
-            valid_edges = np.where(
-                tree.components[grid[1, :]] != tree.components[grid[2, :]])[0]
-            valid_probs = edge_logits[valid_edges]
-            valid_probs -= valid_probs.max()
-            np.exp(valid_probs, out=valid_probs)
-            total_prob = valid_probs.sum()
-            if total_prob > 0:
-                valid_probs *= 0.9999995 / total_prob  # Avoid np.binom errors.
-                k2 = valid_edges[sample_from_probs(valid_probs)]
-            else:
-                k2 = k1
-                COUNTERS.sample_tree_infeasible += 1
-            tree.add_edge(e, k2)
-
-            COUNTERS.sample_tree_propose += 1
-            COUNTERS.sample_tree_accept += (k1 != k2)
-            HISTOGRAMS.sample_tree_log2_choices.update(
-                [len(valid_edges).bit_length()])
-
-    edges = sorted((grid[1, k], grid[2, k]) for k in tree.e2k.values())
+    E = len(edges)
+    V = 1 + E
+    if grid is None:
+        K = V * (V - 1) // 2
+        grid = np.zeros([3, 0], np.int32)
+    else:
+        K = grid.shape[1]
+        assert grid.shape == (3, K)
+    assert edge_logits.shape == (K, )
+    edges = np.array(edges, dtype=np.int32).reshape((E, 2))
+    stats = np.zeros(3, np.int64)
+    log2_choices = np.zeros(64, np.int64)
+    jit_sample_tree(grid, edge_logits, edges, steps, stats, log2_choices)
+
+    COUNTERS.sample_tree_propose += int(stats[0])
+    COUNTERS.sample_tree_accept += int(stats[1])
+    COUNTERS.sample_tree_infeasible += int(stats[2])
+    for bit_length in np.nonzero(log2_choices)[0]:
+        HISTOGRAMS.sample_tree_log2_choices[int(bit_length)] += int(
+            log2_choices[bit_length])
+
+    edges = sorted((int(v1), int(v2)) if v1 < v2 else (int(v2), int(v1))
+                   for v1, v2 in edges)
     assert len(edges) == E
     return edges
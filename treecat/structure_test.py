@@ -2,20 +2,27 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import itertools
 from collections import defaultdict
 
 import numpy as np
 import pytest
 from goftests import multinomial_goodness_of_fit
 
+from six.moves import cPickle as pickle
 from treecat.structure import OP_IN
 from treecat.structure import OP_OUT
 from treecat.structure import OP_ROOT
 from treecat.structure import OP_UP
+from treecat.structure import TreeStructure
 from treecat.structure import find_center_of_tree
+from treecat.structure import find_complete_edge
+from treecat.structure import find_complete_vertices
+from treecat.structure import make_candidate_graph
 from treecat.structure import make_complete_graph
 from treecat.structure import make_propagation_schedule
 from treecat.structure import make_tree
+from treecat.structure import make_tree_adjacency
 from treecat.structure import sample_tree
 from treecat.testutil import numpy_seterr
 from treecat.util import set_random_seed
@@ -55,6 +62,34 @@ def test_make_complete_graph(num_vertices, expected_grid):
     np.testing.assert_array_equal(grid, expected_grid)
 
 
+@pytest.mark.parametrize('num_vertices', [2, 3, 10, 100, 70000])
+def test_find_complete_vertices(num_vertices):
+    V = num_vertices
+    for v2 in sorted(set([1, V // 2, V - 2, V - 1]) - set([0])):
+        for v1 in sorted(set([0, v2 // 2, v2 - 1])):
+            k = find_complete_edge(v1, v2)
+            assert find_complete_vertices(k) == (v1, v2)
+
+
+@pytest.mark.parametrize('num_vertices', [1, 2, 3, 4, 10])
+def test_make_candidate_graph_complete(num_vertices):
+    V = num_vertices
+    neighbors = [[v2 for v2 in range(V) if v2 != v1] for v1 in range(V)]
+    expected = make_complete_graph(V)
+
+    grid = make_candidate_graph(V, np.array(neighbors).reshape((V, V - 1)))
+    np.testing.assert_array_equal(grid, expected)
+
+
+def test_make_candidate_graph():
+    neighbors = np.array([[2], [2], [0], [2]])
+    edges = [(0, 1), (2, 3)]
+    expected = [[0, 1, 2, 3], [0, 0, 1, 2], [1, 2, 2, 3]]
+
+    grid = make_candidate_graph(4, neighbors, edges)
+    np.testing.assert_array_equal(grid, expected)
+
+
 @pytest.mark.parametrize('edges,expected_grid', [
     ([], []),
     ([(0, 1)], [[0], [0], [1]]),
@@ -83,6 +118,25 @@ def test_make_tree_runs(edges):
         assert set(grid[1, :]) | set(grid[2, :]) == set(range(V))
 
 
+@pytest.mark.parametrize('edges', EXAMPLE_TREES)
+def test_make_tree_adjacency(edges):
+    E = len(edges)
+    V = E + 1
+    grid = make_tree(edges)
+    offsets, neighbors, edge_ids = make_tree_adjacency(grid)
+    assert offsets.shape == (V + 1, )
+    assert neighbors.shape == (2 * E, )
+    assert edge_ids.shape == (2 * E, )
+    for v in range(V):
+        beg, end = offsets[v:v + 2]
+        expected = sorted([v2 for v1, v2 in edges if v1 == v] +
+                          [v1 for v1, v2 in edges if v2 == v])
+        assert list(neighbors[beg:end]) == expected
+        for v2, e in zip(neighbors[beg:end], edge_ids[beg:end]):
+            assert grid[1, e] == min(v, v2)
+            assert grid[2, e] == max(v, v2)
+
+
 @pytest.mark.parametrize('expected_vertex,edges', [
     (0, []),
     (0, [(0, 1)]),
@@ -119,7 +173,7 @@ def test_make_propagation_schedule(edges, root):
     # Generate a schedule.
     schedule = make_propagation_schedule(grid, root)
     assert schedule.shape == (V + E + 1 + E, 4)
-    assert schedule.dtype == np.int16
+    assert schedule.dtype == np.int32
 
     # Check topology.
     if root is not None:
@@ -155,6 +209,140 @@ def test_make_propagation_schedule(edges, root):
     assert np.all(state == 2)
 
 
+@pytest.mark.parametrize('edges,root', EXAMPLE_ROOTED_TREES)
+def test_make_propagation_schedule_levels(edges, root):
+    V = len(edges) + 1
+    grid = make_tree(edges)
+    schedule, level_offsets = make_propagation_schedule(grid, root, True)
+    assert schedule.shape == (V, 3)
+    assert schedule.dtype == np.int32
+    assert level_offsets[0] == 0
+    assert level_offsets[1] == 1
+    assert level_offsets[-1] == V
+    assert np.all(level_offsets[1:] > level_offsets[:-1])
+
+    # The root and out-going messages should match the flat schedule.
+    flat = make_propagation_schedule(grid, root)
+    outward = flat[flat[:, 0] >= OP_ROOT]
+    np.testing.assert_array_equal(schedule[:, 0], outward[:, 1])
+    np.testing.assert_array_equal(schedule[1:, 1:], outward[1:, 2:])
+    assert tuple(schedule[0, 1:]) == (-1, -1)
+
+    # Each parent should be one level up, and siblings should be contiguous.
+    depth = np.zeros(V, np.int32)
+    for d, (beg, end) in enumerate(zip(level_offsets, level_offsets[1:])):
+        depth[schedule[beg:end, 0]] = d
+    for v, v2, e in schedule[1:]:
+        assert depth[v] == depth[v2] + 1
+    parents = schedule[1:, 1]
+    if len(parents):
+        num_runs = 1 + np.count_nonzero(parents[1:] != parents[:-1])
+        assert num_runs == len(set(parents))
+
+
+@pytest.mark.parametrize('edges', EXAMPLE_TREES[2:])
+def test_tree_structure_propagation_schedule(edges):
+    V = len(edges) + 1
+    tree = TreeStructure(V)
+    tree.set_edges(edges)
+    grid = tree.tree_grid
+    for root in [None] + list(range(V)):
+        schedule = tree.propagation_schedule(root)
+        expected = make_propagation_schedule(grid, root)
+        np.testing.assert_array_equal(schedule, expected)
+        assert tree.propagation_schedule(root) is schedule
+        levels = tree.propagation_schedule(root, levels=True)
+        expected = make_propagation_schedule(grid, root, levels=True)
+        np.testing.assert_array_equal(levels[0], expected[0])
+        np.testing.assert_array_equal(levels[1], expected[1])
+
+    # The cache should survive only if edges are unchanged.
+    schedule = tree.propagation_schedule()
+    tree.set_edges(list(reversed(edges)))
+    assert tree.propagation_schedule() is schedule
+    tree.set_edges([(v, v + 1) for v in range(V - 1)])
+    np.testing.assert_array_equal(
+        tree.propagation_schedule(),
+        make_propagation_schedule(tree.tree_grid))
+
+
+def test_tree_structure_pickle():
+    tree = TreeStructure(4)
+    tree.set_edges([(0, 1), (0, 2), (0, 3)])
+    schedule = tree.propagation_schedule()
+    tree = pickle.loads(pickle.dumps(tree))
+    assert tree._schedules == {}
+    np.testing.assert_array_equal(tree.propagation_schedule(), schedule)
+
+
+@pytest.mark.parametrize('num_vertices', [2, 3, 10, 30])
+def test_sample_tree_is_spanning(num_vertices):
+    set_random_seed(0)
+    V = num_vertices
+    grid = make_complete_graph(V)
+    K = grid.shape[1]
+    edge_logits = np.random.random([K]) * 10
+    edges = [(v, v + 1) for v in range(V - 1)]
+    for _ in range(10):
+        edges = sample_tree(grid, edge_logits, edges, steps=2)
+        assert len(edges) == V - 1
+        assert edges == sorted(set(edges))
+        assert all(v1 < v2 for v1, v2 in edges)
+        neighbors = {v: set() for v in range(V)}
+        for v1, v2 in edges:
+            neighbors[v1].add(v2)
+            neighbors[v2].add(v1)
+        component = set([0])
+        stack = [0]
+        while stack:
+            for v in neighbors[stack.pop()] - component:
+                component.add(v)
+                stack.append(v)
+        assert component == set(range(V))
+
+
+@pytest.mark.parametrize('num_vertices', [3, 10, 30])
+def test_sample_tree_candidates_is_spanning(num_vertices):
+    set_random_seed(0)
+    V = num_vertices
+    edges = [(v, v + 1) for v in range(V - 1)]
+    neighbors = np.random.randint(V, size=(V, 2))
+    grid = make_candidate_graph(V, neighbors, edges)
+    candidates = set(map(tuple, grid[1:, :].T))
+    K = grid.shape[1]
+    edge_logits = np.random.random([K]) * 10
+    for _ in range(10):
+        edges = sample_tree(grid, edge_logits, edges, steps=2)
+        assert len(edges) == V - 1
+        assert all(edge in candidates for edge in edges)
+        neighbors = {v: set() for v in range(V)}
+        for v1, v2 in edges:
+            neighbors[v1].add(v2)
+            neighbors[v2].add(v1)
+        component = set([0])
+        stack = [0]
+        while stack:
+            for v in neighbors[stack.pop()] - component:
+                component.add(v)
+                stack.append(v)
+        assert component == set(range(V))
+
+
+@pytest.mark.parametrize('num_vertices', [2, 3, 10, 30])
+def test_sample_tree_implicit_grid(num_vertices):
+    V = num_vertices
+    grid = make_complete_graph(V)
+    K = grid.shape[1]
+    set_random_seed(0)
+    edge_logits = np.random.random([K]) * 10
+    edges = [(v, v + 1) for v in range(V - 1)]
+    set_random_seed(1)
+    expected = sample_tree(grid, edge_logits, edges, steps=3)
+    set_random_seed(1)
+    actual = sample_tree(None, edge_logits, edges, steps=3)
+    assert actual == expected
+
+
 @pytest.mark.parametrize('num_edges', [1, 2, 3, 4])
 def test_sample_tree_gof(num_edges):
     set_random_seed(0)
@@ -183,3 +371,50 @@ def test_sample_tree_gof(num_edges):
     probs /= probs.sum()
     gof = multinomial_goodness_of_fit(probs, counts, num_samples, plot=True)
     assert 1e-2 < gof
+
+
+def is_spanning_tree(V, edges):
+    component = set([0])
+    changed = True
+    while changed:
+        changed = False
+        for v1, v2 in edges:
+            if (v1 in component) != (v2 in component):
+                component.update([v1, v2])
+                changed = True
+    return len(edges) == V - 1 and component == set(range(V))
+
+
+@pytest.mark.parametrize('num_edges', [2, 3, 4])
+def test_sample_tree_candidates_gof(num_edges):
+    set_random_seed(0)
+    E = num_edges
+    V = 1 + E
+    edges = [(v, v + 1) for v in range(V - 1)]
+    neighbors = np.random.randint(V, size=(V, 1))
+    grid = make_candidate_graph(V, neighbors, edges)
+    K = grid.shape[1]
+    edge_logits = np.random.random([K])
+    edge_probs = np.exp(edge_logits)
+    edge_probs_dict = {(v1, v2): edge_probs[k] for k, v1, v2 in grid.T}
+    trees = [
+        tree for tree in itertools.combinations(sorted(edge_probs_dict), E)
+        if is_spanning_tree(V, tree)
+    ]
+
+    # Generate many samples via MCMC.
+    num_samples = 2000
+    counts = defaultdict(lambda: 0)
+    for _ in range(num_samples):
+        edges = sample_tree(grid, edge_logits, edges)
+        counts[tuple(edges)] += 1
+    assert set(counts) == set(trees)
+
+    # Check accuracy using Pearson's chi-squared test.
+    keys = counts.keys()
+    counts = np.array([counts[key] for key in keys])
+    probs = np.array(
+        [np.prod([edge_probs_dict[edge] for edge in key]) for key in keys])
+    probs /= probs.sum()
+    gof = multinomial_goodness_of_fit(probs, counts, num_samples, plot=True)
+    assert 1e-2 < gof
@@ -4,37 +4,69 @@ from __future__ import print_function
 
 import itertools
 import logging
+import math
 import multiprocessing
+import os
+import shutil
+import tempfile
 
 import numpy as np
+import scipy.sparse
 from scipy.special import gammaln
 
 from six.moves import xrange
+from treecat.format import pickle_dump
+from treecat.format import pickle_load
 from treecat.structure import TreeStructure
-from treecat.structure import make_propagation_schedule
+from treecat.structure import find_complete_edge
+from treecat.structure import find_complete_vertices
+from treecat.structure import make_candidate_graph
 from treecat.structure import sample_tree
 from treecat.util import art_logger
+from treecat.util import find_sparse_cells
+from treecat.util import is_threading_started
 from treecat.util import jit
+from treecat.util import make_sparse_data
+from treecat.util import prange
 from treecat.util import profile
+from treecat.util import set_num_threads
 from treecat.util import set_random_seed
+from treecat.util import split_data
 
 logger = logging.getLogger(__name__)
 
+# Action codes for fused training segments.
+ACTION_ADD_ROW = 0
+ACTION_REMOVE_ROW = 1
 
-def count_pairs(assignments, v1, v2, M):
+# Rows are resampled in blocks to bound the memory of random noise.
+SAMPLE_ASSIGNMENTS_BLOCK_SIZE = 4096
+
+# Candidate edges among many vertices are pruned by locality-sensitive hashing
+# into this many tables, each scoring pairs within a window of sorted codes.
+CANDIDATE_HASH_TABLES = 16
+CANDIDATE_HASH_WINDOW = 16
+CANDIDATE_HASH_BUCKET_SIZE = 32
+
+
+def count_pairs(assignments, v1, v2, M, weights=None):
     """Construct sufficient statistics for (v1, v2) pairs.
 
     Args:
       assignments: An _ x V assignment matrix with values in range(M).
       v1, v2: Column ids of the assignments matrix.
       M: The number of possible assignment bins.
+      weights: An optional array of integer row weights.
 
     Returns:
       And M x M array of counts.
     """
     assert v1 != v2
     pairs = assignments[:, v1].astype(np.int32) * M + assignments[:, v2]
-    return np.bincount(pairs, minlength=M * M).reshape((M, M))
+    if weights is None:
+        return np.bincount(pairs, minlength=M * M).reshape((M, M))
+    counts = np.bincount(pairs, weights, minlength=M * M).reshape((M, M))
+    return counts.astype(np.int32)
 
 
 def logprob_dc(counts_plus_prior, axis=None):
@@ -45,6 +77,192 @@ def logprob_dc(counts_plus_prior, axis=None):
     return gammaln(counts_plus_prior).sum(axis)
 
 
+def sample_dirichlet(alpha):
+    """Vectorized sampler from Dirichlet distributions along the last axis.
+
+    Samples are bounded away from zero, so that they are safe to divide by.
+    """
+    probs = np.random.gamma(np.asarray(alpha, np.float64))
+    np.maximum(probs, np.finfo(np.float64).tiny, out=probs)
+    probs /= probs.sum(axis=-1, keepdims=True)
+    return probs
+
+
+@jit(nopython=True, parallel=True, cache=True)
+def jit_compute_edge_logits(columns, weights, grid, vertex_logits, edge_prior,
+                            M):
+    """Compute edge logits of many (v1, v2) pairs in parallel.
+
+    Args:
+      columns: A [V, N]-shaped contiguous array of assignments, i.e. the
+        transpose of an assignments matrix.
+      weights: An [N]-shaped array of row weights, which may be fractional
+        when estimating from a subsample of rows.
+      grid: A 3 x K array of (edge, vertex, vertex) triples, or an empty
+        3 x 0 array to denote an implicit complete graph.
+      vertex_logits: A [V]-shaped array of vertex logits.
+      edge_prior: The Dirichlet prior for each cell of an edge.
+      M: The number of possible assignment bins.
+
+    Returns:
+      A [K]-shaped numpy array of edge logits.
+    """
+    V = columns.shape[0]
+    N = columns.shape[1]
+    K = grid.shape[1]
+    implicit = (K == 0)
+    if implicit:
+        K = V * (V - 1) // 2
+    edge_logits = np.zeros(K, np.float32)
+    for k in prange(K):
+        if implicit:
+            v1, v2 = find_complete_vertices(k)
+        else:
+            v1 = grid[1, k]
+            v2 = grid[2, k]
+        counts = np.zeros((M, M), np.float64)
+        for n in xrange(N):
+            counts[columns[v1, n], columns[v2, n]] += weights[n]
+        logit = 0.0
+        for m1 in xrange(M):
+            for m2 in xrange(M):
+                logit += math.lgamma(counts[m1, m2] + edge_prior)
+        edge_logits[k] = logit - vertex_logits[v1] - vertex_logits[v2]
+    return edge_logits
+
+
+@jit(nopython=True, parallel=True, cache=True)
+def jit_find_candidate_edges(columns, weights, vertex_logits, edge_prior, M,
+                             num_candidates):
+    """Find the highest-scoring neighbors of each vertex in parallel.
+
+    This scores all V^2 pairs, but stores only O(V) of them, so that memory
+    does not grow quadratically in V.
+
+    Args:
+      columns: A [V, N]-shaped contiguous array of assignments, i.e. the
+        transpose of an assignments matrix.
+      weights: An [N]-shaped array of row weights.
+      vertex_logits: A [V]-shaped array of vertex logits.
+      edge_prior: The Dirichlet prior for each cell of an edge.
+      M: The number of possible assignment bins.
+      num_candidates: The number of neighbors to find for each vertex.
+
+    Returns:
+      A [V, num_candidates]-shaped numpy array of neighbor vertices.
+    """
+    V = columns.shape[0]
+    N = columns.shape[1]
+    neighbors = np.zeros((V, num_candidates), np.int32)
+    for v1 in prange(V):
+        logits = np.empty(V, np.float64)
+        counts = np.zeros((M, M), np.float64)
+        for v2 in xrange(V):
+            if v2 == v1:
+                logits[v2] = -np.inf
+                continue
+            counts[:, :] = 0
+            for n in xrange(N):
+                counts[columns[v1, n], columns[v2, n]] += weights[n]
+            logit = 0.0
+            for m1 in xrange(M):
+                for m2 in xrange(M):
+                    logit += math.lgamma(counts[m1, m2] + edge_prior)
+            logits[v2] = logit - vertex_logits[v2]
+        neighbors[v1, :] = np.argsort(-logits)[:num_candidates]
+    return neighbors
+
+
+def find_candidate_edges(columns, weights, vertex_logits, edge_prior, M,
+                         num_candidates):
+    """Find high-scoring neighbors of each vertex.
+
+    Exactly scoring all pairs costs O(V^2 N M^2), which is affordable only
+    for small V. For larger V this first prunes pairs by locality-sensitive
+    hashing. Each table embeds each vertex by whether each row's assignment
+    agrees with that of a random partner row, hashes the centered embedding
+    by the signs of random hyperplanes, and proposes pairs of vertices lying
+    within CANDIDATE_HASH_WINDOW of each other in sorted code order. Strongly
+    dependent vertices have correlated embeddings regardless of how their
+    bins are labeled, and hence likely share codes. Only the O(V) proposed
+    pairs are scored exactly, for a total cost of O(V T (N b + W (N + M^2)))
+    for T tables of window W and b code bits.
+
+    Args:
+      columns: A [V, N]-shaped contiguous array of assignments, i.e. the
+        transpose of an assignments matrix.
+      weights: An [N]-shaped array of row weights.
+      vertex_logits: A [V]-shaped array of vertex logits.
+      edge_prior: The Dirichlet prior for each cell of an edge.
+      M: The number of possible assignment bins.
+      num_candidates: The number of neighbors to find for each vertex.
+
+    Returns:
+      A [V, num_candidates]-shaped numpy array of neighbor vertices. Vertices
+      with fewer proposed neighbors are padded with themselves, which
+      make_candidate_graph() ignores.
+    """
+    V, N = columns.shape
+    tables = CANDIDATE_HASH_TABLES
+    window = CANDIDATE_HASH_WINDOW
+    if V <= 2 * tables * window:
+        return jit_find_candidate_edges(columns, weights, vertex_logits,
+                                        edge_prior, M, num_candidates)
+    bits = max(1, int(np.log2(V / CANDIDATE_HASH_BUCKET_SIZE)))
+    weights = np.asarray(weights, np.float32)
+    pairs = []
+    for _ in xrange(tables):
+        # Embed each vertex by whether each row agrees with a random partner
+        # row; unlike assignments, agreement is invariant to relabeling.
+        partner = np.random.permutation(N)
+        probs = weights * weights[partner]
+        probs /= probs.sum()
+        embedding = (columns == columns[:, partner]).astype(np.float32)
+        embedding -= np.dot(embedding, probs)[:, np.newaxis]
+        embedding *= np.sqrt(probs)
+        hyperplanes = np.random.normal(size=(N, bits)).astype(np.float32)
+        signs = (np.dot(embedding, hyperplanes) > 0)
+        codes = np.dot(signs, 1 << np.arange(bits))
+        order = np.lexsort((np.random.random(V), codes))
+        for offset in xrange(1, window + 1):
+            v1 = order[:-offset]
+            v2 = order[offset:]
+            same = (codes[v1] == codes[v2])
+            v1 = v1[same]
+            v2 = v2[same]
+            pairs.append((np.minimum(v1, v2), np.maximum(v1, v2)))
+    v1 = np.concatenate([pair[0] for pair in pairs])
+    v2 = np.concatenate([pair[1] for pair in pairs])
+    keys = v1 + v2 * (v2 - 1) // 2
+    keys, pos = np.unique(keys, return_index=True)
+    K = len(keys)
+    grid = np.empty([3, K], np.int32)
+    grid[0, :] = np.arange(K)
+    grid[1, :] = v1[pos]
+    grid[2, :] = v2[pos]
+    logits = jit_compute_edge_logits(columns, weights, grid, vertex_logits,
+                                     edge_prior, M)
+
+    # Keep the highest-scoring proposed neighbors of each vertex.
+    source = np.concatenate([grid[1], grid[2]])
+    target = np.concatenate([grid[2], grid[1]])
+    logits = np.concatenate([logits, logits])
+    order = np.lexsort((-logits, source))
+    source = source[order]
+    target = target[order]
+    rank = np.arange(len(source)) - np.searchsorted(source, source)
+    keep = (rank < num_candidates)
+    neighbors = np.empty([V, num_candidates], np.int32)
+    neighbors[:, :] = np.arange(V)[:, np.newaxis]
+    neighbors[source[keep], rank[keep]] = target[keep]
+    return neighbors
+
+
+def _checkpoint_seed(seed, num_tree_samples):
+    """Derive a random seed for the segment after a given tree sample."""
+    return np.random.RandomState([seed, num_tree_samples]).randint(2**31)
+
+
 def get_annealing_schedule(num_rows, config):
     """Iterator for subsample annealing yielding (action, arg) pairs.
 
@@ -82,127 +300,756 @@ def get_annealing_schedule(num_rows, config):
             num_fresh = 0
 
 
-@profile
+def get_adaptive_annealing_schedule(num_rows, config, stats):
+    """Iterator for adaptive subsample annealing yielding (action, arg) pairs.
+
+    This is like get_annealing_schedule(), but adapts to the observed
+    difficulty of the data after each 'sample_tree' action:
+
+    The remove rate is scaled by the fraction of cells whose assignment
+    changed when re-added, relative to
+    config['learning_annealing_target_change'], so that easy data is
+    annealed in fewer effective epochs. This fraction is floored at
+    config['learning_annealing_min_change'], so that rows keep being
+    removed and the tree keeps being sampled even if no assignment changes.
+
+    While fewer than a fraction config['learning_annealing_min_churn'] of
+    tree edges change per sample, the interval between tree samples
+    doubles, up to config['learning_annealing_max_tree_interval'] batches.
+    Regardless of interval, the tree is sampled whenever the number of
+    assigned rows more than doubles, so that batches cannot outgrow the
+    tree.
+
+    Args:
+      num_rows: The number of rows of data.
+      config: A global config dict.
+      stats: A dict with keys 'tree_churn' and 'assignment_change', which
+        the caller updates after each 'sample_tree' action.
+    """
+    # Randomly shuffle rows.
+    row_ids = list(range(num_rows))
+    np.random.shuffle(row_ids)
+    row_to_add = itertools.cycle(row_ids)
+    row_to_remove = itertools.cycle(row_ids)
+
+    # Start with a linear annealing schedule. Note that the remove rate
+    # is kept below the add rate, so rows are never removed before added.
+    epochs = float(config['learning_annealing_epochs'])
+    add_rate = epochs
+    remove_rate = epochs - 1.0
+    state = epochs * config['learning_annealing_init_rows']
+    target_change = config['learning_annealing_target_change']
+    min_change = config['learning_annealing_min_change']
+    min_churn = config['learning_annealing_min_churn']
+    max_interval = config['learning_annealing_max_tree_interval']
+
+    # Sample the tree after every few batches.
+    sampling_tree = (config['learning_sample_tree_steps'] > 0)
+    interval = 1
+    num_batches = 0
+    num_fresh = 0
+    num_stale = 0
+    tree_rows = 0  # The number of assigned rows at the last tree sample.
+    while num_fresh + num_stale != num_rows:
+        if state >= 0.0:
+            yield 'add_row', next(row_to_add)
+            state -= remove_rate
+            num_fresh += 1
+        else:
+            yield 'remove_row', next(row_to_remove)
+            state += add_rate
+            num_stale -= 1
+        if not sampling_tree:
+            continue
+        sample = (num_fresh + num_stale > 2 * tree_rows)
+        if num_stale == 0 and num_fresh > 0:
+            num_batches += 1
+            sample = sample or num_batches >= interval
+            num_stale = num_fresh
+            num_fresh = 0
+        if sample:
+            yield 'sample_tree', None
+            num_batches = 0
+            tree_rows = num_fresh + num_stale
+            change = min(1.0, stats['assignment_change'] / target_change)
+            change = max(min_change, change)
+            remove_rate = (epochs - 1.0) * change
+            if stats['tree_churn'] < min_churn:
+                interval = min(2 * interval, max_interval)
+            else:
+                interval = 1
+
+
+def update_early_stopping(progress, scores, churn, config):
+    """Update early stopping state after a tree sample.
+
+    This compares the mean predictive score per added row and the mean tree
+    churn over consecutive windows of
+    config['learning_early_stopping_patience'] tree samples. Training has
+    converged when, with roughly 95% confidence, the score changed by at
+    most a relative config['learning_early_stopping_tol'] from one window to
+    the next, and the churn fell by at most
+    config['learning_early_stopping_churn'].
+
+    Args:
+      progress: An early stopping state dict as returned by
+        make_early_stopping(), which is updated in place.
+      scores: A length-3 numpy array of (count, sum, sum of squares) of
+        predictive log probabilities of rows added since the previous tree
+        sample.
+      churn: The fraction of tree edges that changed in the tree sample.
+      config: A global config dict.
+    """
+    patience = config['learning_early_stopping_patience']
+    if patience <= 0:
+        return
+    progress['scores'] += scores
+    progress['churn'] += churn
+    progress['num_tree_samples'] += 1
+    if progress['num_tree_samples'] < patience:
+        return
+    count, total, total_sq = progress['scores']
+    count = max(1.0, count)
+    mean = total / count
+    var = max(0.0, total_sq / count - mean * mean) / count
+    churn = progress['churn'] / patience
+    logger.info('Predictive score %g +- %g, tree churn %g', mean,
+                math.sqrt(var), churn)
+    if progress['window'] is not None:
+        old_mean, old_var, old_churn = progress['window']
+        tol = config['learning_early_stopping_tol'] * abs(mean)
+        bound = abs(mean - old_mean) + 2.0 * math.sqrt(var + old_var)
+        if (bound <= tol and
+                churn >= old_churn - config['learning_early_stopping_churn']):
+            progress['converged'] = True
+    progress['window'] = (mean, var, churn)
+    progress['scores'] = np.zeros(3)
+    progress['churn'] = 0.0
+    progress['num_tree_samples'] = 0
+
+
+def make_early_stopping():
+    """Create an initial early stopping state for update_early_stopping()."""
+    return {
+        'scores': np.zeros(3),
+        'churn': 0.0,
+        'num_tree_samples': 0,
+        'window': None,
+        'converged': False,
+    }
+
+
+def get_warm_start_schedule(num_rows, num_init_rows, config):
+    """Iterator for refining a warm-started model yielding (action, arg) pairs.
+
+    This assumes rows [0, num_init_rows) are already assigned, e.g. by
+    TreeCatTrainer.warm_start(). First all remaining rows are added, and then
+    config['learning_warm_start_epochs'] sweeps of single-site Gibbs
+    sampling remove and re-add every row. The tree is sampled after each
+    pass.
+
+    Args:
+      num_rows: The number of rows of data.
+      num_init_rows: The number of initially assigned rows.
+      config: A global config dict.
+    """
+    sampling_tree = (config['learning_sample_tree_steps'] > 0)
+    row_ids = list(range(num_init_rows, num_rows))
+    np.random.shuffle(row_ids)
+    for row_id in row_ids:
+        yield 'add_row', row_id
+    if sampling_tree and row_ids:
+        yield 'sample_tree', None
+    for _ in range(int(config['learning_warm_start_epochs'])):
+        # Each sweep is shuffled afresh, so that resuming from a checkpoint
+        # replays exactly.
+        row_ids = np.random.permutation(num_rows)
+        for row_id in row_ids:
+            yield 'remove_row', row_id
+            yield 'add_row', row_id
+        if sampling_tree and num_rows:
+            yield 'sample_tree', None
+
+
+def get_annealing_segments(schedule):
+    """Iterator batching an annealing schedule into fused segments.
+
+    This batches each run of consecutive 'add_row' and 'remove_row' actions
+    into a single 'segment' action whose arg is an [S, 2]-shaped numpy array
+    of (action code, row_id) pairs, where action codes are ACTION_ADD_ROW or
+    ACTION_REMOVE_ROW. 'sample_tree' actions are passed through unchanged.
+
+    Args:
+      schedule: An iterator of (action, arg) pairs as yielded by
+        get_annealing_schedule().
+    """
+    segment = []
+    for action, row_id in schedule:
+        if action == 'add_row':
+            segment.append((ACTION_ADD_ROW, row_id))
+        elif action == 'remove_row':
+            segment.append((ACTION_REMOVE_ROW, row_id))
+        else:
+            if segment:
+                yield 'segment', np.array(segment, dtype=np.int32)
+                segment = []
+            yield action, row_id
+    if segment:
+        yield 'segment', np.array(segment, dtype=np.int32)
+
+
 @jit(nopython=True, cache=True)
-def jit_add_row(
+def jit_sample_weighted_row(
         ragged_index,
-        data_row,
-        tree_grid,
+        data_cells,
+        data_counts,
+        weight,
         schedule,
         assignments,
-        vert_ss,
-        edge_ss,
-        feat_ss,
-        meas_ss,
         vert_probs,
         edge_probs,
         feat_probs,
         meas_probs, ):
-    messages = vert_probs.copy()
+    """Sample the shared latent assignments of w copies of a row.
+
+    This is the weighted analogue of the sampler in jit_add_row(), where
+    each vertex, edge, and feature factor is replaced by a rising factorial
+    of order w. Messages are computed in log space, since these factors can
+    be very large.
+
+    Returns:
+      The predictive log probability of all w copies given all other
+      assigned rows, divided by w.
+    """
+    V, M = vert_probs.shape
+    w = weight
+    log_vert = np.empty((V, M), np.float64)
+    for v in xrange(V):
+        for m in xrange(M):
+            log_vert[v, m] = (math.lgamma(vert_probs[v, m] + w) -
+                              math.lgamma(vert_probs[v, m]))
+    total = vert_probs[0, :].sum()
+    logprob = math.lgamma(total) - math.lgamma(total + w)
+    messages = np.empty((V, M), np.float64)
+    for v in xrange(V):
+        shift = log_vert[v, :].max()
+        messages[v, :] = np.exp(log_vert[v, :] - shift)
+        logprob += shift
+    logits = np.empty(M, np.float64)
+    trans = np.empty((M, M), np.float64)
     for i in xrange(len(schedule)):
         op, v, v2, e = schedule[i]
         message = messages[v, :]
         if op == 0:  # OP_UP
             # Propagate upward from observed to latent.
-            beg, end = ragged_index[v:v + 2]
-            feat_block = feat_probs[beg:end, :]
+            beg = np.searchsorted(data_cells, ragged_index[v])
+            end = np.searchsorted(data_cells, ragged_index[v + 1])
             meas_block = meas_probs[v, :]
-            for c, count in enumerate(data_row[beg:end]):
-                for _ in xrange(count):
-                    message *= feat_block[c, :]
-                    message /= meas_block
-                    feat_block[c, :] += 1.0
-                    meas_block += 1.0
+            logits[:] = 0
+            seen = 0  # The number of observations already in this block.
+            for j in xrange(beg, end):
+                feat_block = feat_probs[data_cells[j], :]
+                count = data_counts[j] * w
+                for m in xrange(M):
+                    logits[m] += (math.lgamma(feat_block[m] + count) -
+                                  math.lgamma(feat_block[m]) -
+                                  math.lgamma(meas_block[m] + seen + count) +
+                                  math.lgamma(meas_block[m] + seen))
+                seen += count
+            shift = logits.max()
+            message *= np.exp(logits - shift)
+            logprob += shift
         elif op == 1:  # OP_IN
             # Propagate latent state inward from children to v.
-            trans = edge_probs[e, :, :]
-            if v > v2:
-                trans = trans.T
-            message *= np.dot(trans, messages[v2, :] / vert_probs[v2, :])
-            message /= vert_probs[v, :]
-            message /= message.sum()  # For numerical stability only.
+            for m in xrange(M):
+                for m2 in xrange(M):
+                    if v < v2:
+                        edge = edge_probs[e, m, m2]
+                    else:
+                        edge = edge_probs[e, m2, m]
+                    trans[m, m2] = (math.lgamma(edge + w) - math.lgamma(edge)
+                                    - log_vert[v, m] - log_vert[v2, m2])
+            shift = trans.max()
+            message *= np.dot(np.exp(trans - shift), messages[v2, :])
+            message_sum = message.sum()
+            message /= message_sum  # For numerical stability only.
+            logprob += shift + math.log(message_sum)
         else:  # OP_ROOT or OP_OUT
+            if op == 2:  # OP_ROOT
+                logprob += math.log(message.sum())
             if op == 3:  # OP_OUT
                 # Propagate latent state outward from parent to v.
+                m2 = assignments[v2]
+                for m in xrange(M):
+                    if v < v2:
+                        edge = edge_probs[e, m, m2]
+                    else:
+                        edge = edge_probs[e, m2, m]
+                    logits[m] = (math.lgamma(edge + w) - math.lgamma(edge) -
+                                 log_vert[v, m])
+                message *= np.exp(logits - logits.max())
+            message *= 0.999999 / message.sum()  # Avoid np.binom errors.
+            assignments[v] = np.random.multinomial(1, message).argmax()
+    return logprob / w
+
+
+@jit(nopython=True, cache=True)
+def jit_add_row(
+        ragged_index,
+        data_cells,
+        data_counts,
+        weight,
+        tree_grid,
+        schedule,
+        assignments,
+        vert_ss,
+        edge_ss,
+        feat_ss,
+        meas_ss,
+        pair_ss,
+        vert_probs,
+        edge_probs,
+        feat_probs,
+        meas_probs, ):
+    """Add a row, sampling its latent assignments.
+
+    A row of integer weight w counts as w copies of the row, all of which
+    share a single sample of latent assignments. Weighted rows are sampled
+    from their exact conditional by jit_sample_weighted_row().
+
+    Returns:
+      The predictive log probability of the row given all other assigned
+      rows, which is computed as a byproduct of sampling. For weighted rows
+      this is averaged over the w copies.
+    """
+    if weight != 1:
+        logprob = jit_sample_weighted_row(
+            ragged_index, data_cells, data_counts, weight, schedule,
+            assignments, vert_probs, edge_probs, feat_probs, meas_probs)
+    else:
+        M = vert_probs.shape[1]
+        messages = vert_probs.copy()
+        logits = np.empty(M, np.float64)
+        logprob = -math.log(vert_probs[0, :].sum())
+        for i in xrange(len(schedule)):
+            op, v, v2, e = schedule[i]
+            message = messages[v, :]
+            if op == 0:  # OP_UP
+                # Propagate upward from observed to latent.
+                # This iterates only over observed cells of the sparse row.
+                beg = np.searchsorted(data_cells, ragged_index[v])
+                end = np.searchsorted(data_cells, ragged_index[v + 1])
+                meas_block = meas_probs[v, :]
+                seen = 0  # The number of observations already in this block.
+                for j in xrange(beg, end):
+                    feat_block = feat_probs[data_cells[j], :]
+                    count = data_counts[j]
+                    if count == 1:
+                        message *= feat_block
+                        message /= meas_block + seen
+                    else:
+                        # Multiply by the ratio of rising factorials
+                        # (feat)^(count) / (meas + seen)^(count) in log space,
+                        # which costs O(M) independent of count.
+                        max_logit = -np.inf
+                        for m in xrange(M):
+                            logits[m] = (
+                                math.lgamma(feat_block[m] + count) -
+                                math.lgamma(feat_block[m]) -
+                                math.lgamma(meas_block[m] + seen + count) +
+                                math.lgamma(meas_block[m] + seen))
+                            max_logit = max(max_logit, logits[m])
+                        for m in xrange(M):
+                            message[m] *= math.exp(logits[m] - max_logit)
+                        logprob += max_logit
+                    seen += count
+            elif op == 1:  # OP_IN
+                # Propagate latent state inward from children to v.
                 trans = edge_probs[e, :, :]
-                if v2 > v:
+                if v > v2:
                     trans = trans.T
-                message *= trans[assignments[v2], :]
+                message *= np.dot(trans, messages[v2, :] / vert_probs[v2, :])
                 message /= vert_probs[v, :]
-            message *= 0.999999 / message.sum()  # Avoid np.binom errors.
-            assignments[v] = np.random.multinomial(1, message).argmax()
+                message_sum = message.sum()
+                message /= message_sum  # For numerical stability only.
+                logprob += math.log(message_sum)
+            else:  # OP_ROOT or OP_OUT
+                if op == 2:  # OP_ROOT
+                    logprob += math.log(message.sum())
+                if op == 3:  # OP_OUT
+                    # Propagate latent state outward from parent to v.
+                    trans = edge_probs[e, :, :]
+                    if v2 > v:
+                        trans = trans.T
+                    message *= trans[assignments[v2], :]
+                    message /= vert_probs[v, :]
+                message *= 0.999999 / message.sum()  # Avoid np.binom errors.
+                assignments[v] = np.random.multinomial(1, message).argmax()
 
-    # Update sufficient statistics.
+    # Update sufficient statistics and probability tables.
     E = tree_grid.shape[1]
     for v, m in enumerate(assignments):
-        vert_ss[v, m] += 1
+        vert_ss[v, m] += weight
+        vert_probs[v, m] += weight
     for e in xrange(E):
-        edge_ss[e,  #
-                assignments[tree_grid[1, e]],  #
-                assignments[tree_grid[2, e]]] += 1
-    for v, m in enumerate(assignments):
-        beg, end = ragged_index[v:v + 2]
-        feat_ss[beg:end, m] += data_row[beg:end]
-        meas_ss[v, m] += data_row[beg:end].sum()
+        m1 = assignments[tree_grid[1, e]]
+        m2 = assignments[tree_grid[2, e]]
+        edge_ss[e, m1, m2] += weight
+        edge_probs[e, m1, m2] += weight
+    v = 0
+    for j in xrange(len(data_cells)):
+        r = data_cells[j]
+        while r >= ragged_index[v + 1]:
+            v += 1
+        m = assignments[v]
+        count = data_counts[j] * weight
+        feat_ss[r, m] += count
+        feat_probs[r, m] += count
+        meas_ss[v, m] += count
+        meas_probs[v, m] += count
+    if pair_ss.shape[0]:
+        k = 0
+        for v2 in xrange(len(assignments)):
+            for v1 in xrange(v2):
+                pair_ss[k, assignments[v1], assignments[v2]] += weight
+                k += 1
+    return logprob
 
 
-@profile
 @jit(nopython=True, cache=True)
 def jit_remove_row(
         ragged_index,
-        data_row,
+        data_cells,
+        data_counts,
+        weight,
         tree_grid,
         assignments,
         vert_ss,
         edge_ss,
         feat_ss,
-        meas_ss, ):
+        meas_ss,
+        pair_ss,
+        vert_probs,
+        edge_probs,
+        feat_probs,
+        meas_probs, ):
 
-    # Update sufficient statistics.
+    # Update sufficient statistics and probability tables.
     E = tree_grid.shape[1]
     for v, m in enumerate(assignments):
-        vert_ss[v, m] -= 1
+        vert_ss[v, m] -= weight
+        vert_probs[v, m] -= weight
     for e in xrange(E):
-        edge_ss[e,  #
-                assignments[tree_grid[1, e]],  #
-                assignments[tree_grid[2, e]]] -= 1
-    for v, m in enumerate(assignments):
-        beg, end = ragged_index[v:v + 2]
-        feat_ss[beg:end, m] -= data_row[beg:end]
-        meas_ss[v, m] -= data_row[beg:end].sum()
+        m1 = assignments[tree_grid[1, e]]
+        m2 = assignments[tree_grid[2, e]]
+        edge_ss[e, m1, m2] -= weight
+        edge_probs[e, m1, m2] -= weight
+    v = 0
+    for j in xrange(len(data_cells)):
+        r = data_cells[j]
+        while r >= ragged_index[v + 1]:
+            v += 1
+        m = assignments[v]
+        count = data_counts[j] * weight
+        feat_ss[r, m] -= count
+        feat_probs[r, m] -= count
+        meas_ss[v, m] -= count
+        meas_probs[v, m] -= count
+    if pair_ss.shape[0]:
+        k = 0
+        for v2 in xrange(len(assignments)):
+            for v1 in xrange(v2):
+                pair_ss[k, assignments[v1], assignments[v2]] -= weight
+                k += 1
+
+
+@jit(nopython=True, cache=True)
+def jit_get_row(data_dense, data_indptr, data_cells, data_counts, row_id):
+    """Get the sparse (cells, counts) of one row of dense or CSR data.
+
+    Exactly one of data_dense or (data_indptr, data_cells, data_counts) is
+    nonempty, as returned by split_data().
+    """
+    if data_dense.shape[0]:
+        row = data_dense[row_id, :]
+        cells = np.flatnonzero(row).astype(np.int32)
+        return cells, row[cells]
+    beg = data_indptr[row_id]
+    end = data_indptr[row_id + 1]
+    return data_cells[beg:end], data_counts[beg:end]
+
+
+@jit(nopython=True, cache=True)
+def jit_train_segment(
+        ragged_index,
+        data_dense,
+        data_indptr,
+        data_cells,
+        data_counts,
+        weights,
+        tree_grid,
+        schedule,
+        assignments,
+        assigned_rows,
+        vert_ss,
+        edge_ss,
+        feat_ss,
+        meas_ss,
+        pair_ss,
+        vert_probs,
+        edge_probs,
+        feat_probs,
+        meas_probs,
+        actions,
+        scores, ):
+    """Run a segment of add and remove actions.
+
+    The (count, sum, sum of squares) of predictive log probabilities of
+    added rows are accumulated into the length-3 scores array.
+    """
+    for i in xrange(actions.shape[0]):
+        action, row_id = actions[i]
+        cells, counts = jit_get_row(data_dense, data_indptr, data_cells,
+                                    data_counts, row_id)
+        if action == ACTION_ADD_ROW:
+            assert not assigned_rows[row_id]
+            logprob = jit_add_row(
+                ragged_index,
+                cells,
+                counts,
+                weights[row_id],
+                tree_grid,
+                schedule,
+                assignments[row_id, :],
+                vert_ss,
+                edge_ss,
+                feat_ss,
+                meas_ss,
+                pair_ss,
+                vert_probs,
+                edge_probs,
+                feat_probs,
+                meas_probs, )
+            assigned_rows[row_id] = True
+            weight = weights[row_id]
+            scores[0] += weight
+            scores[1] += weight * logprob
+            scores[2] += weight * logprob * logprob
+        else:
+            assert assigned_rows[row_id]
+            jit_remove_row(
+                ragged_index,
+                cells,
+                counts,
+                weights[row_id],
+                tree_grid,
+                assignments[row_id, :],
+                vert_ss,
+                edge_ss,
+                feat_ss,
+                meas_ss,
+                pair_ss,
+                vert_probs,
+                edge_probs,
+                feat_probs,
+                meas_probs, )
+            assigned_rows[row_id] = False
+
+
+@jit(nopython=True, parallel=True, cache=True)
+def jit_sample_assignments(
+        ragged_index,
+        data_dense,
+        data_indptr,
+        data_cells,
+        data_counts,
+        weights,
+        schedule,
+        row_ids,
+        noise,
+        proposals,
+        log_vert_probs,
+        edge_trans,
+        log_edge_trans,
+        log_feat_probs, ):
+    """Propose latent assignments of many rows in parallel given parameters.
+
+    Each row is sampled independently by filtering inward along the
+    schedule and then sampling outward from the root. A row of weight w is
+    sampled with probability proportional to the wth power of its
+    likelihood. Proposals are accepted or rejected by
+    jit_accept_assignments().
+
+    Args:
+      weights: An [N]-shaped array of integer row multiplicities.
+      row_ids: A [B]-shaped array of ids of rows to resample.
+      noise: A [B, V]-shaped array of uniform random numbers in [0, 1).
+      proposals: A [B, V]-shaped output array of proposed assignments.
+      log_vert_probs: A [V, M]-shaped array of log latent marginals.
+      edge_trans: An [E, M, M]-shaped array of latent pair probabilities
+        divided by both latent marginals.
+      log_edge_trans: The log of edge_trans.
+      log_feat_probs: An [R, M]-shaped array of log probabilities of
+        features given latents.
+    """
+    V, M = log_vert_probs.shape
+    for b in prange(len(row_ids)):
+        row_id = row_ids[b]
+        w = weights[row_id]
+        cells, counts = jit_get_row(data_dense, data_indptr, data_cells,
+                                    data_counts, row_id)
+        messages = np.empty((V, M), np.float64)
+        logits = np.empty(M, np.float64)
+        for i in xrange(len(schedule)):
+            op, v, v2, e = schedule[i]
+            message = messages[v, :]
+            if op == 0:  # OP_UP
+                # Propagate upward from observed to latent.
+                beg = np.searchsorted(cells, ragged_index[v])
+                end = np.searchsorted(cells, ragged_index[v + 1])
+                for m in xrange(M):
+                    logit = log_vert_probs[v, m]
+                    for j in xrange(beg, end):
+                        logit += counts[j] * log_feat_probs[cells[j], m]
+                    message[m] = w * logit
+                message[:] = np.exp(message - message.max())
+            elif op == 1:  # OP_IN
+                # Propagate latent state inward from children to v.
+                if w == 1:
+                    trans = edge_trans[e, :, :]
+                    if v > v2:
+                        trans = trans.T
+                    message *= np.dot(trans, messages[v2, :])
+                else:
+                    # Raise trans to the wth power in log space.
+                    log_trans = log_edge_trans[e, :, :]
+                    if v > v2:
+                        log_trans = log_trans.T
+                    log_child = np.log(messages[v2, :])
+                    for m in xrange(M):
+                        terms = w * log_trans[m, :] + log_child
+                        shift = terms.max()
+                        logits[m] = shift + math.log(
+                            np.exp(terms - shift).sum())
+                    message *= np.exp(logits - logits.max())
+                message /= message.sum()  # For numerical stability only.
+            else:  # OP_ROOT or OP_OUT
+                if op == 3:  # OP_OUT
+                    # Propagate latent state outward from parent to v.
+                    log_trans = log_edge_trans[e, :, :]
+                    if v2 > v:
+                        log_trans = log_trans.T
+                    logits[:] = w * log_trans[proposals[b, v2], :]
+                    message *= np.exp(logits - logits.max())
+                u = noise[b, v] * message.sum()
+                m = 0
+                while m < M - 1:
+                    u -= message[m]
+                    if u < 0:
+                        break
+                    m += 1
+                proposals[b, v] = m
+
+
+@jit(nopython=True, cache=True)
+def jit_accept_assignments(row_ids, weights, proposals, noise, degrees,
+                           vert_prior, log_vert_probs, vert_ss, assignments):
+    """Accept or reject proposed assignments of each row in turn.
+
+    Each row is a Metropolis-Hastings step targeting the collapsed
+    posterior, where parameters are treated as auxiliary variables. Given
+    parameters, proposals differ from the collapsed posterior only in how
+    vertex marginals are shared among the deg(v) edges at each vertex v, so
+    the acceptance ratio depends only on vertex sufficient statistics.
+
+    Args:
+      row_ids: A [B]-shaped array of ids of rows to update.
+      weights: An [N]-shaped array of integer row multiplicities.
+      proposals: A [B, V]-shaped array of proposed assignments.
+      noise: A [B]-shaped array of uniform random numbers in [0, 1).
+      degrees: A [V]-shaped array of vertex degrees in the tree.
+      vert_prior: The Dirichlet prior of vertex sufficient statistics.
+      log_vert_probs: A [V, M]-shaped array of log latent marginals, as used
+        to propose.
+      vert_ss: A [V, M]-shaped array of vertex sufficient statistics, which
+        is updated in place.
+      assignments: An [N, V]-shaped array of assignments, which is updated
+        in place.
+
+    Returns:
+      The number of accepted rows.
+    """
+    V = vert_ss.shape[0]
+    num_accepted = 0
+    for b in xrange(len(row_ids)):
+        row_id = row_ids[b]
+        w = weights[row_id]
+        log_accept = 0.0
+        for v in xrange(V):
+            m1 = assignments[row_id, v]
+            m2 = proposals[b, v]
+            if m1 != m2 and degrees[v]:
+                ss1 = vert_ss[v, m1] + vert_prior
+                ss2 = vert_ss[v, m2] + vert_prior
+                log_accept += degrees[v] * (
+                    w * (log_vert_probs[v, m2] - log_vert_probs[v, m1]) +
+                    math.lgamma(ss1) - math.lgamma(ss1 - w) +
+                    math.lgamma(ss2) - math.lgamma(ss2 + w))
+        if log_accept >= 0 or noise[b] < math.exp(log_accept):
+            for v in xrange(V):
+                m1 = assignments[row_id, v]
+                m2 = proposals[b, v]
+                vert_ss[v, m1] -= w
+                vert_ss[v, m2] += w
+                assignments[row_id, v] = m2
+            num_accepted += 1
+    return num_accepted
 
 
 class TreeCatTrainer(object):
     """Class for training a TreeCat model."""
 
-    def __init__(self, ragged_index, data, config):
+    def __init__(self, ragged_index, data, config, weights=None):
         """Initialize a model in an unassigned state.
 
         Args:
           ragged_index: A [V+1]-shaped numpy array of indices into the ragged
             data array.
-          data: An [N, _]-shaped numpy array of ragged data, where the vth
-            column is stored in data[:, ragged_index[v]:ragged_index[v+1]].
+          data: An [N, _]-shaped numpy array or scipy.sparse matrix of
+            ragged data, where the vth column is stored in
+            data[:, ragged_index[v]:ragged_index[v+1]].
           config: A global config dict.
+          weights: An optional [N]-shaped numpy array of positive integer
+            row multiplicities, e.g. as returned by dedup_rows(). Each row
+            counts as that many copies, all sharing one latent assignment.
         """
-        logger.info('TreeCatTrainer of %d x %d data', data[0].shape[0],
-                    len(data))
+        logger.info('TreeCatTrainer of %d x %d data', data.shape[0],
+                    data.shape[1])
         ragged_index = np.asarray(ragged_index, np.int32)
-        data = np.asarray(data, np.int8)
+        if scipy.sparse.issparse(data):
+            data = make_sparse_data(data)
+        else:
+            data = np.asarray(data, np.int8)  # Avoids copying int8 memmaps.
         config = config.copy()
         V = len(ragged_index) - 1  # Number of features, i.e. vertices.
         N = data.shape[0]  # Number of rows.
-        assert V <= 32768, 'Invalid # features > 32768: {}'.format(V)
         assert len(data.shape) == 2
         assert data.shape[1] == ragged_index[-1]
+        if weights is None:
+            weights = np.ones(N, np.int32)
+        weights = np.asarray(weights, np.int32)
+        assert weights.shape == (N, )
+        assert np.all(weights > 0)
         self._data = data
+        self._data_arrays = split_data(data)
+        self._weights = weights
         self._config = config
         self._ragged_index = ragged_index
-        self._assigned_rows = set()
+        self._assigned_rows = np.zeros(N, dtype=np.bool_)
         self._assignments = np.zeros([N, V], dtype=np.int8)
         self._tree = TreeStructure(V)
         assert self._tree.num_vertices == V
-        self._schedule = make_propagation_schedule(self._tree.tree_grid)
+        self._schedule = self._tree.propagation_schedule()
 
         # These are useful dimensions to import into locals().
         E = V - 1  # Number of edges in the tree.
@@ -212,9 +1059,9 @@ class TreeCatTrainer(object):
         self._VEKM = (V, E, K, M)
 
         # Use Jeffreys priors.
-        self._vert_prior = 0.5
-        self._edge_prior = 0.5 / M
-        self._feat_prior = 0.5 / M
+        self._vert_prior = np.float32(0.5)
+        self._edge_prior = np.float32(0.5 / M)
+        self._feat_prior = np.float32(0.5 / M)
         self._meas_prior = self._feat_prior * np.array(
             [(ragged_index[v + 1] - ragged_index[v]) for v in range(V)],
             dtype=np.float32).reshape((V, 1))
@@ -225,25 +1072,76 @@ class TreeCatTrainer(object):
         self._feat_ss = np.zeros([self._ragged_index[-1], M], np.int32)
         self._meas_ss = np.zeros([V, M], np.int32)
 
+        # Pairwise counts for all K vertex pairs are optionally cached. This
+        # costs O(K M^2) memory and O(K) time per row, but makes tree
+        # sampling independent of the number of rows.
+        if config['learning_pair_cache']:
+            self._pair_ss = np.zeros([K, M, M], np.int32)
+        else:
+            self._pair_ss = np.zeros([0, M, M], np.int32)
+
+        # Probability tables are maintained incrementally alongside the
+        # sufficient statistics by jit_add_row() and jit_remove_row().
+        self._update_probs()
+
+        # This accumulates the (count, sum, sum of squares) of predictive
+        # log probabilities of added rows, for early stopping.
+        self._scores = np.zeros(3)
+
+        # This accumulates the (count, number changed) of assignments of
+        # re-added rows, for adaptive annealing.
+        self._seen_rows = np.zeros(N, dtype=np.bool_)
+        self._changes = np.zeros(2)
+
+        # This is the number of initially assigned rows after warm_start().
+        self._warm_start_rows = None
+
+        # Candidate edges for sample_tree() are lazily constructed and
+        # periodically refreshed, if enabled.
+        self._candidate_grid = None
+        self._candidate_age = 0
+
+    def _update_probs(self):
+        self._vert_probs = self._vert_ss.astype(np.float32) + self._vert_prior
+        self._edge_probs = self._edge_ss.astype(np.float32) + self._edge_prior
+        self._feat_probs = self._feat_ss.astype(np.float32) + self._feat_prior
+        self._meas_probs = self._meas_ss.astype(np.float32) + self._meas_prior
+
     def _update_tree(self):
         V, E, K, M = self._VEKM
-        assignments = self._assignments[sorted(self._assigned_rows), :]
-        for e, v1, v2 in self._tree.tree_grid.T:
-            self._edge_ss[e, :, :] = count_pairs(assignments, v1, v2, M)
-        self._schedule = make_propagation_schedule(self._tree.tree_grid)
+        if self._pair_ss.shape[0]:
+            for e, v1, v2 in self._tree.tree_grid.T:
+                k = find_complete_edge(v1, v2)
+                self._edge_ss[e, :, :] = self._pair_ss[k, :, :]
+        else:
+            assignments = self._assignments[self._assigned_rows, :]
+            weights = self._weights[self._assigned_rows]
+            for e, v1, v2 in self._tree.tree_grid.T:
+                self._edge_ss[e, :, :] = count_pairs(assignments, v1, v2, M,
+                                                     weights)
+        self._schedule = self._tree.propagation_schedule()
+        # This also resets any float rounding error accumulated in the
+        # incrementally updated probability tables.
+        self._update_probs()
 
     @profile
     def add_row(self, row_id):
+        """Add a row, sampling its latent assignments.
+
+        Returns:
+          The predictive log probability of the row given all other assigned
+          rows.
+        """
         logger.debug('TreeCatTrainer.add_row %d', row_id)
-        assert row_id not in self._assigned_rows, row_id
-        vert_probs = self._vert_ss.astype(np.float32) + self._vert_prior
-        edge_probs = self._edge_ss.astype(np.float32) + self._edge_prior
-        feat_probs = self._feat_ss.astype(np.float32) + self._feat_prior
-        meas_probs = self._meas_ss.astype(np.float32) + self._meas_prior
+        assert not self._assigned_rows[row_id], row_id
+        old_assignments = self._assignments[row_id, :].copy()
 
-        jit_add_row(
+        cells, counts = jit_get_row(*(self._data_arrays + (row_id, )))
+        logprob = jit_add_row(
             self._ragged_index,
-            self._data[row_id, :],
+            cells,
+            counts,
+            self._weights[row_id],
             self._tree.tree_grid,
             self._schedule,
             self._assignments[row_id, :],
@@ -251,55 +1149,315 @@ class TreeCatTrainer(object):
             self._edge_ss,
             self._feat_ss,
             self._meas_ss,
-            vert_probs,
-            edge_probs,
-            feat_probs,
-            meas_probs, )
+            self._pair_ss,
+            self._vert_probs,
+            self._edge_probs,
+            self._feat_probs,
+            self._meas_probs, )
 
-        self._assigned_rows.add(row_id)
+        self._assigned_rows[row_id] = True
+        weight = self._weights[row_id]
+        self._scores += (weight, weight * logprob, weight * logprob**2)
+        if self._seen_rows[row_id]:
+            changed = old_assignments != self._assignments[row_id, :]
+            self._changes += (changed.size, np.count_nonzero(changed))
+        self._seen_rows[row_id] = True
+        return logprob
 
     @profile
     def remove_row(self, row_id):
         logger.debug('TreeCatTrainer.remove_row %d', row_id)
-        assert row_id in self._assigned_rows, row_id
+        assert self._assigned_rows[row_id], row_id
 
+        cells, counts = jit_get_row(*(self._data_arrays + (row_id, )))
         jit_remove_row(
             self._ragged_index,
-            self._data[row_id, :],
+            cells,
+            counts,
+            self._weights[row_id],
             self._tree.tree_grid,
             self._assignments[row_id, :],
             self._vert_ss,
             self._edge_ss,
             self._feat_ss,
-            self._meas_ss, )
+            self._meas_ss,
+            self._pair_ss,
+            self._vert_probs,
+            self._edge_probs,
+            self._feat_probs,
+            self._meas_probs, )
 
-        self._assigned_rows.remove(row_id)
+        self._assigned_rows[row_id] = False
 
     @profile
-    def sample_tree(self):
-        logger.info('TreeCatTrainer.sample_tree given %d rows',
-                    len(self._assigned_rows))
+    def train_segment(self, actions):
+        """Run a fused segment of add_row and remove_row actions.
+
+        Args:
+          actions: An [S, 2]-shaped numpy array of (action code, row_id)
+            pairs as yielded by get_annealing_segments().
+        """
+        logger.debug('TreeCatTrainer.train_segment of %d actions',
+                     actions.shape[0])
+        row_ids = actions[actions[:, 0] == ACTION_ADD_ROW, 1]
+        seen_row_ids = row_ids[self._seen_rows[row_ids]]
+        old_assignments = self._assignments[seen_row_ids, :]
+        data_dense, data_indptr, data_cells, data_counts = self._data_arrays
+        jit_train_segment(
+            self._ragged_index,
+            data_dense,
+            data_indptr,
+            data_cells,
+            data_counts,
+            self._weights,
+            self._tree.tree_grid,
+            self._schedule,
+            self._assignments,
+            self._assigned_rows,
+            self._vert_ss,
+            self._edge_ss,
+            self._feat_ss,
+            self._meas_ss,
+            self._pair_ss,
+            self._vert_probs,
+            self._edge_probs,
+            self._feat_probs,
+            self._meas_probs,
+            actions,
+            self._scores, )
+        changed = old_assignments != self._assignments[seen_row_ids, :]
+        self._changes += (changed.size, np.count_nonzero(changed))
+        self._seen_rows[row_ids] = True
+
+    @profile
+    def sample_assignments(self):
+        """Resample the assignments of all assigned rows in parallel.
+
+        This is a Metropolis-Hastings sweep for the current tree.
+        Parameters are sampled from their posterior given the sufficient
+        statistics, then every row is proposed independently given those
+        parameters, in parallel. Each proposal is accepted or rejected in
+        turn so as to target the exact collapsed posterior, and finally the
+        sufficient statistics are recomputed in bulk.
+
+        Returns:
+          The fraction of assigned cells whose assignment changed.
+        """
+        logger.info('TreeCatTrainer.sample_assignments of %d rows',
+                    self._assigned_rows.sum())
+        V, E, K, M = self._VEKM
+        ragged_index = self._ragged_index
+
+        # Sample parameters.
+        vert_probs = sample_dirichlet(self._vert_ss + self._vert_prior)
+        edge_probs = sample_dirichlet(
+            (self._edge_ss + self._edge_prior).reshape((E, M * M)))
+        edge_trans = edge_probs.reshape((E, M, M))
+        for e, v1, v2 in self._tree.tree_grid.T:
+            edge_trans[e, :, :] /= vert_probs[v1, :, np.newaxis]
+            edge_trans[e, :, :] /= vert_probs[v2, np.newaxis, :]
+        feat_probs = np.empty(self._feat_ss.shape, np.float64)
+        for v in range(V):
+            beg, end = ragged_index[v:v + 2]
+            feat_probs[beg:end, :] = sample_dirichlet(
+                (self._feat_ss[beg:end, :] + self._feat_prior).T).T
+        log_vert_probs = np.log(vert_probs)
+        log_edge_trans = np.log(edge_trans)
+        log_feat_probs = np.log(feat_probs)
+
+        # Propose assignments in parallel, then accept or reject each row.
+        data_dense, data_indptr, data_cells, data_counts = self._data_arrays
+        set_num_threads(self._config['learning_num_threads'])
+        row_ids = np.flatnonzero(self._assigned_rows).astype(np.int32)
+        degrees = np.bincount(
+            self._tree.tree_grid[1:, :].reshape(-1), minlength=V)
+        vert_ss = self._vert_ss.astype(np.float64)
+        num_changed = 0
+        num_accepted = 0
+        for pos in range(0, len(row_ids), SAMPLE_ASSIGNMENTS_BLOCK_SIZE):
+            block = row_ids[pos:pos + SAMPLE_ASSIGNMENTS_BLOCK_SIZE]
+            noise = np.random.random((len(block), V + 1))
+            proposals = np.empty((len(block), V), np.int8)
+            old_assignments = self._assignments[block, :]
+            jit_sample_assignments(
+                ragged_index,
+                data_dense,
+                data_indptr,
+                data_cells,
+                data_counts,
+                self._weights,
+                self._schedule,
+                block,
+                noise[:, :V],
+                proposals,
+                log_vert_probs,
+                edge_trans,
+                log_edge_trans,
+                log_feat_probs, )
+            num_accepted += jit_accept_assignments(
+                block, self._weights, proposals, noise[:, V], degrees,
+                self._vert_prior, log_vert_probs, vert_ss, self._assignments)
+            num_changed += np.count_nonzero(
+                old_assignments != self._assignments[block, :])
+        logger.info('TreeCatTrainer.sample_assignments accepted %d of %d rows',
+                    num_accepted, len(row_ids))
+
+        self._update_suffstats()
+        return num_changed / max(1.0, float(len(row_ids) * V))
+
+    def _update_suffstats(self):
+        """Recompute all sufficient statistics from assigned rows."""
+        V, E, K, M = self._VEKM
+        R = self._ragged_index[-1]
+        assignments = self._assignments[self._assigned_rows, :]
+        weights = self._weights[self._assigned_rows]
+        for v in range(V):
+            self._vert_ss[v, :] = np.bincount(
+                assignments[:, v], weights, minlength=M)
+        for e, v1, v2 in self._tree.tree_grid.T:
+            self._edge_ss[e, :, :] = count_pairs(assignments, v1, v2, M,
+                                                 weights)
+        if self._pair_ss.shape[0]:
+            for k, v1, v2 in self._tree.complete_grid.T:
+                self._pair_ss[k, :, :] = count_pairs(assignments, v1, v2, M,
+                                                     weights)
+        rows, cells, counts = find_sparse_cells(self._data)
+        assigned = self._assigned_rows[rows]
+        rows, cells, counts = rows[assigned], cells[assigned], counts[assigned]
+        verts = np.searchsorted(self._ragged_index, cells, 'right') - 1
+        clusters = self._assignments[rows, verts]
+        counts = counts * self._weights[rows]
+        self._feat_ss[...] = np.bincount(
+            cells * M + clusters, counts, minlength=R * M).reshape((R, M))
+        self._meas_ss[...] = np.bincount(
+            verts * M + clusters, counts, minlength=V * M).reshape((V, M))
+        self._update_probs()
+
+    def _get_edge_columns(self, max_rows=None):
+        """Get transposed assignments and weights of rows to score edges.
+
+        To bound the cost of scoring edges, this optionally takes a uniform
+        random subsample of at most max_rows assigned rows, with weights
+        rescaled to preserve the total count.
+
+        Args:
+          max_rows: An optional maximum number of rows, or 0 for all rows.
+            Defaults to config['learning_sample_tree_rows'].
+
+        Returns:
+          A pair (columns, weights) of a [V, _]-shaped contiguous array of
+          assignments and an array of row weights.
+        """
+        row_ids = np.flatnonzero(self._assigned_rows)
+        weights = self._weights[row_ids]
+        if max_rows is None:
+            max_rows = self._config['learning_sample_tree_rows']
+        if 0 < max_rows < len(row_ids):
+            subsample = np.sort(
+                np.random.choice(len(row_ids), max_rows, replace=False))
+            total = float(weights.sum())
+            row_ids = row_ids[subsample]
+            weights = weights[subsample] * (total / weights[subsample].sum())
+        columns = np.ascontiguousarray(self._assignments[row_ids, :].T)
+        return columns, weights
+
+    def _get_candidate_grid(self):
+        """Get the graph of edges that sample_tree() may choose from.
+
+        If config['learning_sample_tree_candidates'] is positive, this is a
+        sparse graph of the current tree plus that many top-scoring neighbors
+        of each vertex, refreshed every
+        config['learning_sample_tree_refresh'] tree samples. Neighbors are
+        found from a subsample of at most
+        config['learning_sample_tree_candidate_rows'] rows, since they need
+        only be approximate; among many vertices, pairs are further pruned
+        by hashing before exact scoring, see find_candidate_edges().
+        sample_tree() then scores candidate edges on the usual rows.
+        Otherwise this is the complete graph.
+
+        Returns:
+          A 3 x K array of (edge, vertex, vertex) triples, or None to denote
+          an implicit complete graph.
+        """
+        V, E, K, M = self._VEKM
+        num_candidates = self._config['learning_sample_tree_candidates']
+        if not 0 < num_candidates < V - 1:
+            return None
+        refresh = self._config['learning_sample_tree_refresh']
+        if self._candidate_grid is None or self._candidate_age >= refresh:
+            logger.info('TreeCatTrainer finding %d candidate edges per vertex',
+                        num_candidates)
+            max_rows = self._config['learning_sample_tree_candidate_rows']
+            if self._config['learning_sample_tree_rows'] > 0:
+                max_rows = min(max_rows or np.inf,
+                               self._config['learning_sample_tree_rows'])
+            columns, weights = self._get_edge_columns(max_rows)
+            vertex_logits = logprob_dc(
+                self._vert_ss + self._vert_prior, axis=1)
+            set_num_threads(self._config['learning_num_threads'])
+            neighbors = find_candidate_edges(
+                columns, weights, vertex_logits, self._edge_prior, M,
+                num_candidates)
+            edges = [tuple(edge) for edge in self._tree.tree_grid[1:3, :].T]
+            self._candidate_grid = make_candidate_graph(V, neighbors, edges)
+            self._candidate_age = 0
+        self._candidate_age += 1
+        return self._candidate_grid
+
+    @profile
+    def compute_edge_logits(self, grid=None):
+        """Compute non-normalized logprob of graph edges.
+
+        Args:
+          grid: An optional 3 x K array of (edge, vertex, vertex) triples.
+            Defaults to an implicit complete graph.
+
+        Returns:
+          A [K]-shaped numpy array of edge logits.
+        """
         V, E, K, M = self._VEKM
-        assignments = self._assignments[sorted(self._assigned_rows), :]
         vertex_logits = logprob_dc(self._vert_ss + self._vert_prior, axis=1)
-        edge_logits = np.zeros([K], np.float32)
-        for k, v1, v2 in self._tree.tree_grid.T:
-            counts = count_pairs(assignments, v1, v2, M)
-            # This is the most expensive part of tree sampling:
-            edge_logits[k] = (logprob_dc(counts + self._edge_prior) -
-                              vertex_logits[v1] - vertex_logits[v2])
+        if self._pair_ss.shape[0]:
+            if grid is None:
+                grid = self._tree.complete_grid
+            v1 = grid[1, :].astype(np.int64)
+            v2 = grid[2, :].astype(np.int64)
+            pair_ss = self._pair_ss[v1 + v2 * (v2 - 1) // 2]
+            edge_logits = logprob_dc(pair_ss + self._edge_prior, axis=(1, 2))
+            edge_logits -= vertex_logits[grid[1, :]]
+            edge_logits -= vertex_logits[grid[2, :]]
+            return edge_logits.astype(np.float32)
+        if grid is None:
+            grid = np.zeros([3, 0], np.int32)
+        # This is the most expensive part of tree sampling.
+        columns, weights = self._get_edge_columns()
+        set_num_threads(self._config['learning_num_threads'])
+        return jit_compute_edge_logits(columns, weights, grid, vertex_logits,
+                                       self._edge_prior, M)
+
+    @profile
+    def sample_tree(self):
+        """Sample the tree structure given current assignments.
+
+        Returns:
+          The number of edges that changed.
+        """
+        logger.info('TreeCatTrainer.sample_tree given %d rows',
+                    self._assigned_rows.sum())
+        grid = self._get_candidate_grid()
+        edge_logits = self.compute_edge_logits(grid)
 
         # Sample the tree.
-        complete_grid = self._tree.complete_grid
-        assert edge_logits.shape[0] == complete_grid.shape[1]
         edges = [tuple(edge) for edge in self._tree.tree_grid[1:3, :].T]
+        old_edges = set(edges)
         edges = sample_tree(
-            complete_grid,
+            grid,
             edge_logits,
             edges,
             steps=self._config['learning_sample_tree_steps'])
         self._tree.set_edges(edges)
         self._update_tree()
+        return len(old_edges.difference(edges))
 
     def logprob(self):
         """Compute non-normalized log probability of data and assignments.
@@ -307,7 +1465,7 @@ class TreeCatTrainer(object):
         This is mainly useful for testing goodness of fit of the category
         kernel.
         """
-        assert len(self._assigned_rows) == self._assignments.shape[0]
+        assert self._assigned_rows.all()
         V, E, K, M = self._VEKM
         vertex_logits = logprob_dc(self._vert_ss + self._vert_prior, axis=1)
         logprob = vertex_logits.sum()
@@ -322,14 +1480,101 @@ class TreeCatTrainer(object):
 
     def finish(self):
         logger.info('TreeCatTrainer.finish with %d rows',
-                    len(self._assigned_rows))
+                    self._assigned_rows.sum())
         self._tree.gc()
 
-    def train(self):
+    def save_checkpoint(self, filename, position, num_tree_samples,
+                        progress):
+        """Save training state to a file at a sample_tree boundary.
+
+        Args:
+          filename: The path of a .pkl.gz file to write.
+          position: The number of annealing schedule actions completed.
+          num_tree_samples: The number of sample_tree actions completed.
+          progress: A dict of training progress with keys
+            'early_stopping', a state dict as updated by
+            update_early_stopping(), and 'schedule_stats', a list of the
+            stats dicts fed to the annealing schedule after each tree sample.
+        """
+        logger.info('TreeCatTrainer.save_checkpoint %s', filename)
+        checkpoint = {
+            'config': self._config,
+            'position': position,
+            'num_tree_samples': num_tree_samples,
+            'progress': progress,
+            'tree_grid': self._tree.tree_grid,
+            'assignments': self._assignments,
+            'assigned_rows': np.packbits(self._assigned_rows),
+            'seen_rows': np.packbits(self._seen_rows),
+            'candidate_grid': self._candidate_grid,
+            'candidate_age': self._candidate_age,
+            'suffstats': {
+                'vert_ss': self._vert_ss,
+                'edge_ss': self._edge_ss,
+                'feat_ss': self._feat_ss,
+                'meas_ss': self._meas_ss,
+                'pair_ss': self._pair_ss,
+            },
+        }
+        # Write atomically, so that preemption cannot corrupt a checkpoint.
+        temp_filename = filename + '.temp'
+        pickle_dump(checkpoint, temp_filename)
+        os.rename(temp_filename, filename)
+
+    def load_checkpoint(self, filename):
+        """Restore training state saved by save_checkpoint().
+
+        Returns:
+          A tuple (position, num_tree_samples, progress).
+        """
+        logger.info('TreeCatTrainer.load_checkpoint %s', filename)
+        checkpoint = pickle_load(filename)
+        assert checkpoint['config'] == self._config, 'config mismatch'
+        N = self._assignments.shape[0]
+        assert checkpoint['assignments'].shape == self._assignments.shape
+        self._tree.set_edges(
+            [tuple(edge) for edge in checkpoint['tree_grid'][1:3, :].T])
+        self._schedule = self._tree.propagation_schedule()
+        self._assignments[...] = checkpoint['assignments']
+        self._assigned_rows[...] = np.unpackbits(
+            checkpoint['assigned_rows'])[:N].astype(np.bool_)
+        self._seen_rows[...] = np.unpackbits(
+            checkpoint['seen_rows'])[:N].astype(np.bool_)
+        self._candidate_grid = checkpoint['candidate_grid']
+        self._candidate_age = checkpoint['candidate_age']
+        suffstats = checkpoint['suffstats']
+        self._vert_ss[...] = suffstats['vert_ss']
+        self._edge_ss[...] = suffstats['edge_ss']
+        self._feat_ss[...] = suffstats['feat_ss']
+        self._meas_ss[...] = suffstats['meas_ss']
+        self._pair_ss[...] = suffstats['pair_ss']
+        self._update_probs()
+        return (checkpoint['position'], checkpoint['num_tree_samples'],
+                checkpoint['progress'])
+
+    def train(self, checkpoint=None):
         """Train a TreeCat model using subsample-annealed MCMC.
 
         Let N be the number of data rows and V be the number of features.
 
+        Args:
+          checkpoint: An optional path of a checkpoint file. If provided,
+            training state is saved after every
+            config['learning_checkpoint_period'] tree samples, and training
+            resumes from this file if it already exists. Resumed training
+            yields exactly the same model as uninterrupted training.
+            The annealing schedule is chosen by
+            config['learning_annealing_schedule'], either 'linear' or
+            'adaptive'; see get_adaptive_annealing_schedule().
+            If config['learning_early_stopping_patience'] is positive,
+            annealing stops early once the predictive score and tree have
+            plateaued, and all remaining rows are added in a final pass.
+            After warm_start(), the annealing schedule is replaced by the
+            shorter get_warm_start_schedule().
+            Finally config['learning_parallel_sweeps'] sweeps of
+            sample_assignments() refine all rows in parallel for the final
+            tree.
+
         Returns:
           A trained model as a dictionary with keys:
             tree: A TreeStructure instance with the learned latent structure.
@@ -341,17 +1586,187 @@ class TreeCatTrainer(object):
         logger.info('train()')
         set_random_seed(self._config['seed'])
         num_rows = self._assignments.shape[0]
-        for action, row_id in get_annealing_schedule(num_rows, self._config):
+        stats = {'tree_churn': 1.0, 'assignment_change': 1.0}
+        schedule_type = self._config['learning_annealing_schedule']
+        if self._warm_start_rows is not None:
+            schedule = get_warm_start_schedule(
+                num_rows, self._warm_start_rows, self._config)
+        elif schedule_type == 'linear':
+            schedule = get_annealing_schedule(num_rows, self._config)
+        elif schedule_type == 'adaptive':
+            schedule = get_adaptive_annealing_schedule(num_rows, self._config,
+                                                       stats)
+        else:
+            raise ValueError('Invalid learning_annealing_schedule: {}'.format(
+                schedule_type))
+        position = 0
+        num_tree_samples = 0
+        progress = {
+            'early_stopping': make_early_stopping(),
+            'schedule_stats': [],
+        }
+        if checkpoint is not None and os.path.exists(checkpoint):
+            position, num_tree_samples, progress = self.load_checkpoint(
+                checkpoint)
+            # Consume completed actions before reseeding, replaying the
+            # stats that were fed to the schedule after each tree sample.
+            schedule_stats = iter(progress['schedule_stats'])
+            for action, arg in itertools.islice(schedule, position):
+                if action == 'sample_tree':
+                    stats.update(next(schedule_stats))
+            set_random_seed(
+                _checkpoint_seed(self._config['seed'], num_tree_samples))
+        early_stopping = progress['early_stopping']
+        if self._config['learning_fused_segments']:
+            schedule = get_annealing_segments(schedule)
+        for action, arg in schedule:
+            if early_stopping['converged']:
+                break
             if action == 'add_row':
                 art_logger('+')
-                self.add_row(row_id)
+                self.add_row(arg)
+                position += 1
             elif action == 'remove_row':
                 art_logger('-')
-                self.remove_row(row_id)
+                self.remove_row(arg)
+                position += 1
+            elif action == 'segment':
+                art_logger('*')
+                self.train_segment(arg)
+                position += arg.shape[0]
             else:
                 art_logger('\n')
+                churn = self.sample_tree()
+                position += 1
+                num_tree_samples += 1
+                churn /= max(1.0, float(self._tree.num_edges))
+                update_early_stopping(early_stopping, self._scores, churn,
+                                      self._config)
+                self._scores[:] = 0.0
+                stats['tree_churn'] = churn
+                if self._changes[0]:
+                    stats['assignment_change'] = (
+                        self._changes[1] / self._changes[0])
+                self._changes[:] = 0.0
+                progress['schedule_stats'].append(stats.copy())
+                if checkpoint is not None:
+                    # Reseed so that resumed runs replay exactly.
+                    set_random_seed(
+                        _checkpoint_seed(self._config['seed'],
+                                         num_tree_samples))
+                    period = self._config['learning_checkpoint_period']
+                    if (early_stopping['converged'] or
+                            num_tree_samples % period == 0):
+                        self.save_checkpoint(checkpoint, position,
+                                             num_tree_samples, progress)
+        if early_stopping['converged']:
+            logger.info('Stopping early after %d tree samples',
+                        num_tree_samples)
+            self._add_unassigned_rows()
+            if self._config['learning_sample_tree_steps'] > 0:
+                self.sample_tree()
+        for _ in range(self._config['learning_parallel_sweeps']):
+            art_logger('#')
+            self.sample_assignments()
+        self.finish()
+        return self._get_model()
+
+    def load_model(self, model):
+        """Initialize from a trained model, e.g. to add new rows.
+
+        Args:
+          model: A trained model as returned by train(), whose assignments
+            correspond to the first rows of this trainer's data. Any
+            remaining rows are left unassigned.
+        """
+        logger.info('TreeCatTrainer.load_model')
+        V, E, K, M = self._VEKM
+        assignments = model['assignments']
+        suffstats = model['suffstats']
+        N = assignments.shape[0]
+        assert N <= self._assignments.shape[0]
+        assert assignments.shape[1] == V
+        assert np.all(suffstats['ragged_index'] == self._ragged_index)
+        tree_grid = model['tree'].tree_grid
+        self._tree.set_edges([tuple(edge) for edge in tree_grid[1:3, :].T])
+        self._schedule = self._tree.propagation_schedule()
+        self._candidate_grid = None
+        self._assignments[:N, :] = assignments
+        self._assigned_rows[:] = False
+        self._assigned_rows[:N] = True
+        self._vert_ss[...] = suffstats['vert_ss']
+        self._edge_ss[...] = suffstats['edge_ss']
+        self._feat_ss[...] = suffstats['feat_ss']
+        self._meas_ss[...] = suffstats['meas_ss']
+        if self._pair_ss.shape[0]:
+            grid = self._tree.complete_grid
+            weights = self._weights[:N]
+            for k, v1, v2 in grid.T:
+                self._pair_ss[k, :, :] = count_pairs(assignments, v1, v2, M,
+                                                     weights)
+        self._update_probs()
+
+    def warm_start(self, model):
+        """Initialize from a model trained on similar data, e.g. to retrain.
+
+        This copies the tree and the assignments of overlapping rows, then
+        recomputes sufficient statistics from this trainer's data, so that
+        train() can refine the model with a short schedule.
+
+        Args:
+          model: A trained model with the same ragged_index and number of
+            clusters, whose assignments correspond to the first rows of
+            this trainer's data. Any remaining rows are left unassigned.
+        """
+        logger.info('TreeCatTrainer.warm_start')
+        V, E, K, M = self._VEKM
+        suffstats = model['suffstats']
+        assert np.all(suffstats['ragged_index'] == self._ragged_index)
+        assert suffstats['vert_ss'].shape == (V, M), 'model_num_clusters'
+        N = min(model['assignments'].shape[0], self._assignments.shape[0])
+        tree_grid = model['tree'].tree_grid
+        self._tree.set_edges([tuple(edge) for edge in tree_grid[1:3, :].T])
+        self._schedule = self._tree.propagation_schedule()
+        self._candidate_grid = None
+        self._assignments[:N, :] = model['assignments'][:N, :]
+        self._assigned_rows[:] = False
+        self._assigned_rows[:N] = True
+        self._seen_rows[:] = self._assigned_rows
+        self._update_suffstats()
+        self._warm_start_rows = N
+
+    def update(self):
+        """Incrementally add all unassigned rows to a loaded model.
+
+        New rows are added in random order, followed by
+        config['learning_update_tree_samples'] tree samples.
+
+        Returns:
+          An updated model in the same format as returned by train().
+        """
+        logger.info('update()')
+        set_random_seed(self._config['seed'])
+        self._add_unassigned_rows()
+        if self._config['learning_sample_tree_steps'] > 0:
+            for _ in range(self._config['learning_update_tree_samples']):
                 self.sample_tree()
         self.finish()
+        return self._get_model()
+
+    def _add_unassigned_rows(self):
+        """Add all unassigned rows in random order."""
+        row_ids = np.flatnonzero(~self._assigned_rows).astype(np.int32)
+        np.random.shuffle(row_ids)
+        if self._config['learning_fused_segments']:
+            actions = np.zeros([len(row_ids), 2], np.int32)
+            actions[:, 0] = ACTION_ADD_ROW
+            actions[:, 1] = row_ids
+            self.train_segment(actions)
+        else:
+            for row_id in row_ids:
+                self.add_row(row_id)
+
+    def _get_model(self):
         return {
             'config': self._config,
             'tree': self._tree,
@@ -366,7 +1781,12 @@ class TreeCatTrainer(object):
         }
 
 
-def train_model(ragged_index, data, config):
+def train_model(ragged_index,
+                data,
+                config,
+                checkpoint=None,
+                weights=None,
+                init_model=None):
     """Train a TreeCat model using subsample-annealed MCMC.
 
     Let N be the number of data rows and V be the number of features.
@@ -374,11 +1794,17 @@ def train_model(ragged_index, data, config):
     Args:
       ragged_index: A [V+1]-shaped numpy array of indices into the ragged
         data array.
-      data: An [N, _]-shaped numpy array of ragged data, where the vth
-        column is stored in data[:, ragged_index[v]:ragged_index[v+1]].
-      data: A list of numpy arrays, where each array is an N x _ column of
-        counts of multinomial data.
+      data: An [N, _]-shaped numpy array or scipy.sparse matrix of ragged
+        data, where the vth column is stored in
+        data[:, ragged_index[v]:ragged_index[v+1]].
       config: A global config dict.
+      checkpoint: An optional path of a checkpoint file to periodically save
+        to and to resume from, if it exists.
+      weights: An optional [N]-shaped numpy array of integer row
+        multiplicities, e.g. as returned by dedup_rows().
+      init_model: An optional model trained on similar data, to warm start
+        from. Its assignments should correspond to the first rows of data.
+        See TreeCatTrainer.warm_start().
 
     Returns:
       A trained model as a dictionary with keys:
@@ -388,28 +1814,130 @@ def train_model(ragged_index, data, config):
         assignments: An [N, V] numpy array of latent cluster ids for each
           cell in the dataset.
     """
-    return TreeCatTrainer(ragged_index, data, config).train()
+    trainer = TreeCatTrainer(ragged_index, data, config, weights)
+    if init_model is not None:
+        trainer.warm_start(init_model)
+    return trainer.train(checkpoint)
+
+
+def update_model(model, data, weights=None):
+    """Incrementally update a trained TreeCat model with new rows of data.
+
+    This adds new rows to the model without retraining from scratch,
+    optionally followed by a few tree samples, as controlled by
+    config['learning_update_tree_samples'].
+
+    Args:
+      model: A trained model as returned by train_model(), which is not
+        modified.
+      data: An [N, _]-shaped numpy array of ragged data, whose first rows are
+        the rows on which the model was trained and whose remaining rows are
+        new.
+      weights: An optional [N]-shaped numpy array of integer row
+        multiplicities, which must agree with those used for training.
+
+    Returns:
+      An updated model in the same format as returned by train_model().
+    """
+    ragged_index = model['suffstats']['ragged_index']
+    trainer = TreeCatTrainer(ragged_index, data, model['config'], weights)
+    trainer.load_model(model)
+    return trainer.update()
+
+
+def _make_pool(processes=None):
+    # Avoid fork()ing a process whose parallel jit kernels have started a
+    # threading layer, which is not fork-safe.
+    get_context = getattr(multiprocessing, 'get_context', None)
+    if get_context is None or not is_threading_started():
+        return multiprocessing.Pool(processes)
+    return get_context('spawn').Pool(processes)
+
+
+def _share_array(array, dirname, name):
+    """Place an array in a memory-mapped file for zero-copy sharing.
+
+    Arrays that are already memory-mapped, e.g. via
+    np.load(filename, mmap_mode='r'), are shared from their own file.
+
+    Returns:
+      A picklable (filename, offset, dtype, shape) spec for _attach_array().
+    """
+    if (isinstance(array, np.memmap) and array.filename is not None and
+            array.flags.c_contiguous):
+        return (array.filename, array.offset, array.dtype.str, array.shape)
+    array = np.ascontiguousarray(array)
+    filename = os.path.join(dirname, name)
+    array.tofile(filename)
+    return (filename, 0, array.dtype.str, array.shape)
+
+
+def _attach_array(spec):
+    """Attach to an array shared by _share_array() without copying."""
+    filename, offset, dtype, shape = spec
+    if not np.prod(shape):
+        return np.zeros(shape, dtype)  # Empty files cannot be mapped.
+    return np.memmap(filename, dtype, 'r', offset, shape)
+
+
+def _share_data(data, dirname):
+    """Share dense or sparse data for zero-copy use by _attach_data().
+
+    Dense data is shared as a single array, so that a memory-mapped input
+    file reaches workers without being copied or converted; sparse data is
+    shared as its three CSR arrays.
+    """
+    if not scipy.sparse.issparse(data):
+        return _share_array(np.asanyarray(data, np.int8), dirname, 'data')
+    data = make_sparse_data(data)
+    return (data.shape, (
+        _share_array(data.indptr, dirname, 'indptr'),
+        _share_array(data.indices, dirname, 'indices'),
+        _share_array(data.data, dirname, 'data'), ))
+
+
+def _attach_data(spec):
+    """Attach to data shared by _share_data() without copying."""
+    if len(spec) == 4:
+        return _attach_array(spec)
+    shape, specs = spec
+    indptr, indices, counts = map(_attach_array, specs)
+    return scipy.sparse.csr_matrix((counts, indices, indptr), shape)
 
 
 def _train_model(task):
-    ragged_index, data, config = task
-    return train_model(ragged_index, data, config)
+    ragged_index, data_spec, weights_spec, config, init_model = task
+    data = _attach_data(data_spec)
+    weights = _attach_array(weights_spec)
+    return train_model(
+        ragged_index, data, config, weights=weights, init_model=init_model)
 
 
-def train_ensemble(ragged_index, data, config):
+def train_ensemble(ragged_index,
+                   data,
+                   config,
+                   weights=None,
+                   init_ensemble=None):
     """Train a TreeCat ensemble model using subsample-annealed MCMC.
 
     The ensemble size is controlled by config['model_ensemble_size'].
+    Members are trained in parallel by a pool of at most
+    config['learning_num_processes'] processes (0 means one per core), which
+    share a single read-only memory-mapped copy of the data. Dense data stays
+    dense, so a memory-mapped input array is shared from its own file.
     Let N be the number of data rows and V be the number of features.
 
     Args:
       ragged_index: A [V+1]-shaped numpy array of indices into the ragged
         data array.
-      data: An [N, _]-shaped numpy array of ragged data, where the vth
-        column is stored in data[:, ragged_index[v]:ragged_index[v+1]].
-      data: A list of numpy arrays, where each array is an N x _ column of
-        counts of multinomial data.
+      data: An [N, _]-shaped numpy array or scipy.sparse matrix of ragged
+        data, where the vth column is stored in
+        data[:, ragged_index[v]:ragged_index[v+1]].
       config: A global config dict.
+      weights: An optional [N]-shaped numpy array of integer row
+        multiplicities, e.g. as returned by dedup_rows().
+      init_ensemble: An optional ensemble trained on similar data, to warm
+        start from. Member i is warm started from init_ensemble[i % size].
 
     Returns:
       A trained model as a dictionary with keys:
@@ -419,9 +1947,31 @@ def train_ensemble(ragged_index, data, config):
         assignments: An [N, V] numpy array of latent cluster ids for each
           cell in the dataset.
     """
-    tasks = []
-    for sub_seed in range(config['model_ensemble_size']):
-        sub_config = config.copy()
-        sub_config['seed'] += sub_seed
-        tasks.append((ragged_index, data, sub_config))
-    return multiprocessing.Pool().map(_train_model, tasks)
+    ragged_index = np.asarray(ragged_index, np.int32)
+    size = config['model_ensemble_size']
+    processes = min(size, config['learning_num_processes'] or
+                    multiprocessing.cpu_count())
+    dirname = tempfile.mkdtemp()
+    try:
+        data_spec = _share_data(data, dirname)
+        if weights is None:
+            weights = np.ones(data.shape[0], np.int32)
+        weights_spec = _share_array(
+            np.asarray(weights, np.int32), dirname, 'weights')
+        tasks = []
+        for sub_seed in range(size):
+            sub_config = config.copy()
+            sub_config['seed'] += sub_seed
+            init_model = None
+            if init_ensemble:
+                init_model = init_ensemble[sub_seed % len(init_ensemble)]
+            tasks.append((ragged_index, data_spec, weights_spec, sub_config,
+                          init_model))
+        pool = _make_pool(processes)
+        try:
+            return pool.map(_train_model, tasks)
+        finally:
+            pool.close()
+            pool.join()
+    finally:
+        shutil.rmtree(dirname)
@@ -2,24 +2,133 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import itertools
+import math
+import os
+
 import numpy as np
 import pytest
+import scipy.sparse
 from goftests import multinomial_goodness_of_fit
 
 from treecat.config import make_default_config
 from treecat.generate import generate_dataset
 from treecat.structure import TreeStructure
+from treecat.structure import make_complete_graph
 from treecat.testutil import TINY_CONFIG
 from treecat.testutil import numpy_seterr
+from treecat.testutil import tempdir
 from treecat.training import TreeCatTrainer
+from treecat.training import _attach_data
+from treecat.training import _make_pool
+from treecat.training import _share_data
+from treecat.training import count_pairs
+from treecat.training import find_candidate_edges
+from treecat.training import get_adaptive_annealing_schedule
 from treecat.training import get_annealing_schedule
+from treecat.training import get_annealing_segments
+from treecat.training import get_warm_start_schedule
+from treecat.training import jit_compute_edge_logits
+from treecat.training import logprob_dc
+from treecat.training import make_early_stopping
 from treecat.training import train_ensemble
 from treecat.training import train_model
+from treecat.training import update_early_stopping
+from treecat.training import update_model
+from treecat.util import dedup_rows
 from treecat.util import set_random_seed
 
 numpy_seterr()
 
 
+@pytest.mark.parametrize('N,V,M', [
+    (1, 2, 2),
+    (10, 3, 2),
+    (10, 5, 3),
+    (100, 7, 8),
+])
+def test_jit_compute_edge_logits(N, V, M):
+    set_random_seed(0)
+    assignments = np.random.randint(M, size=(N, V)).astype(np.int8)
+    grid = make_complete_graph(V)
+    vertex_logits = np.random.random(V)
+    edge_prior = 0.5 / M
+    columns = np.ascontiguousarray(assignments.T)
+    weights = np.ones(N, np.int32)
+    actual = jit_compute_edge_logits(columns, weights, grid, vertex_logits,
+                                     edge_prior, M)
+    assert actual.shape == (grid.shape[1], )
+    implicit = jit_compute_edge_logits(columns, weights,
+                                       np.zeros([3, 0], np.int32),
+                                       vertex_logits, edge_prior, M)
+    assert np.all(implicit == actual)
+    for k, v1, v2 in grid.T:
+        counts = count_pairs(assignments, v1, v2, M)
+        expected = (logprob_dc(counts + edge_prior) - vertex_logits[v1] -
+                    vertex_logits[v2])
+        assert actual[k] == pytest.approx(expected, rel=1e-5, abs=1e-5)
+
+
+@pytest.mark.parametrize('V', [20, 2000])
+def test_find_candidate_edges_twins(V):
+    set_random_seed(0)
+    N = 200
+    M = 4
+    num_candidates = 2
+    half = V // 2
+    columns = np.random.randint(M, size=(half, N)).astype(np.int8)
+    # Each vertex has a relabeled twin, which should be its best neighbor.
+    columns = np.concatenate([columns, (columns + 1) % M])
+    weights = np.ones(N, np.int32)
+    vertex_logits = np.zeros(V, np.float32)
+    edge_prior = 0.5 / M
+    neighbors = find_candidate_edges(columns, weights, vertex_logits,
+                                     edge_prior, M, num_candidates)
+    assert neighbors.shape == (V, num_candidates)
+    assert neighbors.dtype == np.int32
+    assert np.all(0 <= neighbors) and np.all(neighbors < V)
+    twins = (np.arange(V) + half) % V
+    assert np.mean(neighbors[:, 0] == twins) > 0.9
+
+
+def test_find_candidate_edges_constant():
+    set_random_seed(0)
+    V = 2000
+    N = 10
+    M = 2
+    columns = np.zeros([V, N], np.int8)
+    weights = np.ones(N, np.int32)
+    vertex_logits = np.zeros(V, np.float32)
+    neighbors = find_candidate_edges(columns, weights, vertex_logits, 0.25, M,
+                                     3)
+    assert neighbors.shape == (V, 3)
+    assert np.all(0 <= neighbors) and np.all(neighbors < V)
+
+
+@pytest.mark.parametrize('max_rows', [0, 1, 5, 20])
+def test_compute_edge_logits_subsample(max_rows):
+    config = make_default_config()
+    config['model_num_clusters'] = 3
+    config['learning_sample_tree_rows'] = max_rows
+    dataset = generate_dataset(num_rows=20, num_cols=4, num_cats=3)
+    ragged_index = dataset['ragged_index']
+    data = dataset['data']
+    weights = np.arange(1, 21, dtype=np.int32)
+    trainer = TreeCatTrainer(ragged_index, data, config, weights)
+    set_random_seed(0)
+    for row_id in range(20):
+        trainer.add_row(row_id)
+
+    # Rescaled counts of identical rows are exact for any subsample.
+    trainer._assignments[:, :] = [0, 1, 2, 1]
+    trainer._update_suffstats()
+    actual = trainer.compute_edge_logits()
+    config['learning_sample_tree_rows'] = 0
+    trainer._config = config
+    expected = trainer.compute_edge_logits()
+    np.testing.assert_allclose(actual, expected, rtol=1e-5)
+
+
 def test_get_annealing_schedule():
     set_random_seed(0)
     num_rows = 10
@@ -33,6 +142,95 @@ def test_get_annealing_schedule():
             assert 0 <= row_id and row_id < num_rows
 
 
+@pytest.mark.parametrize('assignment_change', [0.0, 0.1, 1.0])
+@pytest.mark.parametrize('tree_churn', [0.0, 1.0])
+def test_get_adaptive_annealing_schedule(tree_churn, assignment_change):
+    num_rows = 100
+    config = make_default_config()
+    config['learning_annealing_epochs'] = 10
+    set_random_seed(0)
+    expected = list(get_annealing_schedule(num_rows, config))
+    set_random_seed(0)
+    stats = {'tree_churn': 1.0, 'assignment_change': 1.0}
+    schedule = get_adaptive_annealing_schedule(num_rows, config, stats)
+    assigned = set()
+    actions = []
+    tree_sizes = []
+    for action, row_id in schedule:
+        actions.append((action, row_id))
+        if action == 'add_row':
+            assert row_id not in assigned
+            assigned.add(row_id)
+        elif action == 'remove_row':
+            assert row_id in assigned
+            assigned.remove(row_id)
+        else:
+            assert action == 'sample_tree'
+            tree_sizes.append(len(assigned))
+            stats['tree_churn'] = tree_churn
+            stats['assignment_change'] = assignment_change
+    assert assigned == set(range(num_rows))
+
+    # The tree keeps being sampled even if no assignment ever changes.
+    assert len(tree_sizes) > 1
+    assert tree_sizes[-1] > num_rows // 2
+
+    # Without adaptation, rows are added and removed as in the linear
+    # schedule, and the tree is sampled at least as often.
+    if tree_churn == 1.0 and assignment_change == 1.0:
+        rows = [a for a in actions if a[0] != 'sample_tree']
+        assert rows == [a for a in expected if a[0] != 'sample_tree']
+        assert len(actions) - len(rows) >= len(expected) - len(rows)
+    else:
+        assert len(actions) < len(expected)
+
+
+@pytest.mark.parametrize('num_init_rows', [0, 5, 10])
+def test_get_warm_start_schedule(num_init_rows):
+    set_random_seed(0)
+    num_rows = 10
+    config = make_default_config()
+    schedule = get_warm_start_schedule(num_rows, num_init_rows, config)
+    assigned = set(range(num_init_rows))
+    num_adds = 0
+    num_tree_samples = 0
+    for action, row_id in schedule:
+        if action == 'add_row':
+            assert row_id not in assigned
+            assigned.add(row_id)
+            num_adds += 1
+        elif action == 'remove_row':
+            assert row_id in assigned
+            assigned.remove(row_id)
+        else:
+            assert action == 'sample_tree'
+            assert row_id is None
+            num_tree_samples += 1
+    assert assigned == set(range(num_rows))
+    epochs = config['learning_warm_start_epochs']
+    assert num_adds == num_rows - num_init_rows + epochs * num_rows
+    assert num_tree_samples == epochs + (num_init_rows < num_rows)
+
+
+def test_get_annealing_segments():
+    set_random_seed(0)
+    num_rows = 10
+    expected = list(get_annealing_schedule(num_rows, TINY_CONFIG))
+    set_random_seed(0)
+    schedule = get_annealing_schedule(num_rows, TINY_CONFIG)
+    actual = []
+    for action, arg in get_annealing_segments(schedule):
+        assert action in ['segment', 'sample_tree']
+        if action == 'sample_tree':
+            actual.append((action, arg))
+        else:
+            assert arg.shape[1] == 2
+            for code, row_id in arg:
+                action = ['add_row', 'remove_row'][code]
+                actual.append((action, row_id))
+    assert actual == expected
+
+
 def validate_model(ragged_index, data, model, config):
     assert model['config'] == config
     assert isinstance(model['tree'], TreeStructure)
@@ -146,6 +344,590 @@ def test_train_ensemble(N, V, C, M):
         validate_model(ragged_index, data, model, sub_config)
 
 
+@pytest.mark.parametrize('N,V,C,M', [
+    (2, 2, 2, 2),
+    (5, 5, 5, 5),
+    (10, 4, 3, 7),
+])
+def test_train_fused_segments(N, V, C, M):
+    config = make_default_config()
+    config['model_num_clusters'] = M
+    config['learning_annealing_epochs'] = 5
+    dataset = generate_dataset(num_rows=N, num_cols=V, num_cats=C)
+    ragged_index = dataset['ragged_index']
+    data = dataset['data']
+    config['learning_fused_segments'] = False
+    expected = train_model(ragged_index, data, config)
+    config['learning_fused_segments'] = True
+    actual = train_model(ragged_index, data, config)
+    validate_model(ragged_index, data, actual, config)
+    assert actual['tree'] == expected['tree']
+    assert np.all(actual['assignments'] == expected['assignments'])
+
+
+@pytest.mark.parametrize('N,V,C,M', [
+    (2, 2, 2, 2),
+    (10, 4, 3, 7),
+    (100, 5, 3, 3),
+])
+def test_train_adaptive_schedule(N, V, C, M):
+    config = make_default_config()
+    config['model_num_clusters'] = M
+    config['learning_annealing_epochs'] = 5
+    config['learning_annealing_schedule'] = 'adaptive'
+    dataset = generate_dataset(num_rows=N, num_cols=V, num_cats=C)
+    ragged_index = dataset['ragged_index']
+    data = dataset['data']
+    model = train_model(ragged_index, data, config)
+    validate_model(ragged_index, data, model, config)
+
+
+@pytest.mark.parametrize('fused_segments', [False, True])
+@pytest.mark.parametrize('N,V,C,M', [
+    (2, 2, 2, 2),
+    (10, 4, 3, 7),
+])
+def test_train_sparse_data(N, V, C, M, fused_segments):
+    config = make_default_config()
+    config['model_num_clusters'] = M
+    config['learning_annealing_epochs'] = 5
+    config['learning_fused_segments'] = fused_segments
+    dataset = generate_dataset(num_rows=N, num_cols=V, num_cats=C, rate=0.3)
+    ragged_index = dataset['ragged_index']
+    data = dataset['data']
+    expected = train_model(ragged_index, data, config)
+    actual = train_model(ragged_index, scipy.sparse.csr_matrix(data), config)
+    validate_model(ragged_index, data, actual, config)
+    assert actual['tree'] == expected['tree']
+    assert np.all(actual['assignments'] == expected['assignments'])
+    for key, value in expected['suffstats'].items():
+        assert np.all(actual['suffstats'][key] == value)
+
+
+@pytest.mark.parametrize('fused_segments', [False, True])
+def test_train_large_counts(fused_segments):
+    config = make_default_config()
+    config['model_num_clusters'] = 4
+    config['learning_annealing_epochs'] = 5
+    config['learning_fused_segments'] = fused_segments
+    dataset = generate_dataset(num_rows=10, num_cols=4, num_cats=2, rate=50)
+    ragged_index = dataset['ragged_index']
+    data = dataset['data']
+    assert data.max() > 30
+    model = train_model(ragged_index, data, config)
+    validate_model(ragged_index, data, model, config)
+    trainer = TreeCatTrainer(ragged_index, data, config)
+    trainer.load_model(model)
+    assert np.isfinite(trainer.logprob())
+
+
+@pytest.mark.parametrize('fused_segments', [False, True])
+@pytest.mark.parametrize('N,V,C,M', [
+    (2, 2, 2, 2),
+    (20, 3, 2, 3),
+    (100, 4, 2, 4),
+])
+def test_train_weighted_data(N, V, C, M, fused_segments):
+    config = make_default_config()
+    config['model_num_clusters'] = M
+    config['learning_annealing_epochs'] = 5
+    config['learning_fused_segments'] = fused_segments
+    dataset = generate_dataset(num_rows=N, num_cols=V, num_cats=C, rate=0.5)
+    ragged_index = dataset['ragged_index']
+    data, weights, inverse = dedup_rows(dataset['data'])
+    assert weights.sum() == N
+    model = train_model(ragged_index, data, config, weights=weights)
+
+    # A weighted row should behave like many copies sharing an assignment.
+    model['assignments'] = np.repeat(model['assignments'], weights, axis=0)
+    validate_model(ragged_index, np.repeat(data, weights, axis=0), model,
+                   config)
+
+
+@pytest.mark.parametrize('count', [1, 2, 3])
+@pytest.mark.parametrize('N,V,C,M', [
+    (0, 1, 2, 2),
+    (5, 1, 3, 2),
+    (5, 2, 2, 3),
+    (5, 3, 2, 2),
+])
+def test_add_row_logprob_normalized(N, V, C, M, count):
+    config = make_default_config()
+    config['model_num_clusters'] = M
+    dataset = generate_dataset(num_rows=N, num_cols=V, num_cats=C)
+    ragged_index = dataset['ragged_index']
+
+    # Enumerate all possible rows, weighted by multinomial coefficients.
+    blocks = []
+    for block in itertools.product(range(count + 1), repeat=C):
+        if sum(block) == count:
+            coeff = math.factorial(count)
+            for c in block:
+                coeff //= math.factorial(c)
+            blocks.append((block, coeff))
+    rows = []
+    coeffs = []
+    for row in itertools.product(blocks, repeat=V):
+        rows.append(sum((block for block, _ in row), ()))
+        coeffs.append(np.prod([coeff for _, coeff in row]))
+    data = np.concatenate([dataset['data'], np.array(rows, np.int8)])
+
+    trainer = TreeCatTrainer(ragged_index, data, config)
+    set_random_seed(0)
+    for row_id in range(N):
+        trainer.add_row(row_id)
+    trainer.sample_tree()
+    total = 0.0
+    for row_id, coeff in enumerate(coeffs):
+        total += coeff * np.exp(trainer.add_row(N + row_id))
+        trainer.remove_row(N + row_id)
+    assert total == pytest.approx(1.0, rel=1e-4)
+
+
+@pytest.mark.parametrize('fused_segments', [False, True])
+@pytest.mark.parametrize('pair_cache', [False, True])
+@pytest.mark.parametrize('N,V,C,M', [
+    (2, 2, 2, 2),
+    (10, 4, 3, 7),
+    (100, 5, 3, 3),
+])
+def test_train_warm_start(N, V, C, M, pair_cache, fused_segments):
+    config = make_default_config()
+    config['model_num_clusters'] = M
+    config['learning_annealing_epochs'] = 5
+    config['learning_pair_cache'] = pair_cache
+    config['learning_fused_segments'] = fused_segments
+    dataset = generate_dataset(num_rows=N + 5, num_cols=V, num_cats=C)
+    ragged_index = dataset['ragged_index']
+    data = dataset['data']
+    init_model = train_model(ragged_index, data[:N, :], config)
+    init_assignments = init_model['assignments'].copy()
+
+    # Warm start from a model of fewer rows.
+    model = train_model(ragged_index, data, config, init_model=init_model)
+    validate_model(ragged_index, data, model, config)
+    assert np.all(init_model['assignments'] == init_assignments)
+
+    # Warm start from a model of more rows.
+    model = train_model(ragged_index, data[:2, :], config, init_model=model)
+    validate_model(ragged_index, data[:2, :], model, config)
+
+
+def test_train_ensemble_warm_start():
+    config = make_default_config()
+    config['model_num_clusters'] = 3
+    config['model_ensemble_size'] = 3
+    config['learning_annealing_epochs'] = 5
+    dataset = generate_dataset(num_rows=15, num_cols=4, num_cats=3)
+    ragged_index = dataset['ragged_index']
+    data = dataset['data']
+    init_ensemble = train_ensemble(ragged_index, data[:10, :], config)
+    ensemble = train_ensemble(
+        ragged_index, data, config, init_ensemble=init_ensemble[:2])
+    assert len(ensemble) == config['model_ensemble_size']
+    for sub_seed, model in enumerate(ensemble):
+        sub_config = config.copy()
+        sub_config['seed'] += sub_seed
+        validate_model(ragged_index, data, model, sub_config)
+
+
+@pytest.mark.parametrize('N,V,C,M', [
+    (2, 2, 2, 2),
+    (100, 5, 3, 3),
+])
+def test_train_sample_tree_rows(N, V, C, M):
+    config = make_default_config()
+    config['model_num_clusters'] = M
+    config['learning_annealing_epochs'] = 5
+    config['learning_sample_tree_rows'] = 10
+    dataset = generate_dataset(num_rows=N, num_cols=V, num_cats=C)
+    ragged_index = dataset['ragged_index']
+    data = dataset['data']
+    model = train_model(ragged_index, data, config)
+    validate_model(ragged_index, data, model, config)
+
+
+@pytest.mark.parametrize('pair_cache', [False, True])
+@pytest.mark.parametrize('num_candidates', [1, 3])
+@pytest.mark.parametrize('N,V,C,M', [
+    (2, 2, 2, 2),
+    (10, 12, 3, 4),
+    (100, 20, 2, 3),
+])
+def test_train_sample_tree_candidates(N, V, C, M, num_candidates,
+                                      pair_cache):
+    config = make_default_config()
+    config['model_num_clusters'] = M
+    config['learning_annealing_epochs'] = 5
+    config['learning_pair_cache'] = pair_cache
+    config['learning_sample_tree_candidates'] = num_candidates
+    config['learning_sample_tree_refresh'] = 3
+    dataset = generate_dataset(num_rows=N, num_cols=V, num_cats=C)
+    ragged_index = dataset['ragged_index']
+    data = dataset['data']
+    model = train_model(ragged_index, data, config)
+    validate_model(ragged_index, data, model, config)
+
+
+@pytest.mark.parametrize('tree_rows,candidate_rows,expected_rows', [
+    (0, 0, 100),
+    (0, 10, 10),
+    (20, 0, 20),
+    (20, 10, 10),
+    (5, 10, 5),
+])
+def test_candidate_grid_subsample(tree_rows, candidate_rows, expected_rows):
+    config = make_default_config()
+    config['model_num_clusters'] = 3
+    config['learning_sample_tree_rows'] = tree_rows
+    config['learning_sample_tree_candidates'] = 2
+    config['learning_sample_tree_candidate_rows'] = candidate_rows
+    dataset = generate_dataset(num_rows=100, num_cols=8, num_cats=3)
+    trainer = TreeCatTrainer(dataset['ragged_index'], dataset['data'], config)
+    set_random_seed(0)
+    for row_id in range(100):
+        trainer.add_row(row_id)
+
+    num_rows = []
+    get_edge_columns = trainer._get_edge_columns
+
+    def spy(*args):
+        columns, weights = get_edge_columns(*args)
+        num_rows.append(columns.shape[1])
+        return columns, weights
+
+    trainer._get_edge_columns = spy
+    trainer.sample_tree()
+    assert num_rows == [expected_rows, tree_rows or 100]
+
+
+@pytest.mark.parametrize('fused_segments', [False, True])
+@pytest.mark.parametrize('N,V,C,M', [
+    (1, 1, 1, 1),
+    (2, 2, 2, 2),
+    (10, 4, 3, 7),
+    (100, 5, 3, 3),
+])
+def test_train_parallel_sweeps(N, V, C, M, fused_segments):
+    config = make_default_config()
+    config['model_num_clusters'] = M
+    config['learning_annealing_epochs'] = 5
+    config['learning_fused_segments'] = fused_segments
+    config['learning_parallel_sweeps'] = 3
+    dataset = generate_dataset(num_rows=N, num_cols=V, num_cats=C)
+    ragged_index = dataset['ragged_index']
+    data, weights, inverse = dedup_rows(dataset['data'])
+    model = train_model(ragged_index, data, config, weights=weights)
+    model['assignments'] = np.repeat(model['assignments'], weights, axis=0)
+    validate_model(ragged_index, np.repeat(data, weights, axis=0), model,
+                   config)
+
+
+def test_sample_assignments_updates_probs():
+    config = make_default_config()
+    config['model_num_clusters'] = 5
+    config['learning_pair_cache'] = True
+    dataset = generate_dataset(num_rows=10, num_cols=4, num_cats=3, rate=2.0)
+    ragged_index = dataset['ragged_index']
+    data = dataset['data']
+    trainer = TreeCatTrainer(ragged_index, data, config)
+    set_random_seed(0)
+    for row_id in range(0, 10, 2):
+        trainer.add_row(row_id)
+    assignments = trainer._assignments.copy()
+    trainer.sample_assignments()
+    assert np.all(trainer._assignments[1::2] == assignments[1::2])
+    expected = TreeCatTrainer(ragged_index, data, config)
+    expected._tree = trainer._tree
+    expected._schedule = trainer._schedule
+    for row_id in range(0, 10, 2):
+        expected._assignments[row_id] = trainer._assignments[row_id]
+        expected._assigned_rows[row_id] = True
+    expected._update_suffstats()
+    for name in ['vert', 'edge', 'feat', 'meas', 'pair']:
+        ss = getattr(trainer, '_{}_ss'.format(name))
+        np.testing.assert_array_equal(ss, getattr(expected,
+                                                  '_{}_ss'.format(name)))
+    for name in ['vert', 'edge', 'feat', 'meas']:
+        ss = getattr(trainer, '_{}_ss'.format(name))
+        prior = getattr(trainer, '_{}_prior'.format(name))
+        probs = getattr(trainer, '_{}_probs'.format(name))
+        np.testing.assert_allclose(probs, ss + prior, rtol=1e-6)
+
+
+def test_trainer_probs_match_suffstats():
+    config = make_default_config()
+    config['model_num_clusters'] = 5
+    dataset = generate_dataset(num_rows=10, num_cols=4, num_cats=3, rate=2.0)
+    ragged_index = dataset['ragged_index']
+    data = dataset['data']
+    trainer = TreeCatTrainer(ragged_index, data, config)
+    set_random_seed(0)
+    for row_id in range(10):
+        trainer.add_row(row_id)
+    for row_id in range(0, 10, 2):
+        trainer.remove_row(row_id)
+    for row_id in range(0, 10, 4):
+        trainer.add_row(row_id)
+
+    for name in ['vert', 'edge', 'feat', 'meas']:
+        ss = getattr(trainer, '_{}_ss'.format(name))
+        prior = getattr(trainer, '_{}_prior'.format(name))
+        probs = getattr(trainer, '_{}_probs'.format(name))
+        assert probs.dtype == np.float32
+        np.testing.assert_allclose(probs, ss + prior, rtol=1e-6)
+
+
+@pytest.mark.parametrize('N,V,C,M', [
+    (2, 2, 2, 2),
+    (5, 5, 5, 5),
+    (10, 4, 3, 7),
+])
+def test_pair_cache(N, V, C, M):
+    config = make_default_config()
+    config['model_num_clusters'] = M
+    config['learning_annealing_epochs'] = 5
+    config['learning_pair_cache'] = True
+    dataset = generate_dataset(num_rows=N, num_cols=V, num_cats=C)
+    ragged_index = dataset['ragged_index']
+    data = dataset['data']
+    model = train_model(ragged_index, data, config)
+    validate_model(ragged_index, data, model, config)
+
+    # Check that cached edge logits agree with edge logits from scratch.
+    trainer = TreeCatTrainer(ragged_index, data, config)
+    for row_id in range(N):
+        trainer.add_row(row_id)
+    trainer.remove_row(0)
+    assignments = trainer._assignments[1:, :]
+    for k, v1, v2 in trainer._tree.complete_grid.T:
+        pairs = assignments[:, v1].astype(np.int32) * M + assignments[:, v2]
+        counts = np.bincount(pairs, minlength=M * M).reshape((M, M))
+        assert np.all(trainer._pair_ss[k, :, :] == counts)
+    expected = trainer.compute_edge_logits()
+    trainer._pair_ss = trainer._pair_ss[:0, :, :]
+    actual = trainer.compute_edge_logits()
+    assert actual.shape == expected.shape
+    np.testing.assert_allclose(actual, expected, rtol=1e-5)
+
+
+@pytest.mark.parametrize('num_processes', [0, 1, 2])
+def test_train_ensemble_memmap(num_processes):
+    config = make_default_config()
+    config['model_num_clusters'] = 3
+    config['model_ensemble_size'] = 3
+    config['learning_num_processes'] = num_processes
+    dataset = generate_dataset(num_rows=5, num_cols=4, num_cats=3)
+    ragged_index = dataset['ragged_index']
+    data = dataset['data']
+    with tempdir() as dirname:
+        filename = os.path.join(dirname, 'data.npy')
+        np.save(filename, data)
+        data = np.load(filename, mmap_mode='r')
+        ensemble = train_ensemble(ragged_index, data, config)
+
+        assert len(ensemble) == config['model_ensemble_size']
+        for sub_seed, model in enumerate(ensemble):
+            sub_config = config.copy()
+            sub_config['seed'] += sub_seed
+            validate_model(ragged_index, data, model, sub_config)
+
+
+def test_share_data_memmap_zero_copy():
+    dataset = generate_dataset(num_rows=5, num_cols=4, num_cats=3)
+    data = dataset['data'].astype(np.int8)
+    with tempdir() as dirname:
+        filename = os.path.join(dirname, 'data.npy')
+        np.save(filename, data)
+        data = np.load(filename, mmap_mode='r')
+        sharedir = os.path.join(dirname, 'shared')
+        os.mkdir(sharedir)
+        spec = _share_data(data, sharedir)
+        assert not os.listdir(sharedir)
+        actual = _attach_data(spec)
+        assert isinstance(actual, np.memmap)
+        assert os.path.samefile(actual.filename, filename)
+        assert np.all(actual == data)
+
+        trainer = TreeCatTrainer(dataset['ragged_index'], actual,
+                                 make_default_config())
+        assert np.shares_memory(trainer._data, actual)
+
+
+def test_make_pool_after_parallel_kernel():
+    config = make_default_config()
+    config['learning_parallel_sweeps'] = 2
+    dataset = generate_dataset(num_rows=5, num_cols=4, num_cats=3)
+    train_model(dataset['ragged_index'], dataset['data'], config)
+
+    pool = _make_pool(2)
+    try:
+        assert pool.map(abs, [-1, 2, -3]) == [1, 2, 3]
+    finally:
+        pool.close()
+        pool.join()
+
+
+class Preempted(Exception):
+    pass
+
+
+@pytest.mark.parametrize('sample_tree_candidates', [0, 1])
+@pytest.mark.parametrize('warm_start', [False, True])
+@pytest.mark.parametrize('annealing_schedule', ['linear', 'adaptive'])
+@pytest.mark.parametrize('early_stopping_patience', [0, 2])
+@pytest.mark.parametrize('fused_segments', [False, True])
+def test_train_resume_from_checkpoint(fused_segments, early_stopping_patience,
+                                      annealing_schedule, warm_start,
+                                      sample_tree_candidates):
+    config = make_default_config()
+    config['learning_sample_tree_candidates'] = sample_tree_candidates
+    config['learning_sample_tree_refresh'] = 2
+    config['learning_annealing_schedule'] = annealing_schedule
+    config['model_num_clusters'] = 3
+    config['learning_annealing_epochs'] = 5
+    config['learning_fused_segments'] = fused_segments
+    config['learning_early_stopping_patience'] = early_stopping_patience
+    config['learning_early_stopping_tol'] = 1.0
+    config['learning_early_stopping_churn'] = 1.0
+    dataset = generate_dataset(num_rows=20, num_cols=4, num_cats=3)
+    ragged_index = dataset['ragged_index']
+    data = dataset['data']
+    init_model = None
+    if warm_start:
+        init_model = train_model(ragged_index, data[:10, :], config)
+    with tempdir() as dirname:
+        filename = os.path.join(dirname, 'expected.pkl.gz')
+        expected = train_model(
+            ragged_index, data, config, filename, init_model=init_model)
+
+        # Simulate preemption after a few tree samples.
+        filename = os.path.join(dirname, 'actual.pkl.gz')
+        trainer = TreeCatTrainer(ragged_index, data, config)
+        if warm_start:
+            trainer.warm_start(init_model)
+        sample_tree = trainer.sample_tree
+        calls = []
+
+        def preemptible_sample_tree():
+            calls.append(None)
+            if len(calls) > 3:
+                raise Preempted()
+            return sample_tree()
+
+        trainer.sample_tree = preemptible_sample_tree
+        with pytest.raises(Preempted):
+            trainer.train(filename)
+        assert os.path.exists(filename)
+        actual = train_model(
+            ragged_index, data, config, filename, init_model=init_model)
+
+    validate_model(ragged_index, data, actual, config)
+    assert actual['tree'] == expected['tree']
+    assert np.all(actual['assignments'] == expected['assignments'])
+    for key, value in expected['suffstats'].items():
+        assert np.all(actual['suffstats'][key] == value)
+
+
+def test_update_early_stopping():
+    config = make_default_config()
+    config['learning_early_stopping_patience'] = 2
+    config['learning_early_stopping_tol'] = 0.01
+    config['learning_early_stopping_churn'] = 0.05
+
+    # Improving scores have not converged.
+    progress = make_early_stopping()
+    for score in range(-100, -80):
+        scores = np.array([1000.0, 1000.0 * score, 1000.0 * score**2])
+        update_early_stopping(progress, scores, 0.5, config)
+        assert not progress['converged']
+
+    # Noisy scores have not converged.
+    progress = make_early_stopping()
+    for _ in range(10):
+        scores = np.array([10.0, -1000.0, 200000.0])
+        update_early_stopping(progress, scores, 0.5, config)
+        assert not progress['converged']
+
+    # Decreasing churn has not converged.
+    progress = make_early_stopping()
+    scores = np.array([1000.0, -100000.0, 1000.0 * 100.0**2])
+    for churn in [0.9, 0.9, 0.5, 0.5, 0.1, 0.1]:
+        update_early_stopping(progress, scores, churn, config)
+        assert not progress['converged']
+
+    # Plateaued scores and churn have converged after a full window.
+    update_early_stopping(progress, scores, 0.1, config)
+    assert not progress['converged']
+    update_early_stopping(progress, scores, 0.1, config)
+    assert progress['converged']
+
+
+def count_tree_samples(ragged_index, data, config):
+    trainer = TreeCatTrainer(ragged_index, data, config)
+    sample_tree = trainer.sample_tree
+    calls = []
+
+    def counting_sample_tree():
+        calls.append(None)
+        return sample_tree()
+
+    trainer.sample_tree = counting_sample_tree
+    model = trainer.train()
+    validate_model(ragged_index, data, model, config)
+    return len(calls)
+
+
+@pytest.mark.parametrize('fused_segments', [False, True])
+def test_train_early_stopping(fused_segments):
+    config = make_default_config()
+    config['model_num_clusters'] = 3
+    config['learning_annealing_epochs'] = 5
+    config['learning_fused_segments'] = fused_segments
+    # Enough rows and columns for predictive scores to plateau before the
+    # annealing schedule ends.
+    dataset = generate_dataset(num_rows=2000, num_cols=16, num_cats=3)
+    ragged_index = dataset['ragged_index']
+    data = dataset['data']
+    expected = count_tree_samples(ragged_index, data, config)
+
+    # Strict thresholds must not stop early.
+    config['learning_early_stopping_patience'] = 2
+    config['learning_early_stopping_tol'] = 0.001
+    config['learning_early_stopping_churn'] = 0.0
+    actual = count_tree_samples(ragged_index, data, config)
+    assert actual == expected
+
+    # Realistic thresholds stop once scores plateau.
+    config['learning_early_stopping_tol'] = 0.05
+    config['learning_early_stopping_churn'] = 0.05
+    actual = count_tree_samples(ragged_index, data, config)
+    assert actual < expected
+
+
+@pytest.mark.parametrize('fused_segments', [False, True])
+@pytest.mark.parametrize('pair_cache', [False, True])
+@pytest.mark.parametrize('N,V,C,M', [
+    (2, 2, 2, 2),
+    (10, 4, 3, 7),
+])
+def test_update_model(N, V, C, M, pair_cache, fused_segments):
+    config = make_default_config()
+    config['model_num_clusters'] = M
+    config['learning_annealing_epochs'] = 5
+    config['learning_pair_cache'] = pair_cache
+    config['learning_fused_segments'] = fused_segments
+    dataset = generate_dataset(num_rows=N + 5, num_cols=V, num_cats=C)
+    ragged_index = dataset['ragged_index']
+    data = dataset['data']
+    model = train_model(ragged_index, data[:N, :], config)
+    old_assignments = model['assignments'].copy()
+
+    model = update_model(model, data)
+    validate_model(ragged_index, data, model, config)
+    assert np.all(model['assignments'][:N, :] == old_assignments)
+
+
 def hash_assignments(assignments):
     assert isinstance(assignments, np.ndarray)
     return tuple(tuple(row) for row in assignments)
@@ -212,3 +994,113 @@ def test_assignment_sampler_gof(N, V, C, M):
         print('{:}\t{:0.1f}\t{}'.format(count, prob * num_samples, key))
     gof = multinomial_goodness_of_fit(probs, counts, num_samples, plot=True)
     assert 1e-2 < gof
+
+
+@pytest.mark.parametrize('N,V,C,M,weights', [
+    (2, 1, 2, 2, [1, 2]),
+    (2, 1, 3, 3, [1, 2]),
+    (2, 2, 2, 2, [2, 3]),
+    (2, 3, 2, 2, [3, 1]),
+    (3, 1, 2, 2, [1, 2, 3]),
+])
+def test_weighted_assignment_sampler_gof(N, V, C, M, weights):
+    config = make_default_config()
+    config['learning_sample_tree_steps'] = 0  # Disable tree kernel.
+    config['model_num_clusters'] = M
+    dataset = generate_dataset(num_rows=N, num_cols=V, num_cats=C, rate=2.0)
+    ragged_index = dataset['ragged_index']
+    data = dataset['data']
+    trainer = TreeCatTrainer(ragged_index, data, config, weights)
+    print('Data:')
+    print(data)
+
+    # Add all rows.
+    set_random_seed(0)
+    for row_id in range(N):
+        trainer.add_row(row_id)
+
+    # Collect samples.
+    num_samples = 500 * M**(N * V)
+    counts = {}
+    logprobs = {}
+    for _ in range(num_samples):
+        # Thin samples, since weighted rows switch modes slowly.
+        for _ in range(3):
+            for row_id in range(N):
+                trainer.remove_row(row_id)
+                trainer.add_row(row_id)
+        key = hash_assignments(trainer._assignments)
+        if key in counts:
+            counts[key] += 1
+        else:
+            counts[key] = 1
+            logprobs[key] = trainer.logprob()
+    assert len(counts) == M**(N * V)
+
+    # Check accuracy using Pearson's chi-squared test.
+    keys = sorted(counts.keys())
+    counts = np.array([counts[k] for k in keys], dtype=np.int32)
+    probs = np.exp(np.array([logprobs[k] for k in keys]))
+    probs /= probs.sum()
+    print('Actual\tExpected\tAssignment')
+    for count, prob, key in zip(counts, probs, keys):
+        print('{:}\t{:0.1f}\t{}'.format(count, prob * num_samples, key))
+    gof = multinomial_goodness_of_fit(probs, counts, num_samples, plot=True)
+    assert 1e-2 < gof
+
+
+@pytest.mark.parametrize('N,V,C,M,weights', [
+    (1, 1, 2, 3, None),
+    (1, 3, 2, 2, None),
+    (2, 1, 2, 3, None),
+    (2, 2, 2, 2, None),
+    (2, 3, 2, 2, None),
+    (2, 3, 2, 2, [1, 2]),
+    (3, 2, 2, 2, [2, 1, 1]),
+    (4, 1, 2, 2, None),
+])
+def test_parallel_sampler_gof(N, V, C, M, weights):
+    config = make_default_config()
+    config['learning_sample_tree_steps'] = 0  # Disable tree kernel.
+    config['model_num_clusters'] = M
+    dataset = generate_dataset(num_rows=N, num_cols=V, num_cats=C)
+    ragged_index = dataset['ragged_index']
+    data = dataset['data']
+    trainer = TreeCatTrainer(ragged_index, data, config, weights)
+    print('Data:')
+    print(data)
+
+    # Add all rows.
+    set_random_seed(0)
+    for row_id in range(N):
+        trainer.add_row(row_id)
+
+    # Enumerate the exact posterior.
+    keys = list(itertools.product(range(M), repeat=N * V))
+    logprobs = []
+    for key in keys:
+        trainer._assignments[...] = np.reshape(key, (N, V))
+        trainer._update_suffstats()
+        logprobs.append(trainer.logprob())
+    probs = np.exp(np.array(logprobs) - max(logprobs))
+    probs /= probs.sum()
+
+    # Check that a few sweeps started from the posterior preserve it. Each
+    # sample starts afresh, which avoids autocorrelation of a single chain.
+    num_samples = 500 * M**(N * V)
+    counts = np.zeros(len(keys), np.int32)
+    for _ in range(num_samples):
+        key = keys[np.random.choice(len(keys), p=probs)]
+        trainer._assignments[...] = np.reshape(key, (N, V))
+        trainer._update_suffstats()
+        for _ in range(5):
+            trainer.sample_assignments()
+        key = tuple(trainer._assignments.reshape(-1))
+        counts[np.ravel_multi_index(key, (M, ) * (N * V))] += 1
+
+    # Check accuracy using Pearson's chi-squared test.
+    print('Actual\tExpected\tAssignment')
+    for count, prob, key in zip(counts, probs, keys):
+        print('{:}\t{:0.1f}\t{}'.format(count, prob * num_samples, key))
+    gof = multinomial_goodness_of_fit(probs, counts, num_samples, plot=True)
+    assert 1e-2 < gof
@@ -12,6 +12,7 @@ from collections import defaultdict
 from timeit import default_timer
 
 import numpy as np
+import scipy.sparse
 
 TREECAT_JIT = int(os.environ.get('TREECAT_JIT', 1))
 DEBUG_LEVEL = int(os.environ.get('TREECAT_DEBUG_LEVEL', 0))
@@ -33,10 +34,49 @@ def no_jit(*args, **kwargs):
 if TREECAT_JIT:
     try:
         from numba import jit
+        from numba import prange
     except ImportError:
         jit = no_jit
+        prange = range
 else:
     jit = no_jit
+    prange = range
+
+
+def set_num_threads(num_threads):
+    """Set the number of threads used by parallel jit-compiled kernels.
+
+    Args:
+      num_threads: A positive number of threads, or 0 for all cores. This
+        is ignored by numba < 0.49, which always uses all cores.
+    """
+    if jit is no_jit:
+        return
+    import numba
+    if not hasattr(numba, 'set_num_threads'):
+        return
+    if not num_threads:
+        num_threads = numba.config.NUMBA_NUM_THREADS
+    numba.set_num_threads(min(num_threads, numba.config.NUMBA_NUM_THREADS))
+
+
+def is_threading_started():
+    """Whether a parallel jit-compiled kernel has started a threading layer.
+
+    Returns:
+      True if worker threads may be running, in which case this process is no
+      longer safe to fork().
+    """
+    if jit is no_jit:
+        return False
+    import numba
+    if not hasattr(numba, 'threading_layer'):
+        return True  # Conservatively assume threads may be running.
+    try:
+        numba.threading_layer()
+    except ValueError:
+        return False
+    return True
 
 
 @jit
@@ -109,6 +149,91 @@ def make_ragged_index(columns):
     return ragged_index
 
 
+def make_sparse_data(data):
+    """Convert ragged data to a sparse row format.
+
+    Args:
+      data: An [N, R]-shaped numpy array or scipy.sparse matrix of ragged
+        multinomial count data.
+
+    Returns:
+      An [N, R]-shaped scipy.sparse.csr_matrix of int8 counts with sorted
+      column indices, where only observed cells are stored.
+    """
+    if scipy.sparse.issparse(data):
+        data = data.tocsr()
+        if data.dtype != np.int8:
+            data = data.astype(np.int8)
+    else:
+        data = scipy.sparse.csr_matrix(np.asarray(data, np.int8))
+    if not data.data.all():
+        data = data.copy()
+        data.eliminate_zeros()
+    if not data.has_sorted_indices:
+        data = data.sorted_indices()
+    return data
+
+
+def split_data(data):
+    """Split dense or sparse data into arrays for jit-compiled kernels.
+
+    Args:
+      data: An [N, R]-shaped int8 numpy array, or a scipy.sparse.csr_matrix
+        as returned by make_sparse_data().
+
+    Returns:
+      A tuple (dense, indptr, cells, counts) of numpy arrays. Dense data is
+      passed through without copying, with empty sparse arrays; sparse data
+      is split into its CSR arrays, with an empty dense array.
+    """
+    if scipy.sparse.issparse(data):
+        return (np.zeros((0, data.shape[1]), np.int8),
+                data.indptr.astype(np.int32, copy=False),
+                data.indices.astype(np.int32, copy=False), data.data)
+    return (data, np.zeros(0, np.int32), np.zeros(0, np.int32),
+            np.zeros(0, np.int8))
+
+
+def dedup_rows(data):
+    """Find the unique rows of a dense data array.
+
+    Args:
+      data: An [N, R]-shaped numpy array.
+
+    Returns:
+      A tuple (unique_data, weights, inverse), where unique_data is a
+      [U, R]-shaped array of unique rows, weights is a [U]-shaped int32 array
+      of row multiplicities, and inverse is an [N]-shaped array such that
+      data == unique_data[inverse].
+    """
+    data = np.asarray(data)
+    assert len(data.shape) == 2
+    if data.shape[0] == 0:
+        return data, np.zeros(0, np.int32), np.zeros(0, np.int32)
+    unique_data, inverse, weights = np.unique(
+        data, axis=0, return_inverse=True, return_counts=True)
+    inverse = inverse.reshape(-1).astype(np.int32)
+    return unique_data, weights.astype(np.int32), inverse
+
+
+def find_sparse_cells(data):
+    """Find the observed cells of ragged data.
+
+    Args:
+      data: An [N, R]-shaped numpy array or scipy.sparse matrix of ragged
+        multinomial count data.
+
+    Returns:
+      A tuple (rows, cols, counts) of [nnz]-shaped numpy arrays.
+    """
+    if scipy.sparse.issparse(data):
+        data = data.tocoo()
+        nonzero = (data.data != 0)
+        return data.row[nonzero], data.col[nonzero], data.data[nonzero]
+    rows, cols = np.nonzero(data)
+    return rows, cols, data[rows, cols]
+
+
 class ProfilingSet(defaultdict):
     __getattr__ = defaultdict.__getitem__
     __setattr__ = defaultdict.__setitem__
@@ -6,8 +6,10 @@ import numpy as np
 import pytest
 from goftests import multinomial_goodness_of_fit
 
+from treecat.util import dedup_rows
 from treecat.util import sample_from_probs
 from treecat.util import sample_from_probs2
+from treecat.util import set_num_threads
 from treecat.util import set_random_seed
 from treecat.util import sizeof
 
@@ -55,3 +57,25 @@ def test_sample_from_probs2_gof(size):
     print(probs * num_samples)
     gof = multinomial_goodness_of_fit(probs, counts, num_samples, plot=True)
     assert 1e-2 < gof
+
+
+@pytest.mark.parametrize('shape', [(0, 3), (1, 3), (10, 1), (100, 4)])
+def test_dedup_rows(shape):
+    set_random_seed(0)
+    data = np.random.randint(2, size=shape).astype(np.int8)
+    unique_data, weights, inverse = dedup_rows(data)
+    assert unique_data.dtype == data.dtype
+    assert unique_data.shape[1] == data.shape[1]
+    assert weights.shape == (unique_data.shape[0], )
+    assert inverse.shape == (data.shape[0], )
+    assert np.all(unique_data[inverse] == data)
+    assert weights.sum() == data.shape[0]
+    assert np.all(weights == np.bincount(inverse, minlength=len(weights)))
+    assert len(set(map(tuple, unique_data))) == unique_data.shape[0]
+
+
+@pytest.mark.parametrize('num_threads', [0, 1, 2])
+def test_set_num_threads_old_numba(monkeypatch, num_threads):
+    numba = pytest.importorskip('numba')
+    monkeypatch.delattr(numba, 'set_num_threads')
+    set_num_threads(num_threads)